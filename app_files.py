@@ -2,11 +2,14 @@
 ## Description: Functions for doing things with files (duh).
 ## Contains:    file_read_uint          Read the next uint32_t from a file
 ##              file_read_line          Read a single line from a text file (one-based)
+##              file_read_lines         Read a set of lines from a text file (one-based) in a single pass
 ##              file_get_size           Fetch the on-disk size of a file
 ##              file_get_lines          Fetch the number of lines in the file
 ##              file_read_random_line   Just what it says on the tin
+##              ResourceStore           Memory-mapped access to the fixed-width data files
 
 import os
+import mmap
 import struct
 import app_numeric
 
@@ -49,6 +52,8 @@ file_config     = dir_data + "config.ini"           ## file - configuration
 file_all_rgn    = dir_data + "all_rgn.txt"          ## file - time zone region information
 file_tz_index   = dir_data + "all_tz.idx"           ## file - time zone index to the map
 file_tz_map     = dir_data + "all_tz.map"           ## file - time zone compressed map
+file_tz_raster  = dir_data + "all_tz.ras"           ## file - time zone dense raster (derived from the map, not under source control)
+file_lunations  = dir_data + "all_nm.bin"           ## file - new moon table, 2024 to 2100 (generated by app_numeric.lunation_build)
 
 file_macro      = dir_data + "r_macr.txt"           ## file - macro definitions for daily events
 file_time       = dir_data + "r_time.txt"           ## file - lines for specific times of day
@@ -73,29 +78,28 @@ def file_read_uint (fin):
 ## constants at the start of this file.
 
 def file_read_line (fname, linenum, linelen):
-    f = open(fname, "r")                        ## open the file and skip to the needed line
-    f.seek((linenum - 1) * linelen)
-    s = f.read(linelen - 2)                     ## read the line then close the file
-    f.close()
-    return (s)
+    return (store.read_line(fname, linenum, linelen))
+
+
+## Read a set of lines from a text file in one go, with the same assumptions as file_read_line.  The line numbers
+## are sorted and merged in to contiguous runs so that each run of neighbouring lines is a single range read.  The
+## lines are returned as a list in the same order as the requested line numbers (duplicates are allowed).
+
+def file_read_lines (fname, linenums, linelen):
+    return (store.read_lines(fname, linenums, linelen))
     
 
 ## Fetch the on-disk size of a file.
 
 def file_get_size (fname):
-    f = open(fname, 'r')                        ## open the file as read-only
-    f.seek(0, 2)                                ## move to the end of file
-    stop = f.tell()                             ## get the byte offset
-    f.close()                                   ## close the file
-    return (stop)
+    return (store.size(fname))
  
  
 ## Fetch the size of the files as a number of lines, assuming that every line in the file has the
 ## same length.
  
 def file_get_lines (fname, linelen):
-    a = file_get_size(fname)
-    return (int(a / linelen))
+    return (store.lines(fname, linelen))
 
 
 ## Read a single RANDOM line from a text file, assuming that every line is the same length as specified
@@ -104,15 +108,111 @@ def file_get_lines (fname, linelen):
 ## are given as constants at the start of this file.
 
 def file_read_random_line (fname, linelen = k_LEN_R_ANYS):
-    f = open(fname, 'r')                        ## open the file as read-only
-    f.seek(0, 2)                                ## move to the end of file
-    stop = f.tell()                             ## get the byte offset
-    lines = int(stop / linelen)                 ## compute the number of lines
+    return (store.read_random_line(fname, linelen))
+
+
+## ------------------------------------------------------------------------------------------------- CLASS - ResourceStore
+## Memory-mapped store for all of the fixed-width data files.  Every file is opened and mapped exactly once (on first
+## use) and then stays mapped for the life of the process.  Handing out a line is then just a slice of the mapping, so
+## a fetch costs no open, seek, read, or close calls at all -- the only cost is the page cache.  Files are addressed by
+## the same path names as everywhere else in the app (file_any, file_macro, dir_h_year + "h_2026.txt", etc.).  If the
+## data files are edited while the app is running, call release() to drop the stale mappings.
+
+class ResourceStore:
+    
+    ## The set of files that every fetch is likely to touch.  These are mapped up front by preload().  The r_year and
+    ## h_year files are mapped on demand, since only the one for the current year is ever needed.
+    
+    k_preload = [ file_any, file_brc, file_cond, file_macro, file_time, file_all_rgn ]
+    
+    def __init__ (self):
+        self.maps = {}                              ## file name -> memory map (or bytes for empty files)
+    
+    
+    ## Map every file in the preload list.  This is optional, since map() will do the same on first use.
+    
+    def preload (self):
+        for fname in self.k_preload:
+            self.map(fname)
+    
+    
+    ## Return the memory map for the given file name, mapping it if this is the first time that it has been asked
+    ## for.  Zero-length files cannot be memory mapped, so those are stored as an empty byte string.
+    
+    def map (self, fname):
+        m = self.maps.get(fname)
+        if (m is None):
+            f = open(fname, 'rb')                   ## open the file as read-only (binary, so that offsets are bytes)
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:                      ## can't map an empty file
+                m = b""
+            f.close()                               ## the mapping stays valid after the file is closed
+            self.maps[fname] = m
+        return (m)
     
-    r = app_numeric.arand(2, 0, (lines - 1))    ## pick out a random line
-    f.seek(r * linelen)                         ## jump to that line
-    s = f.read(linelen - 2)                     ## read the line then close the file and return the line
-    f.close()
-    return (s)
     
+    ## Drop the mapping for a single file, or all of them if no file name is given.  The next access re-maps.
+    
+    def release (self, fname = None):
+        if (fname is None):
+            names = list(self.maps.keys())
+        else:
+            names = [ fname ]
+        for n in names:
+            m = self.maps.pop(n, None)
+            if (isinstance(m, mmap.mmap)):
+                try:
+                    m.close()
+                except BufferError:                     ## still in use (an array over it), so it is unmapped when
+                    pass                                ## the last user lets go of it
+    
+    
+    ## Size of the file in bytes and size of the file in lines (for fixed-width files).
+    
+    def size (self, fname):
+        return (len(self.map(fname)))
+    
+    def lines (self, fname, linelen):
+        return (int(self.size(fname) / linelen))
+    
+    
+    ## Return a single line (one-based line number) without the trailing [CR][LF] characters.
+    
+    def read_line (self, fname, linenum, linelen):
+        m = self.map(fname)
+        i = (linenum - 1) * linelen
+        return (m[i:(i + linelen - 2)].decode())
+    
+    
+    ## Return a list of lines for a list of (one-based) line numbers.  Requested lines are sorted and merged in to
+    ## runs of consecutive line numbers, each run is sliced out of the mapping in one piece and then cut up in to
+    ## lines.  The result is handed back in the order that the lines were requested.
+    
+    def read_lines (self, fname, linenums, linelen):
+        m     = self.map(fname)
+        found = {}                                      ## line number -> line
+        nums  = sorted(set(linenums))
+        i     = 0
+        while (i < len(nums)):
+            j = i                                       ## find the end of this run of consecutive lines
+            while ((j + 1 < len(nums)) and (nums[j + 1] == nums[j] + 1)):
+                j = j + 1
+            a = (nums[i] - 1) * linelen                 ## read the whole run in one slice
+            b = nums[j] * linelen
+            run = m[a:b]
+            for k in range(j - i + 1):                  ## and split it back in to lines
+                found[nums[i + k]] = run[(k * linelen):((k * linelen) + linelen - 2)].decode()
+            i = j + 1
+        return ([ found[n] for n in linenums ])
+    
+    
+    ## Return a single line chosen at random from the file.
+    
+    def read_random_line (self, fname, linelen = k_LEN_R_ANYS):
+        lines = self.lines(fname, linelen)              ## compute the number of lines
+        r = app_numeric.arand(2, 0, (lines - 1))        ## pick out a random line
+        return (self.read_line(fname, r + 1, linelen))
+
 
+store = ResourceStore()                             ## the one and only resource store for the app
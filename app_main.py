@@ -7,9 +7,7 @@
 ## search in notepad++ with the following parameter: [^\n-~]  Anything not in the valid UTF-8 set will
 ## be highlighted.
 
-import tkinter as tk
 import numpy as np
-from PIL import ImageTk, Image
 import sys
 import os
 import signal
@@ -25,6 +23,13 @@ import app_numeric
 import app_timezones
 import app_files
 
+## The display libraries are only imported when the App window is made, so that the parser (and anything else that
+## imports this module) can run headless, without Tk or PIL.
+
+tk      = app_numeric.lazy_import("tkinter",     globals(), "tk")
+ImageTk = app_numeric.lazy_import("PIL.ImageTk", globals(), "ImageTk")
+Image   = app_numeric.lazy_import("PIL.Image",   globals(), "Image")
+
 
 ## ------------------------------------------------------------------------------------------------- CONSTANT DEFINITIONS
 ## Global valid image set.  Any image names not in this set will not be used.
@@ -37,8 +42,8 @@ imgs = set( [ 'brc', 'brd', 'car', 'chn', 'cop', 'cyb', 'd20', 'dcc', 'els', 'gf
 
 ## ------------------------------------------------------------------------------------------------- GLOBAL VARIABLES
 
-ltc  = datetime.datetime.now()                      ## init the times
-utc  = datetime.datetime.now(datetime.UTC)
+ltc  = app_numeric.clock.now()                      ## init the times
+utc  = app_numeric.clock.utcnow()
 
 ## ------------------------------------------------------------------------------------------------- CLASS - Config
 ## Class for managing the configuration file read/writes
@@ -55,6 +60,8 @@ class Config:
         self.debug   = False                        ## debug flag (used for setting sleepytime and other stuff)
         self.playa   = True                         ## display on-playa messages
         self.has_gps = False                        ## flag - GPS module is present in the system
+        self.tz_eng  = "rle"                        ## timezone lookup engine (rle = small devices, raster = servers)
+        self.seed    = ""                           ## random seed for reproducible runs ("" = truly random)
         self.img_dir = app_files.dir_images         ## directory for image files
         
         self.l_chars = 56                           ## number of characters in a single line
@@ -94,6 +101,10 @@ class Config:
         self.playa   = ('True' == self.p[self.sec]['playa'])    ## on playa flag (true | false)
         self.has_gps = ('True' == self.p[self.sec]['gps'])      ## gps module installed
         self.img_dir = self.p[self.sec]['img_dir']              ## image directory
+        self.tz_eng  = self.p[self.sec].get('tz_engine', 'rle') ## timezone lookup engine (optional)
+        if (self.tz_eng not in app_timezones.k_TZ_ENGINES): self.tz_eng = 'rle'
+        self.seed    = self.p[self.sec].get('seed', '').strip() ## random seed (optional)
+        if (not self.seed.isdigit()): self.seed = ''
         
         self.l_chars = int(self.p[self.sec]['l_chars'])         ## read character settings
         self.l_lines = int(self.p[self.sec]['l_lines'])
@@ -115,7 +126,8 @@ class Config:
                              'gps':      self.has_gps,   'img_dir':  self.img_dir,   'l_chars':  self.l_chars,
                              'l_lines':  self.l_lines,   'l_start':  self.l_start,   'l_end':    self.l_end, 
                              'l_step':   self.l_step,    't_font':   self.t_font,    't_size':   self.t_size, 
-                             't_sstep':  self.t_sstep,   't_style':  self.t_style,   't_color':  self.t_color
+                             't_sstep':  self.t_sstep,   't_style':  self.t_style,   't_color':  self.t_color,
+                             'tz_engine': self.tz_eng,   'seed':     self.seed
         }
         cfgfile = open(self.f_cfg, 'w')
         self.p.write(cfgfile)
@@ -133,6 +145,9 @@ class App ():
     def __init__ (self):
         self.p          = app_parser.Parser()       ## make a new parser instance
         self.cfg        = Config()                  ## read the configuration file
+        app_timezones.set_timezone_engine(self.cfg.tz_eng)
+        if ((self.cfg.seed != "") and (os.environ.get(app_numeric.k_SEED_ENV, "") == "")):
+            app_numeric.seed_random(self.cfg.seed)  ## seeded run from the config (the environment variable wins)
         self.i          = 0                         ## iteration counter
         self.c          = app_parser.coordinate(ltc, utc, self.cfg.lat, self.cfg.lon, self.cfg.tz, self.cfg.tz_off)
         
@@ -162,9 +177,23 @@ class App ():
         self.imgB   = ImageTk.PhotoImage(Image.open(self.cfg.img_dir + "brd.jpg"))
         self.bgimg  = self.canvas.create_image(center_x, center_y, image=self.imgB, anchor='center', state='hidden')
         
-        ## create each text box (one per character) as an array
+        self.make_textboxes(center_x, center_y, radius, angle_start, angle_end)
+        clock_font = (self.cfg.t_font, self.cfg.t_size, self.cfg.t_style)
+        if (angle_off != 0):
+            self.clock_txt = self.canvas.create_text(center_x - 300, center_y + 300, anchor="center", font=clock_font, fill="#040", angle=angle_off)
+        else:
+            self.clock_txt = self.canvas.create_text(center_x, self.h - 150, anchor="center", font=clock_font, fill="#040")
         
-        self.textboxes = [ [], [], [], [], [], [] ]
+        self.update_me()                            ## update the UI elements
+        self.root.mainloop()                        ## then enter the primary loop
+    
+    ## Create each text box (one per character) as an array, one row per line, and the shadow buffer that holds
+    ## what each one is showing right now (they all start out blank).
+    
+    def make_textboxes (self, center_x, center_y, radius, angle_start, angle_end):
+        self.textboxes = [ [] for j in range(self.cfg.l_lines) ]
+        self.shown     = [ ([ "" ] * self.cfg.l_chars) for j in range(self.cfg.l_lines) ]
+        self.frame_ms  = 0.0                                                ## time taken by the last update_strings
         angle_inc = (abs(angle_end - angle_start)) / self.cfg.l_chars
         for i in range(self.cfg.l_chars + 1):
             cangle = angle_start - (i * angle_inc)
@@ -174,14 +203,6 @@ class App ():
                 textY = center_y - ((radius - (j * self.cfg.l_step)) * np.sin(cangle))
                 next_font = (self.cfg.t_font, (self.cfg.t_size - (j * self.cfg.t_sstep)), self.cfg.t_style)
                 self.textboxes[j].append(self.canvas.create_text(textX, textY, font=next_font, fill=self.cfg.t_color, angle=aangle ))
-        clock_font = (self.cfg.t_font, self.cfg.t_size, self.cfg.t_style)
-        if (angle_off != 0):
-            self.clock_txt = self.canvas.create_text(center_x - 300, center_y + 300, anchor="center", font=clock_font, fill="#040", angle=angle_off)
-        else:
-            self.clock_txt = self.canvas.create_text(center_x, self.h - 150, anchor="center", font=clock_font, fill="#040")
-        
-        self.update_me()                            ## update the UI elements
-        self.root.mainloop()                        ## then enter the primary loop
     
     ## Do whatever needs to be done on application quit.  Including updating the config file if needed.
     
@@ -199,13 +220,44 @@ class App ():
             self.imgB = ImageTk.PhotoImage(Image.open(fname))                   ## otherwise get the image and show it
             self.canvas.itemconfig(self.bgimg, image=self.imgB, state='normal')
     
-    ## Update the contents of the string lines (concentric circles).  First, split the incoming string
-    ## to individual lines as needed.  Then erase the previous elements by setting each element text
-    ## to a nullstring.  Then add the new text by updating each element on a character-by-character
-    ## basis.  If there are any lines that are less than the maximum single line length, then pad with
-    ## spaces to make everything more-or-less lined up.
+    ## Lay out what every text box should show for a string, one list of characters per line.  First,
+    ## split the incoming string to individual lines as needed.  If there are any lines that are less
+    ## than the maximum single line length, then pad with spaces to make everything more-or-less lined
+    ## up.  A space draws nothing, so spaces (including the pad) are laid out as blanks.
+    
+    def layout_strings(self, aa):
+        bb  = app_strings.split_me(aa, self.cfg.l_chars)                    ## split the string in to lines as needed
+        out = []
+        for j in range(self.cfg.l_lines):
+            new = [ "" ] * self.cfg.l_chars                                 ## what this line should show
+            if (j < len(bb)):
+                l = len(bb[j])
+                if (l > 1) and (l < (self.cfg.l_chars - 1)):                ## justify short lines as needed
+                    bb[j] = (" " * int((self.cfg.l_chars - l) / 2)) + bb[j]
+                l = len(bb[j])
+                if (l > 1):
+                    for i in range(min(self.cfg.l_chars, l)):
+                        if (bb[j][i] != " "): new[i] = bb[j][i]
+            out.append(new)
+        return (out)
+    
+    ## Update the contents of the string lines (concentric circles).  Compare the new layout with the
+    ## shadow buffer (what each text box is showing now) and only update the glyphs that changed.
     
     def update_strings(self, aa):
+        t0 = time.perf_counter()
+        for (j, new) in enumerate(self.layout_strings(aa)):
+            old = self.shown[j]
+            for i in range(self.cfg.l_chars):
+                if (new[i] != old[i]):
+                    self.canvas.itemconfig(self.textboxes[j][i], text=new[i])
+                    old[i] = new[i]
+        self.frame_ms = (time.perf_counter() - t0) * 1000.0
+    
+    ## The same update the way it used to be done:  blank every text box, then write every character of
+    ## the new string (about 680 itemconfig calls).  Kept for comparison in app_main_bench_strings.
+    
+    def update_strings_redraw(self, aa):
         bb = app_strings.split_me(aa, self.cfg.l_chars)                     ## split the string in to lines as needed
         for j in range (0, self.cfg.l_lines):                               ## erase the previous string
             for i in range (0, self.cfg.l_chars):
@@ -218,6 +270,7 @@ class App ():
             if (l > 1):                                                     ## write line-by-line
                 for i in range(min(self.cfg.l_chars, l)):
                     self.canvas.itemconfig(self.textboxes[j][i], text=bb[j][i])
+        self.shown = self.layout_strings(aa)
     
     ## Perform whatever periodic maintenance may be needed.  This includes things like updating the GPS
     ## location and re-checking the timezone.  It only occurs once every hundred updates of the clock.  In
@@ -225,16 +278,21 @@ class App ():
     ## is nominally every 2.5 minutes) this is once every 4-ish hours (0:25 - 8:20).
     
     def periodic (self):
-        alat = 0.000                                                            ## local lat/lon to try
-        alon = 0.000
+        alat = self.c.lat                                                       ## local lat/lon to try
+        alon = self.c.lon
         atz  = 0                                                                ## local timezone to try
         ## ------------------ attempt to get lat, lon, utc from gps (if self.c.has_gps == True)
         ## ------------------ attempt to get timezone from lat, lon
+        atz  = app_timezones.get_timezone(alat, alon)
         ## set tz to 'brc' if within the boundaries of black rock city region: 40.750, -118.900, 41.150, -119.450
         if ((alat > 40.750) and (alat < 41.150) and (alon > -119.450) and (alon < -118.900)): atz = 452
                 
         ## ------------------ update the offset from utc to ltc
-        ## ------------------ update the coordinate information
+        if (app_timezones.regions.is_region(atz)):
+            tzi = app_timezones.get_timezone_data(atz, self.c.utc.date())
+            ## -------------- update the coordinate information
+            self.c.tz     = atz
+            self.c.tz_off = tzi.offset
         self.i = 0                                                              ## reset the counter
         return (0)
     
@@ -246,8 +304,7 @@ class App ():
     def update_me (self):
         if ((self.i % 100) == 0): self.periodic()                               ## perform periodic updates
         self.i     = self.i + 1                                                 ## increment the counter
-        self.c.ltc = datetime.datetime.now()                                    ## update the current time
-        self.c.utc = datetime.datetime.now(datetime.UTC)
+        app_parser.coordinate_now(self.c)                                       ## update the current time
         on_playa   = (self.cfg.playa) or (self.c.tz == 452)
         a = self.p.fetch(self.c, on_playa)                                      ## fetch the next message
         
@@ -266,12 +323,78 @@ class App ():
         #### debug strings - log every message with a date/time stamp
         sa = img
         if (sa == ""): sa = "   "
-        print ('{date:%Y-%m-%d %H:%M:%S}'.format(date=datetime.datetime.now()) + " [" + att + "][" + sa + "] " + a.message)
+        print ('{date:%Y-%m-%d %H:%M:%S}'.format(date=self.c.ltc) + " [" + att + "][" + sa + "] " + a.message)
         
+        t0 = time.perf_counter()
         self.update_strings(a.message)                                          ## update the message string
+        if (self.cfg.debug):                                                    ## debug - time the redraw too, and log it
+            self.root.update_idletasks()
+            print ("    frame %.1f ms (update_strings %.1f ms)" % ((time.perf_counter() - t0) * 1000.0, self.frame_ms))
         sleepytime = app_numeric.roll_dice("3d20") * 5000                       ## random sleepytime = 0:15 - 5:00 (nominally 2.5 minutes)
         if (self.cfg.debug): sleepytime = 5000                                  ## debug sleepytime = 5 seconds
         self.root.after(sleepytime, self.update_me)                             ## set the time for the next update
         
 
 
+## ------------------------------------------------------------------------------------------------- TEST CODE
+
+## Compare update_strings with update_strings_redraw (the old way) over a run of messages from the parser, on the
+## 1920-wide layout (a 1920x1080 canvas):  itemconfig calls per message and the frame time per message (the updates
+## plus the redraw).  With a display the canvas is a real Tk one, with its calls counted on the way through.  Without
+## one (or without Tk) the calls are only counted, and the times are just the python side of the update.
+
+class CountingCanvas:
+
+    def __init__ (self, canvas = None):
+        self.canvas = canvas                                ## real canvas to pass the calls on to (or None)
+        self.calls  = 0                                     ## number of itemconfig calls
+        self.items  = 0                                     ## number of items made
+
+    def create_text (self, *args, **kwargs):
+        self.items = self.items + 1
+        if (self.canvas is None): return (self.items)
+        return (self.canvas.create_text(*args, **kwargs))
+
+    def itemconfig (self, item, **kwargs):
+        self.calls = self.calls + 1
+        if (self.canvas is not None): self.canvas.itemconfig(item, **kwargs)
+
+def app_main_bench_strings (count = 200, seed = 1234):
+    p   = app_parser.Parser()                                                   ## a seeded run of messages
+    old = app_numeric.seed_random(seed)
+    t0  = datetime.datetime(2026, 8, 30, 12, 0, 0)
+    msg = []
+    for i in range(count):
+        c = app_parser.coordinate(t0 + datetime.timedelta(minutes = i), t0 + datetime.timedelta(minutes = i, hours = 7),
+                                  40.786110, -119.204595, 452, -700)
+        msg.append(p.fetch(c, True).message)
+    app_numeric.set_entropy_pool(old)
+
+    app = App.__new__(App)                                                      ## just the text part of the app
+    app.cfg = Config()
+    root    = None
+    try:
+        root   = tk.Tk()
+        canvas = tk.Canvas(root, height=1080, width=1920, bg='black', highlightthickness=0)
+        canvas.pack()
+    except Exception:                                                           ## no display (or no Tk)
+        root   = None
+        canvas = None
+    app.canvas = CountingCanvas(canvas)
+    app.make_textboxes(960, 540, 540 - 55, np.radians(app.cfg.l_start - 45.0), np.radians(app.cfg.l_end - 45.0))
+
+    print ("%d messages, %d empty, %s" % (len(msg), msg.count(""), ("tk canvas" if (root is not None) else "no display, calls counted only")))
+    for (label, fn) in [ ("redraw", app.update_strings_redraw), ("shadow", app.update_strings) ]:
+        app.update_strings_redraw("")                                           ## start from a blank display
+        calls = app.canvas.calls
+        times = []
+        for s in msg:
+            t1 = time.perf_counter()
+            fn(s)
+            if (root is not None): root.update()
+            times.append((time.perf_counter() - t1) * 1000.0)
+        print ("%-8s %6.1f itemconfig calls per message,  frame %6.2f ms mean  %6.2f ms max" %
+               (label, (app.canvas.calls - calls) / len(msg), sum(times) / len(times), max(times)))
+    if (root is not None): root.destroy()
+
+## app_main_bench_strings()
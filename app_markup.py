@@ -1,11 +1,28 @@
 ##	Module:			    app_markup
 ##	Description:	    Process all of the markup characters in a string for the app.
 ##  Primary:            process_me              Primary markup processor and (should be the) only interface
+##                      process_me_regex        The same, one regex pass per markup stage (no render plan)
+##  Render Plans:       markup_plan             A line compiled once in to literal text and substitution nodes
+##                      plan_compile            Compile a line in to a render plan (cached)
+##                      plan_render             Render a plan for a coordinate
 ##  Helper Functions:   get_24_to_12h           Convert a 24-hour time to a 12-hour time
 ##                      get_season              Return the season given the current date-time
+##  Day Context:        day_context             Everything about a coordinate that only changes with the day
+##                      get_day_context         The day context of a coordinate (made once a day, shared)
+##                      day_season              Season, from the day context
+##                      day_sun                 Sunrise, solar noon, and sunset (local day fractions), from the day context
+##                      day_moon                Phase of the moon, from the day context
+##  GPS Targets:        gps_target              The (lat, lon) of a <G= item
+##                      GpsTargets              Heading and distance to every <G= target, cached by position
 ##  Sub-processors:     conditions              Check the conditional statements (if any)
+##                      condition_test          Test a set of conditional statements
+##                      condition_compile       Compile a set of conditional statements (cached)
+##                      condition_features      Every quantity a condition can test, for a coordinate (cached)
+##                      condition_strip         Strip the end-of-line flags
 ##                      sub_year                Handle the case of (<a|b|o>-xxxx)
+##                      sub_year_text           The text for one year substitution
 ##                      sub_macro               Handle macro subsititutions (_<?>)
+##                      sub_macro_expand        Expand one macro (regex callback)
 ##                      sub_numeric             Handle numeric substitutions (#nnnn)
 ##                      sub_computed            Handle computed substitutions (<xxxxx...)
 ##  Sub-sub-processors: sub_subproc_A           lat-lon coordinates rendered as the nearest whole number
@@ -34,13 +51,17 @@
 ##                      sub_subproc_qq          random choice between multiple items in a list
 
 from dataclasses import dataclass
+import functools
 import re
 import datetime
 import math
 import time
 
+import numpy
+
 import app_strings
 import app_numeric
+import app_timezones
 import app_files
 
 
@@ -54,6 +75,8 @@ class coordinate:
     lon:        float       = 0.0                           ## current longitude
     tz:         int         = 0                             ## current timezone identifier
     tz_off:     int         = 0                             ## current timezone offset (lct = utc + off) in <+|->hhmm
+    clock:      object      = None                          ## clock for "now" (None = the app clock, app_numeric.clock)
+    day:        object      = None                          ## everything that only changes with the day (see get_day_context)
 
 ## ------------------------------------------------------------------------------------------------- PRIMARY FUNCTION
 
@@ -67,8 +90,17 @@ class coordinate:
 ##      3)  Perform any k_macro substitutions "_..." in the string.
 ##      4)  Perform any number substitutions "#..." in the string.
 ##      5)  Perform any computed substitutions "<..." in the string.
+##
+## The stages that don't depend on the coordinate are only done once per line:  the line is compiled in to a render
+## plan (see RENDER PLANS below) the first time that it is seen, and the plan is rendered from then on.  Lines that a
+## plan can't reproduce exactly go through process_me_regex(), which does every stage on every call.
 
 def process_me (s, coord):
+    plan = plan_compile(s)
+    if (plan is None): return (process_me_regex(s, coord))
+    return (plan_render(plan, coord))
+
+def process_me_regex (s, coord):
     s = conditions(s, coord)                        ## 1) check any conditional statements
     if (s == ""): return ("")                       ##      if conditions fail just pop out
     s = sub_year(s, coord)                          ## 2) perform year substitutions
@@ -106,6 +138,138 @@ def get_season (c):
     else: 
         if (c.lat > 0): return (4)
         else:           return (2)
+
+
+## ------------------------------------------------------------------------------------------------- DAY CONTEXT
+## A good part of what goes in to a message only depends on the date and the place, not on the time of day:  the sun
+## times, the phase of the moon, the season, the r_yyyy calendar line, and the year-based macro lines.  These are kept
+## in a day_context that is attached to the coordinate (coordinate.day), and each one is worked out the first time
+## that it is asked for and then kept until the day or the place changes.  The last context made is shared by every
+## coordinate with the same key, so a fresh coordinate for the same day and place doesn't start over.
+##
+## The key is the local date, the GMT date, the place, and the timezone offset.  The sun times are worked out for the
+## GMT date (as they always have been), so the context is made again when either date rolls over -- at most twice a
+## day.  The calendar and macro fields are filled in by app_parser, which reads the r_yyyy files.
+
+@dataclass
+class day_context:
+    key:        tuple       = ()                            ## (local date, gmt date, lat, lon, tz_off)
+    season:     int         = None                          ## get_season()
+    sun:        list        = None                          ## [ sunrise, solar noon, sunset ] as local day fractions
+    polar:      int         = 0                             ## +1 if the sun doesn't set today, -1 if it doesn't rise
+    moon:       float       = None                          ## app_numeric.get_moon_phase()
+    cal:        object      = None                          ## r_yyyy row for the day (False if there isn't one)
+    macros:     str         = None                          ## year-based macro lines for the day, ';' delimited
+
+day_last = day_context()                                    ## the last context made
+
+def day_context_key (coord):
+    return ((coord.ltc.date(), coord.utc.date(), coord.lat, coord.lon, coord.tz_off))
+
+def get_day_context (coord):
+    global day_last
+    key = day_context_key(coord)
+    if ((coord.day is not None) and (coord.day.key == key)): return (coord.day)
+    if (day_last.key != key): day_last = day_context(key)   ## a new day (or place)
+    coord.day = day_last
+    return (coord.day)
+
+def day_season (coord):
+    ctx = get_day_context(coord)
+    if (ctx.season is None): ctx.season = get_season(coord)
+    return (ctx.season)
+
+## The sun times come from the NOAA tables in app_numeric (minutes after UTC midnight), shifted to local time and
+## wrapped in to a day fraction.  With no sunrise or sunset (polar day or night) those two are None and ctx.polar says
+## which it is.
+
+def day_sun (coord):
+    ctx = get_day_context(coord)
+    if (ctx.sun is None):
+        ev  = app_numeric.sun_day(coord.lat, coord.lon, coord.utc)
+        off = (int(coord.tz_off / 100) * 60) + (int(math.copysign(abs(coord.tz_off) % 100, coord.tz_off)))
+        ctx.polar = int(ev['polar'])
+        ctx.sun   = [ (((float(ev[f]) + off) / 1440.0) % 1.0) for f in ('rise', 'noon', 'set') ]
+        if (ctx.polar != 0): ctx.sun[0] = ctx.sun[2] = None
+    return (ctx.sun)
+
+def day_moon (coord):
+    ctx = get_day_context(coord)
+    if (ctx.moon is None): ctx.moon = app_numeric.get_moon_phase(coord.lat, coord.lon, coord.ltc)
+    return (ctx.moon)
+
+
+## ------------------------------------------------------------------------------------------------- GPS TARGETS
+## Every <G= item in the resource files is a fixed place, so the heading and distance to all of them can be worked out
+## together, in one numpy pass, and kept until the clock moves.  The targets are collected from the files the first
+## time they are needed.  The table is worked out again when the position has moved k_GPS_MOVE_KM or more from where it
+## was last worked out (any move at all shows up as a new position, but headings and whole-number distances to places
+## at least 25 km away barely change over a kilometer).  An item that isn't in the files gets None, and is worked out
+## on its own.
+
+k_GPS_MOVE_KM   = 1                                         ## how far the clock can move before the table is redone
+k_GPS_SOURCES   = [ app_files.file_any, app_files.file_brc, app_files.file_cond, app_files.file_macro, app_files.file_time ]
+k_gps_re        = re.compile(rb"<G=[+-][0-9]{5},[+-][0-9]{6}")
+
+def gps_target (item):
+    la = float(item[4:6]) + (float(item[6:9]) / 1000.0)                 ## fetch target (lat, lon)
+    if (item[3] == '-'): la = -1 * la
+    lo = float(item[11:14]) + (float(item[14:]) / 1000.0)
+    if (item[10] == '-'): lo = -1 * lo
+    return ((la, lo))
+
+class GpsTargets:
+
+    def __init__ (self, sources = k_GPS_SOURCES):
+        self.sources  = sources
+        self.index    = None                                ## item -> row of the arrays below
+        self.lat      = None                                ## target latitudes
+        self.lon      = None                                ## target longitudes
+        self.pos      = None                                ## (lat, lon) that the table was worked out from
+        self.heading  = None                                ## rhumb-line heading to each target (whole degrees)
+        self.distance = None                                ## rhumb-line distance to each target (whole km)
+        self.updates  = 0                                   ## number of times the table was worked out
+
+
+    ## Collect the targets from the resource files (scanning the store's mappings of them).
+
+    def load (self):
+        items = {}
+        for fname in self.sources:
+            try:
+                data = app_files.store.map(fname)
+            except OSError:
+                continue
+            for m in k_gps_re.finditer(data):
+                items.setdefault(m.group().decode('ascii'), len(items))
+        pos = numpy.array([ gps_target(s) for s in items ], dtype=numpy.float64).reshape(-1, 2)
+        self.index, self.lat, self.lon = items, pos[:, 0], pos[:, 1]
+        self.pos = None
+
+
+    ## Work out the whole table for a position.
+
+    def update (self, lat, lon):
+        self.heading  = app_numeric.gps_dir_deg_rhumb_many(lat, lon, self.lat, self.lon)
+        self.distance = app_numeric.gps_dist_km_rhumb_many(lat, lon, self.lat, self.lon)
+        self.pos      = (lat, lon)
+        self.updates  = self.updates + 1
+
+
+    ## (heading, distance) from the coordinate to the item's target, or None if the item isn't in the table.
+
+    def get (self, coord, item):
+        if (self.index is None): self.load()
+        i = self.index.get(item)
+        if (i is None): return (None)
+        if (self.pos != (coord.lat, coord.lon)):
+            if ((self.pos is None) or
+                (app_numeric.gps_dist_km_haversine(self.pos[0], self.pos[1], coord.lat, coord.lon) >= k_GPS_MOVE_KM)):
+                self.update(coord.lat, coord.lon)
+        return ((int(self.heading[i]), int(self.distance[i])))
+
+
+gps_targets = GpsTargets()                                  ## the one and only <G= target table for the app
     
 
 ## ------------------------------------------------------------------------------------------------- SUB-PROCESSORS
@@ -143,53 +307,92 @@ def get_season (c):
 def conditions (s, coord):
     if (s == ""): return ("")                       ## safety check
     if (s[0] != "!"):                               ## no conditions to check so automatically passes
-        try:
-            eos = s.index('~')                      ##      find the first eol character
-            s   = s[:(eos - 1)]                     ##      strip off all the tildes and return
-        except:
-            s   = s.strip()
-        return (s)
+        return (condition_strip(s))                 ##      strip off all the tildes and return
     eos  = s.index(' ')                             ## find the first space character
     rem  = s[(eos + 1):]
     s    = s[1:(eos + 1)]                           ## and get everything from after the '!' to before the ' '
-    sset = s.split(',')                             ## then split along the conditional delimiter
-    q    = 0
-    res  = True
-    for cond in sset:                               ## with each condition in the set...
-        if   (cond[0] == 'A'):  q = int(coord.lat * 1000)
-        elif (cond[0] == 'D'):  q = int(coord.ltc.strftime('%w')) + 1
-        elif (cond[0] == 'H'):  q = coord.utc.hour
-        elif (cond[0] == 'I'):  q = get_24_to_12h(coord.utc.hour)
-        elif (cond[0] == 'M'):  q = coord.ltc.month
-        elif (cond[0] == 'O'):  q = int(coord.lon * 1000)
-        elif (cond[0] == 'T'):  q = (coord.utc.hour * 100) + coord.utc.minute
-        elif (cond[0] == 'Y'):  q = coord.ltc.year
-        elif (cond[0] == 'Z'):  q = coord.tz
-        elif (cond[0] == 'd'):  q = coord.ltc.day
-        elif (cond[0] == 'h'):  q = coord.ltc.hour
-        elif (cond[0] == 'i'):  q = get_24_to_12h(coord.ltc.hour)
-        elif (cond[0] == 'm'):  q = coord.ltc.minute
-        elif (cond[0] == 's'):  q = coord.ltc.second
-        elif (cond[0] == 't'):  q = (coord.ltc.hour * 100) + coord.ltc.minute
-        elif (cond[0] == 'y'):  q = coord.ltc.timetuple().tm_yday
-        elif (cond[0] == 'z'):  q = get_season(coord)
-        else:                   return ("")
-        v = int(cond[2:])                                   ## get the target quantity
-        if   (cond[1] == '<'):  res = (res) and (q < v)     ## make the comparison specified
-        elif (cond[1] == '='):  res = (res) and (q == v)
-        elif (cond[1] == '>'):  res = (res) and (q > v)
-        else:                   return ("")
-    if (res):
-        try:
-            eos  = rem.index('~')                           ## find the first eol character
-            rem  = rem[:(eos - 1)]
-        except:
-            rem = rem.strip()
-        return (rem)
+    if (condition_test(s, coord)):
+        return (condition_strip(rem))
     else:
         return ""
 
 
+## Strip the end-of-line flags (everything from the character before the first tilde) or just the spaces.
+
+def condition_strip (s):
+    try:
+        eos = s.index('~')                          ## find the first eol character
+        s   = s[:(eos - 1)]
+    except:
+        s   = s.strip()
+    return (s)
+
+
+## Test a set of conditions (the part between the '!' and the first space).  True if every one of them passes.
+## The conditions are compiled once (per distinct set) in to a tuple of (field, lowest, highest) ranges, and the
+## quantities that they test are worked out once per coordinate, so the test itself is just a few integer compares.
+
+k_cond_fields   = "ADHIMOTYZdhimstyz"                   ## the condition fields, in feature vector order
+k_cond_inf      = float("inf")
+
+def condition_test (s, coord):
+    cset = condition_compile(s)
+    if (cset is None): return (False)                   ## an unknown field or operator never passes
+    f = condition_features(coord)
+    for (i, lo, hi) in cset:
+        if (not (lo <= f[i] <= hi)): return (False)
+    return (True)
+
+
+## Compile a set of conditions in to a tuple of (field index, lowest, highest) that the field must be in.  Returns
+## None if a field or operator is not recognized.  A badly formed target value raises, just as it always has.
+
+@functools.lru_cache(maxsize = 4096)
+def condition_compile (s):
+    cset = []
+    for cond in s.split(','):                           ## split along the conditional delimiter
+        i = k_cond_fields.find(cond[0])
+        if (i < 0): return (None)
+        v = int(cond[2:])                               ## get the target quantity
+        if   (cond[1] == '<'):  cset.append((i, -k_cond_inf, v - 1))
+        elif (cond[1] == '='):  cset.append((i, v, v))
+        elif (cond[1] == '>'):  cset.append((i, v + 1, k_cond_inf))
+        else:                   return (None)
+    return (tuple(cset))
+
+
+## Every quantity that a condition can test, as a tuple in k_cond_fields order.  The last one is kept, so every
+## line tested against the same coordinate (the same tick) shares it.
+
+cond_features = (None, None)                            ## (coordinate key, feature vector)
+
+def condition_features (coord):
+    global cond_features
+    key = (coord.ltc, coord.utc, coord.lat, coord.lon, coord.tz)
+    if (cond_features[0] == key): return (cond_features[1])
+    ltc = coord.ltc
+    utc = coord.utc
+    f   = ( int(coord.lat * 1000),                      ## A
+            int(ltc.strftime('%w')) + 1,                ## D
+            utc.hour,                                   ## H
+            get_24_to_12h(utc.hour),                    ## I
+            ltc.month,                                  ## M
+            int(coord.lon * 1000),                      ## O
+            (utc.hour * 100) + utc.minute,              ## T
+            ltc.year,                                   ## Y
+            coord.tz,                                   ## Z
+            ltc.day,                                    ## d
+            ltc.hour,                                   ## h
+            get_24_to_12h(ltc.hour),                    ## i
+            ltc.minute,                                 ## m
+            ltc.second,                                 ## s
+            (ltc.hour * 100) + ltc.minute,              ## t
+            ltc.timetuple().tm_yday,                    ## y
+            day_season(coord) )                         ## z
+    cond_features = (key, f)
+    return (f)
+
+
 ## Perform any year substitutions "(a-...), (b-...), (o-...)" in the working string.  Note that there cannot
 ## be ANY other use of parens in the data strings aside from year substitutions.  Search for regex [(][^abo][^-]
 ## to verify that none are found.
@@ -200,33 +403,42 @@ def sub_year (s, coord):
     ys    = re.findall(match, s)                        ## get the set of matching things
     
     if (len(ys) == 0): return (s)                       ## bail if none are found
-    cy    = coord.ltc.year
     for y in ys:                                        ## step through each one that is found
-        i = y.index(')')                                ## find the closing paren
-        n = int(y[3:i])                                 ## and extract the target year
-        ord = False
-        if (y[1] == 'a'):                               ## year is "AD" so find the difference
-            n = cy - n
-        elif (y[1] == 'b'):                             ## year is "BC" so find the sum (-1 because there's no year 0)
-            n = cy + n - 1
-        elif (y[1] == 'o'):                             ## year is "AD" and an ordinal
-            n = cy - n
-            ord = True
-        if (abs(n) < 2): return ("")                    ## return a nullstring if less than two years
-        b = app_strings.num_to_text(abs(n), ord)
-        if ((y[1] == 'a') or (y[1] == 'b')):            ## for a non-ordinal
-            r = app_numeric.arand(1, 1, 100)
-            if (n < 0):                                 ## determine before or after
-                if (r <= 50): a = " years before"
-                else:         a = " years until"
-            else:
-                if (r <= 50): a = " years after"
-                else:         a = " years since"
-            b = b + a
+        b = sub_year_text(y, coord)
+        if (b is None): return ("")                     ## return a nullstring if less than two years
         s = s.replace(y, b)
     return (s)
 
 
+## Return the text for a single year substitution y = "(a-nnnn)", "(b-nnnn)", or "(o-nnnn)", or None if it is less
+## than two years from the current (local) year.
+
+def sub_year_text (y, coord):
+    cy  = coord.ltc.year
+    i   = y.index(')')                                  ## find the closing paren
+    n   = int(y[3:i])                                   ## and extract the target year
+    ord = False
+    if (y[1] == 'a'):                                   ## year is "AD" so find the difference
+        n = cy - n
+    elif (y[1] == 'b'):                                 ## year is "BC" so find the sum (-1 because there's no year 0)
+        n = cy + n - 1
+    elif (y[1] == 'o'):                                 ## year is "AD" and an ordinal
+        n = cy - n
+        ord = True
+    if (abs(n) < 2): return (None)
+    b = app_strings.num_to_text(abs(n), ord)
+    if ((y[1] == 'a') or (y[1] == 'b')):                ## for a non-ordinal
+        r = app_numeric.arand(1, 1, 100)
+        if (n < 0):                                     ## determine before or after
+            if (r <= 50): a = " years before"
+            else:         a = " years until"
+        else:
+            if (r <= 50): a = " years after"
+            else:         a = " years since"
+        b = b + a
+    return (b)
+
+
 ## Perform any k_macro substitutions "_..." in the working string.  Data files cannot use an underscore for any reason
 ## except for macro substitutions. All macro substitutions are a single underscore followed by a single character, and
 ## that followed by a single space or valid delimiter (~, ;, |, /).  Strings for macro subsititution, indexed by their
@@ -260,16 +472,23 @@ k_macro_map = [ "_%",               "_&",                 "_*",               "_
                 "_u",               "_v",                 "_w",               "_x",               "_y",                 "_z",
                 "_{",               "_}"     ]
 
+## The macros are expanded in a single pass:  one regex finds every underscore and the character after it, and the
+## substitution comes out of a dict (anything that isn't a macro is put back as it was).  A valid string never has two
+## macros running in to each other and no macro expands to something with an underscore in it, so this gives exactly
+## the same result as replacing each entry of the macro map in turn.
+
+k_macro_dict    = dict(zip(k_macro_map, k_macro))       ## "_x" -> expansion
+k_macro_re      = re.compile("[_].", re.DOTALL)         ## any macro (or would-be macro)
+k_macro_invalid = re.compile("[_].[^ ;|~/]")            ## invalid use of the substitution characters
 
 def sub_macro (s):
     if (s == ""): return ("")                           ## safety check
-    invalid = "[_].[^ ;|~/]"                            ## check for invalid use of the substitution characters
-    bads    = re.findall(invalid, s)                    ## get the set of matching things
-    if (len(bads) > 0): return ("")                     ## kill it if there are invalid things found
-    l = len(k_macro_map)
-    for i in range(l):                                  ## step through the macro map and subsitute everything
-        s = s.replace(k_macro_map[i], k_macro[i])
-    return (s)
+    if ("_" not in s): return (s)                       ## nothing to do
+    if (k_macro_invalid.search(s)): return ("")         ## kill it if there are invalid things found
+    return (k_macro_re.sub(sub_macro_expand, s))        ## subsitute everything in one go
+
+def sub_macro_expand (m):
+    return (k_macro_dict.get(m.group(0), m.group(0)))
     
 
 ## Perform any number substitutions "#..." in the working string.  Data files cannot use the hash symbol for any other
@@ -412,13 +631,12 @@ k_directions = [ "north", "north by northeast", "northeast", "east by northeast"
 
 def sub_subproc_G (s, coord, item):
     if (s == ""): return ("")                                           ## safety check
-    la = float(item[4:6]) + (float(item[6:9]) / 1000.0)                 ## fetch target (lat, lon)
-    if (item[3] == '-'): la = -1 * la
-    lo = float(item[11:14]) + (float(item[14:]) / 1000.0)
-    if (item[10] == '-'): lo = -1 * lo
+    la, lo = gps_target(item)                                           ## fetch target (lat, lon)
     
-    heading  = app_numeric.gps_dir_deg_rhumb(coord.lat, coord.lon, la, lo)  ## compute distance and direction from target (lat, lon)
-    distance = app_numeric.gps_dist_km_rhumb(coord.lat, coord.lon, la, lo)
+    hd = gps_targets.get(coord, item)                                   ## distance and direction from the cached table
+    if (hd is None):                                                    ## or compute them for a target that isn't in it
+        hd = (app_numeric.gps_dir_deg_rhumb(coord.lat, coord.lon, la, lo), app_numeric.gps_dist_km_rhumb(coord.lat, coord.lon, la, lo))
+    heading, distance = hd
     if (distance < 25): return ("")                                         ## if too close to call, return null
     
     dir_idx = int(app_numeric.round_to_val(heading, 22.5) / 22.5)       ## convert direction to string
@@ -565,7 +783,7 @@ k_seasons = [ "spring", "summer", "autumn", "winter" ]
 
 def sub_subproc_S (s, coord, item):
     if (s == ""): return ("")                                           ## safety check
-    a = k_seasons[get_season(coord) - 1]                                ## fetch the season and add
+    a = k_seasons[day_season(coord) - 1]                                ## fetch the season and add
     s = s.replace(item, a)
     return (s)
 
@@ -601,23 +819,14 @@ def sub_subproc_Y (s, coord, item):
     return (s)
 
 
-## Process the name of the current timezone. Start/end string data is unused. Grabs the name of the timezone from
-## the all_rgn.txt file, taking the line corresponding to the timezone index and grabbing the name after the last
-## slash character and before the tilde character.  This makes use of the number string buffer, since we needed a
-## buffer and we weren't using that for anything else.  Example line is as follows:
-##      -12118,+096895;indian/the cocos islands ~~~~~~~ +06:30
-## Note that there may be TWO dividers, as in the case:
-##      -28467,-065783;america/argentina/catamarca ~~~~ -03:00
-## Which means that we have to start from the tilde and work backward to find the last divider.
+## Process the name of the current timezone. Start/end string data is unused. The name is the city for the timezone
+## index, as kept in the region table (app_timezones.regions.city, the part of the name after the last divider).
 
 def sub_subproc_Z (s, coord, item):
     if (s == ""): return ("")                                           ## safety check
-    tz_ln = app_files.file_read_line(app_files.file_all_rgn, coord.tz, app_files.k_LEN_ALL_RG)
-    i = tz_ln.rfind('/')
-    if (i < 0): return ("")
-    j = tz_ln.index('~')
-    if (j < 0): return ("")
-    a = tz_ln[i+1:j-1]
+    if (not app_timezones.regions.is_region(coord.tz)): return ("")
+    a = app_timezones.regions.city[coord.tz]                            ## from the region table
+    if (a == ""): return ("")
     s = s.replace(item, a)
     return (s)
 
@@ -750,3 +959,317 @@ def sub_subproc_qq (s, coord, item):
     a, b = app_strings.choose_between(item[2:], '|')                    ## pick a random thing
     s = s.replace(item, a)
     return (s)
+
+
+## ------------------------------------------------------------------------------------------------- RENDER PLANS
+
+## A line is compiled, once, in to a render plan that holds everything about it that does not depend on the
+## coordinate:  the conditions (if any), the end-of-line strip, the macro and number substitutions (done right there
+## at compile time), and the positions of the year and computed substitutions.  What is left is a list of literal text
+## and numbered slots, plus the nodes that fill the slots in:
+##
+##      years       one node per year substitution, in the order that sub_year() works through them
+##      comps       one node per computed substitution, in the order that sub_computed() works through them
+##
+## Rendering evaluates the nodes in order and joins the text and slots together in a single pass.  Every node calls
+## the same code as the regex path, in the same order and the same number of times, so the random draws (and with a
+## seeded random source, the output) are the same as process_me_regex().  A node that is a repeat of an earlier one
+## is still evaluated (the regex path does that too) but its result is not used, because the earlier one already
+## replaced every copy of that text.  The exception is the <e kind, which draws once per copy.
+##
+## A computed node calls its sub-processor on just its own item with a marker on the end, func(item + "\0", ...),
+## so that a sub-processor that fails (returns "") can be told apart from one that substitutes an empty string.
+##
+## Lines where substitutions can interfere with each other (one computed item inside or at the start of another,
+## a computed item running in to a year substitution, an underscore right before a year) are not compiled, and go
+## through the regex path every time.  Plans are cached by line text in a bounded LRU cache.
+
+k_PLAN_CACHE    = 32768                                 ## number of compiled lines to keep (more than every line in the pack)
+k_PLAN_MARK     = 0xE000                                ## year slots are marked with private-use characters from here
+
+k_computed_fn   = { 'A': sub_subproc_A,  'B': sub_subproc_B,  'C': sub_subproc_C,  'D': sub_subproc_D,  'G': sub_subproc_G,
+                    'H': sub_subproc_Hh, 'M': sub_subproc_M,  'N': sub_subproc_N,  'O': sub_subproc_O,  'P': sub_subproc_P,
+                    'R': sub_subproc_Rr, 'S': sub_subproc_S,  'W': sub_subproc_W,  'Y': sub_subproc_Y,  'Z': sub_subproc_Z,
+                    'd': sub_subproc_d,  'e': sub_subproc_e,  'g': None,           'h': sub_subproc_Hh, 'i': sub_subproc_i,
+                    'm': sub_subproc_mn, 'n': sub_subproc_mn, 'p': sub_subproc_p,  'r': sub_subproc_Rr, 's': sub_subproc_s,
+                    't': sub_subproc_t,  'y': sub_subproc_y,  '?': sub_subproc_qq }
+
+@dataclass
+class markup_plan:
+    cond:       object      = None                      ## conditions to test (None = no conditions)
+    dead:       bool        = False                     ## true if the line is always empty once the years are done
+    years:      list        = None                      ## year nodes:     (item, slot)   (slot -1 = result unused)
+    comps:      list        = None                      ## computed nodes: (function, item, [ slots ])
+    parts:      list        = None                      ## literal text (str) and slot numbers (int), in order
+    slots:      int         = 0                         ## number of slots
+
+
+## Compile a line in to a render plan.  Returns None if the line has to go through the regex path.
+
+@functools.lru_cache(maxsize = k_PLAN_CACHE)
+def plan_compile (s):
+    try:
+        return (plan_build(s))
+    except Exception:
+        return (None)                                   ## anything odd -- let the regex path deal with it
+
+def plan_build (s):
+    plan = markup_plan(years = [], comps = [], parts = [])
+    if (s == ""):
+        plan.dead = True
+        return (plan)
+    if (s[0] == "!"):                                   ## split off the conditions, exactly like conditions()
+        eos       = s.index(' ')
+        plan.cond = s[1:(eos + 1)]
+        s         = s[(eos + 1):]
+    s = condition_strip(s)
+    if (s == ""):
+        plan.dead = True
+        return (plan)
+
+    ## years -- each different year item gets a slot, marked in the text by a private-use character
+
+    ymark = {}
+    for y in re.findall("[(][abo][-][0-9]+[)]", s):
+        if (y in ymark):
+            plan.years.append((y, -1))
+        else:
+            ymark[y] = chr(k_PLAN_MARK + plan.slots)
+            plan.years.append((y, plan.slots))
+            plan.slots = plan.slots + 1
+    for y in ymark:
+        if (("_" + y) in s): return (None)              ## the macro check would see this differently
+        s = s.replace(y, ymark[y])
+
+    ## macros and numbers don't depend on the coordinate, so do them now
+
+    s = sub_numeric(sub_macro(s))
+    if (s == ""):
+        plan.dead = True
+        return (plan)
+
+    ## computed substitutions -- each different item gets a slot (one per copy for <e)
+
+    subs  = re.findall("[<][ABCDGHMNOPRSWYZdeghimnprsty?][^ ~/]*", s)
+    uniq  = list(dict.fromkeys(subs))
+    for a in uniq:
+        if (any([ (ord(ch) >= k_PLAN_MARK) for ch in a ])): return (None)
+        for b in uniq:
+            if ((a != b) and (a in b)): return (None)   ## one item inside another -- order matters
+    spans = []
+    for a in ymark.values():
+        spans.extend([ (m.start(), m.end(), ord(a) - k_PLAN_MARK) for m in re.finditer(re.escape(a), s) ])
+    cslot = {}
+    for item in subs:
+        fn = k_computed_fn[item[1]]
+        if (item in cslot):                             ## a repeat:  evaluated, but already substituted
+            plan.comps.append((fn, item, ([] if (item[1] == 'e') else [ -1 ])))
+            continue
+        at   = [ m.start() for m in re.finditer(re.escape(item), s) ]
+        if (item[1] == 'e'):                            ## one draw for every copy
+            sl = list(range(plan.slots, plan.slots + len(at)))
+        else:
+            sl = [ plan.slots ] * len(at)
+        plan.slots  = plan.slots + len(set(sl))
+        cslot[item] = sl
+        plan.comps.append((fn, item, sorted(set(sl))))
+        spans.extend([ (at[k], at[k] + len(item), sl[k]) for k in range(len(at)) ])
+
+    spans.sort()
+    i = 0
+    for (a, b, slot) in spans:                          ## literal text and slots, in order
+        if (a < i): return (None)                       ## overlapping substitutions
+        if (a > i): plan.parts.append(s[i:a])
+        plan.parts.append(slot)
+        i = b
+    if (i < len(s)): plan.parts.append(s[i:])
+    return (plan)
+
+
+## Render a plan for a coordinate.
+
+def plan_render (plan, coord):
+    if ((plan.cond is not None) and (not condition_test(plan.cond, coord))): return ("")
+    vals = [ "" ] * plan.slots
+    for (y, slot) in plan.years:                        ## years first, just like the regex path
+        b = sub_year_text(y, coord)
+        if (b is None): return ("")
+        if (slot >= 0): vals[slot] = b
+    if (plan.dead): return ("")
+    for (fn, item, slots) in plan.comps:
+        if (fn is None): return ("")                    ## <g is not supported and empties the line
+        for slot in slots:
+            a = fn(item + "\0", coord, item)
+            if (a == ""): return ("")
+            if (slot >= 0): vals[slot] = a[:-1]
+    return ("".join([ (vals[p] if (type(p) is int) else p) for p in plan.parts ]))
+
+
+## ------------------------------------------------------------------------------------------------- TEST CODE
+
+## Benchmark the render plans against the regex path over every line of r_anys.txt, and check that they agree:  each
+## line is processed both ways from the same seed, so even the random substitutions must come out the same.
+
+def app_markup_bench_plans (reps = 3):
+    import app_files
+    import app_parser
+    nln   = app_files.file_get_lines(app_files.file_any, app_files.k_LEN_R_ANYS)
+    lines = app_files.file_read_lines(app_files.file_any, range(1, nln + 1), app_files.k_LEN_R_ANYS)
+    ltc   = datetime.datetime(2026, 8, 30, 21, 15, 0)
+    c     = app_parser.coordinate(ltc, ltc + datetime.timedelta(hours = 7), 40.786110, -119.204595, 452, -700)
+
+    bad = 0
+    for (k, s) in enumerate(lines):
+        old = app_numeric.seed_random(k)
+        try:                a = process_me_regex(s, c)
+        except Exception:   a = None
+        app_numeric.seed_random(k)
+        try:                b = process_me(s, c)
+        except Exception:   b = None
+        app_numeric.set_entropy_pool(old)
+        if (a != b):
+            bad = bad + 1
+            if (bad <= 5): print ("  mismatch: " + s.strip())
+    plan_compile.cache_clear()
+    fallback = len([ 1 for s in lines if (plan_compile(s) is None) ])
+    print ("%d lines, %d compiled, %d regex fallback, %d mismatches" % (len(lines), len(lines) - fallback, fallback, bad))
+
+    old = app_numeric.seed_random(1)
+    for (label, fn) in [ ("regex", process_me_regex), ("plan (warm)", process_me) ]:
+        t0 = time.perf_counter()
+        for r in range(reps):
+            for s in lines:
+                try:                fn(s, c)
+                except Exception:   pass
+        t1 = time.perf_counter()
+        print ("%-12s %7.2f us per line" % (label, (t1 - t0) * 1e6 / (reps * len(lines))))
+    plan_compile.cache_clear()
+    t0 = time.perf_counter()
+    for s in lines: plan_compile(s)
+    t1 = time.perf_counter()
+    print ("%-12s %7.2f us per line" % ("compile", (t1 - t0) * 1e6 / len(lines)))
+    app_numeric.set_entropy_pool(old)
+
+## app_markup_bench_plans()
+
+
+## Benchmark the single-pass macro expander against a replace for every entry in the macro map (the old way), over
+## every line of r_anys.txt and r_macr.txt, and check that the two agree byte for byte.
+
+def app_markup_bench_macro (reps = 5):
+    lines = []
+    for (fname, linelen) in [ (app_files.file_any, app_files.k_LEN_R_ANYS), (app_files.file_macro, app_files.k_LEN_R_MACR) ]:
+        nln   = app_files.file_get_lines(fname, linelen)
+        lines = lines + [ condition_strip(s) for s in app_files.file_read_lines(fname, range(1, nln + 1), linelen) ]
+
+    def sub_macro_each (s):
+        if (s == ""): return ("")
+        if (len(re.findall("[_].[^ ;|~/]", s)) > 0): return ("")
+        for i in range(len(k_macro_map)):
+            s = s.replace(k_macro_map[i], k_macro[i])
+        return (s)
+
+    bad = len([ 1 for s in lines if (sub_macro(s) != sub_macro_each(s)) ])
+    print ("%d lines, %d with macros, %d mismatches" % (len(lines), len([ 1 for s in lines if ("_" in s) ]), bad))
+    for (label, fn) in [ ("replace x74", sub_macro_each), ("single pass", sub_macro) ]:
+        t0 = time.perf_counter()
+        for r in range(reps):
+            for s in lines: fn(s)
+        t1 = time.perf_counter()
+        print ("%-12s %7.2f us per line" % (label, (t1 - t0) * 1e6 / (reps * len(lines))))
+
+## app_markup_bench_macro()
+
+
+## Benchmark the compiled conditions against parsing them on every test (the old way), over every conditional line
+## in r_anys.txt and r_cond.txt at a spread of times and places, and check that the two always agree.
+
+def app_markup_bench_cond (count = 200):
+    import app_parser
+    conds = []
+    for fname in [ app_files.file_any, app_files.file_cond ]:
+        nln = app_files.file_get_lines(fname, app_files.k_LEN_R_ANYS)
+        for s in app_files.file_read_lines(fname, range(1, nln + 1), app_files.k_LEN_R_ANYS):
+            if (s.startswith("!") and (" " in s)): conds.append(s[1:(s.index(' ') + 1)])
+
+    def condition_each (s, coord):
+        res = True
+        for cond in s.split(','):
+            if   (cond[0] == 'A'):  q = int(coord.lat * 1000)
+            elif (cond[0] == 'D'):  q = int(coord.ltc.strftime('%w')) + 1
+            elif (cond[0] == 'H'):  q = coord.utc.hour
+            elif (cond[0] == 'I'):  q = get_24_to_12h(coord.utc.hour)
+            elif (cond[0] == 'M'):  q = coord.ltc.month
+            elif (cond[0] == 'O'):  q = int(coord.lon * 1000)
+            elif (cond[0] == 'T'):  q = (coord.utc.hour * 100) + coord.utc.minute
+            elif (cond[0] == 'Y'):  q = coord.ltc.year
+            elif (cond[0] == 'Z'):  q = coord.tz
+            elif (cond[0] == 'd'):  q = coord.ltc.day
+            elif (cond[0] == 'h'):  q = coord.ltc.hour
+            elif (cond[0] == 'i'):  q = get_24_to_12h(coord.ltc.hour)
+            elif (cond[0] == 'm'):  q = coord.ltc.minute
+            elif (cond[0] == 's'):  q = coord.ltc.second
+            elif (cond[0] == 't'):  q = (coord.ltc.hour * 100) + coord.ltc.minute
+            elif (cond[0] == 'y'):  q = coord.ltc.timetuple().tm_yday
+            elif (cond[0] == 'z'):  q = get_season(coord)
+            else:                   return (False)
+            v = int(cond[2:])
+            if   (cond[1] == '<'):  res = (res) and (q < v)
+            elif (cond[1] == '='):  res = (res) and (q == v)
+            elif (cond[1] == '>'):  res = (res) and (q > v)
+            else:                   return (False)
+        return (res)
+
+    coords = []
+    for k in range(count):
+        ltc = datetime.datetime(2024, 1, 1) + datetime.timedelta(minutes = app_numeric.arand(3, 0, 3 * 525600))
+        lat = (app_numeric.arand(3, 0, 170000) - 85000) / 1000.0
+        lon = (app_numeric.arand(3, 0, 360000) - 180000) / 1000.0
+        coords.append(app_parser.coordinate(ltc, ltc + datetime.timedelta(hours = 7), lat, lon, app_numeric.arand(2, 1, 400), -700))
+
+    bad = 0
+    for c in coords:
+        bad = bad + len([ 1 for s in conds if (condition_test(s, c) != condition_each(s, c)) ])
+    print ("%d condition sets x %d coordinates, %d mismatches" % (len(conds), len(coords), bad))
+    for (label, fn) in [ ("parse each", condition_each), ("compiled", condition_test) ]:
+        t0 = time.perf_counter()
+        for c in coords:
+            for s in conds: fn(s, c)
+        t1 = time.perf_counter()
+        print ("%-12s %7.2f us per test" % (label, (t1 - t0) * 1e6 / (len(coords) * len(conds))))
+
+## app_markup_bench_cond()
+
+
+## Benchmark the <G= target table against working out each target on its own (the old way), from count random places
+## (each one a new position, so the table is worked out every time), and check that the two agree for every target.
+
+def app_markup_bench_gps (count = 50):
+    import app_parser
+    tab   = GpsTargets()
+    tab.load()
+    items = list(tab.index)
+    old   = app_numeric.seed_random(count)
+    spots = [ (app_numeric.randbelow(17001) / 100.0 - 85.0, app_numeric.randbelow(36001) / 100.0 - 180.0) for i in range(count) ]
+    app_numeric.set_entropy_pool(old)
+
+    def gps_each (coord, item):
+        la, lo = gps_target(item)
+        return ((app_numeric.gps_dir_deg_rhumb(coord.lat, coord.lon, la, lo), app_numeric.gps_dist_km_rhumb(coord.lat, coord.lon, la, lo)))
+
+    now = datetime.datetime(2025, 1, 1)
+    crd = [ app_parser.coordinate(now, now, la, lo, 0, 0) for (la, lo) in spots ]
+    bad = sum([ 1 for c in crd for s in items if (tab.get(c, s) != gps_each(c, s)) ])
+    print ("%d targets from %d places, %d mismatches" % (len(items), count, bad))
+    for (label, fn) in [ ("one by one", gps_each), ("table", tab.get) ]:
+        t0 = time.perf_counter()
+        for c in crd:
+            for s in items: fn(c, s)
+        t1 = time.perf_counter()
+        print ("%-12s %7.2f us per target" % (label, (t1 - t0) * 1e6 / (count * len(items))))
+    t0 = time.perf_counter()
+    for c in crd: tab.update(c.lat, c.lon)
+    t1 = time.perf_counter()
+    print ("%-12s %7.1f us per position (all targets)" % ("update", (t1 - t0) * 1e6 / count))
+
+## app_markup_bench_gps()
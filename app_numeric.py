@@ -1,44 +1,240 @@
 ##  Module:		    app_numeric
 ##  Description:    Computation module
-##  Contains:       arand               A better random number generator than the built-in one
+##  Contains:       lazy_import         A module that is only imported when it is first used
+##                  EntropyPool         Buffered random bytes from the operating system (for arand and cryptorand)
+##                  SeededPool          Buffered random bytes from a seeded generator (for reproducible runs)
+##                  seed_random         Switch all of the random functions to a seeded generator (or back)
+##                  SystemClock         The real clock ("now" from the operating system)
+##                  SimClock            A simulated clock that steps through time as fast as it is asked to
+##                  randbelow           Unbiased random integer in the range [0, k)
+##                  arand               A better random number generator than the built-in one
 ##                  cryptorand          A cryptographic random number generator
 ##                  get_julian_date     Return the julian date
 ##                  get_julian_time     Return the julian time
 ##                  is_leap_year        Return true if the specified year is a leap year
-##                  get_sun_times       Return the sun rise, solar noon, and sun set times
-##                  get_moon_phase      Return the current phase of the moon
+##                  get_sun_times       Return the sun rise, solar noon, and sun set times (with suntime, one at a time)
+##                  sun_events          Sunrise, noon, sunset, and civil twilight for arrays of dates and places (NOAA)
+##                  sun_year            A whole year of sun_events for one place (cached)
+##                  sun_day             One day of sun_events for one place (from the sun_year cache)
+##                  get_moon_phase      Return the current phase of the moon (from the lunation table)
+##                  get_moon_phase_ephem Return the current phase of the moon (searched for with ephem)
+##                  lunation_build      Generate the table of new moons used by get_moon_phase
 ##                  get_mars_time       Return the current martian coodinated time
 ##                  simple_project      A simple latitiude projection on to a map
 ##                  gps_dir_deg_*       Haversine or Rhumb-line computation of heading between points
 ##                  gps_dist_km_*       Haversine or Rhumb-line computation of distance between points
+##                  gps_*_many          The same four, from one point to a whole numpy array of points at once
 ##                  day_fraction        Convert input time to a day fractional (0.00 = midnight (am), 1.00 = 23:59)
 ##                  ltc_to_utc          Conversion between LTC and UTC times
 ##                  utc_to_ltc
 ##                  round_to_val        Round a float to another float based on the accuracy figure
+##                  round_to_val_many   Same as round_to_val, for a whole numpy array at once
 ##                  check_time_in_range Check that a time is within a specified time range
+##                  return_planet_ephem Which constellation a planet (or the moon) is in
+##                  PlanetSky           Constellations of the planets, cached by the hour, and yearly ingress tables
 
 import datetime
+import importlib
 import math
-import juliandate
-import suntime
-import ephem
-import numpy
 import os
+import threading
+import bisect
+import app_files
+
+
+## ------------------------------------------------------------------------------------------------- CLASS - LazyModule
+## Stand-in for a module that is imported the first time one of its attributes is used, instead of when this module
+## is.  Most ticks never need ephem (or the others), and on a small board importing them is a good part of the start-up
+## time.  If the caller's globals() are passed in, the stand-in replaces itself there with the real module once it has
+## been imported, so only the first use goes through it.
+
+class LazyModule:
+
+    def __init__ (self, name, scope = None, alias = None):
+        self.__dict__['lazy_name']  = name                  ## module to import
+        self.__dict__['lazy_scope'] = scope                 ## globals() to put the module in, once it's imported
+        self.__dict__['lazy_alias'] = alias or name         ## and the name to put it there under
+
+    def __getattr__ (self, attr):
+        mod = importlib.import_module(self.lazy_name)
+        if ((self.lazy_scope is not None) and (self.lazy_scope.get(self.lazy_alias) is self)):
+            self.lazy_scope[self.lazy_alias] = mod
+        return (getattr(mod, attr))
+
+def lazy_import (name, scope = None, alias = None):
+    return (LazyModule(name, scope, alias))
+
+juliandate = lazy_import("juliandate", globals())
+suntime    = lazy_import("suntime",    globals())
+ephem      = lazy_import("ephem",      globals())
+numpy      = lazy_import("numpy",      globals())
+
+
+## ------------------------------------------------------------------------------------------------- CLASS - EntropyPool
+## Random bytes from the operating system (os.urandom), read a block at a time and handed out from a buffer, so that
+## the random functions below make one system call per block instead of one (or more) per number.  The bytes are the
+## same ones os.urandom would have returned, just fetched ahead of time.  A pool size of zero reads exactly what is
+## asked for, every time (the same as calling os.urandom directly).
+##
+## EntropyPool is not thread-safe.  LockedEntropyPool is the same pool with a lock around it, for when random numbers
+## are drawn from more than one thread; install it with set_entropy_pool().
+
+class EntropyPool:
+
+    def __init__ (self, size = 4096):
+        self.size  = size                                   ## bytes to read at a time
+        self.buf   = b""                                    ## buffered bytes
+        self.pos   = 0                                      ## next unused byte in the buffer
+        self.reads = 0                                      ## number of os.urandom calls made (for benchmarking)
+
+    ## Return the next n random bytes, refilling the buffer first if there are not enough left in it.
+
+    def take (self, n):
+        if ((self.pos + n) > len(self.buf)):
+            self.buf   = self.buf[self.pos:] + self.fill(max(self.size, n - (len(self.buf) - self.pos)))
+            self.pos   = 0
+            self.reads = self.reads + 1
+        b        = self.buf[self.pos:(self.pos + n)]
+        self.pos = self.pos + n
+        return (b)
+
+    ## Where the bytes come from.
+
+    def fill (self, n):
+        return (os.urandom(n))
+
+
+class LockedEntropyPool (EntropyPool):
+
+    def __init__ (self, size = 4096):
+        EntropyPool.__init__(self, size)
+        self.lock = threading.Lock()
+
+    def take (self, n):
+        with self.lock:
+            return (EntropyPool.take(self, n))
+
+
+## ------------------------------------------------------------------------------------------------- CLASS - SeededPool
+## The same pool, but with its bytes made by a seeded PCG64 generator (numpy) instead of read from the operating system.
+## All of the randomness in the app comes through arand and cryptorand (and so through the pool), so with a seeded pool
+## installed the same seed gives the same sequence of messages for the same sequence of times, every time.  Only for
+## testing and benchmarking -- these bytes are not cryptographically random.
+
+class SeededPool (EntropyPool):
+
+    def __init__ (self, seed, size = 4096):
+        EntropyPool.__init__(self, size)
+        self.seed = seed
+        self.gen  = numpy.random.Generator(numpy.random.PCG64(seed))
+
+    def fill (self, n):
+        return (self.gen.bytes(n))
+
+
+k_SEED_ENV = "SUBTIME_SEED"                                 ## environment variable that selects a seeded run
+
+entropy = EntropyPool()                                     ## the pool that arand and cryptorand draw from
+
+## Replace the pool that arand and cryptorand draw from, returning the one that was in use.
+
+def set_entropy_pool (pool):
+    global entropy
+    old     = entropy
+    entropy = pool
+    return (old)
+
+## Switch the random functions to a seeded generator (an integer seed, or a string of one), or back to the operating
+## system's random bytes (seed = None).  Returns the pool that was in use.
+
+def seed_random (seed = None):
+    if (seed is None): return (set_entropy_pool(EntropyPool()))
+    return (set_entropy_pool(SeededPool(int(seed))))
+
+if (os.environ.get(k_SEED_ENV, "") != ""): seed_random(os.environ[k_SEED_ENV])
+
+
+## ------------------------------------------------------------------------------------------------- CLASS - SystemClock
+## Where "now" comes from.  Everything that needs the current time asks a clock for it: the functions below when no
+## time is passed in to them (through the app clock), and the app through the clock on its coordinate.  A clock has
+## two methods, now() for the local time (naive, like datetime.now()) and utcnow() for UTC (timezone aware).
+
+class SystemClock:
+
+    def now (self):
+        return (datetime.datetime.now())
+
+    def utcnow (self):
+        return (datetime.datetime.now(datetime.UTC))
+
+
+## ------------------------------------------------------------------------------------------------- CLASS - SimClock
+## A simulated clock.  It starts at a given UTC time and only moves when tick() is called, by a fixed step (default
+## five minutes), so a whole year of app behaviour can be run through as fast as the CPU allows.  Local time is UTC
+## plus tz_off (<+|->hhmm), which the caller keeps up to date across daylight saving changes.
+
+class SimClock:
+
+    def __init__ (self, start, tz_off = 0, step = datetime.timedelta(minutes = 5)):
+        if (start.tzinfo is None): start = start.replace(tzinfo = datetime.UTC)
+        self.utc    = start                                 ## current simulated time (UTC)
+        self.tz_off = tz_off                                ## offset to local time
+        self.step   = step                                  ## amount to move on each tick
+
+    def now (self):
+        return (utc_to_ltc(self.tz_off, self.utc).replace(tzinfo = None))
+
+    def utcnow (self):
+        return (self.utc)
+
+    def tick (self, n = 1):
+        self.utc = self.utc + (self.step * n)
+        return (self.utc)
+
+
+clock = SystemClock()                                       ## the app clock (the default "now" for everything)
+
+## Replace the app clock, returning the one that was in use.
+
+def set_clock (c):
+    global clock
+    old   = clock
+    clock = c
+    return (old)
 
 
 ## ------------------------------------------------------------------------------------------------- FUNCTIONS
 
-## A better random number generator than the one that comes with python
+## Return a random integer in the range [0, k), with every value equally likely.  Draws just enough bytes to cover
+## k - 1, masks off the bits above the highest one it needs, and tries again if the result is k or more -- which can
+## happen less than half of the time, so it takes fewer than two tries on average whatever k is.
+
+def randbelow (k):
+    if (k <= 0): raise ValueError("randbelow: empty range")
+    b    = (k - 1).bit_length()
+    mask = (1 << b) - 1
+    a    = k
+    while (a >= k):
+        a = int.from_bytes(entropy.take((b + 7) // 8), byteorder='big') & mask
+    return (a)
+
+
+## A better random number generator than the one that comes with python.  Returns a random integer from lo to hi
+## (inclusive) that fits in n bytes.  Every value in the range is equally likely, exactly as it was when this drew n
+## bytes at a time until one landed in the range, but the draw is done by randbelow() so that a small range no longer
+## means thousands of tries (arand(2, 1, 12) used to take 5461 of them on average).  A range with nothing in it, that
+## used to loop forever, raises a ValueError.
 
 def arand (n, lo, hi):
-    a = -1
-    while ((a < lo) or (a > hi)):
-        a = int.from_bytes(os.urandom(n), byteorder='big')
-    return (a)
+    lo = max(math.ceil(lo), 0)                              ## the values that n bytes can actually produce
+    hi = min(math.floor(hi), (1 << (8 * n)) - 1)
+    if (hi < lo): raise ValueError("arand: empty range")
+    return (lo + randbelow(hi - lo + 1))
 
 def cryptorand (n):
-    a = numpy.frombuffer(os.urandom(n*4), dtype=numpy.uint32) >> 5
-    b = numpy.frombuffer(os.urandom(n*4), dtype=numpy.uint32) >> 6
+    r = numpy.frombuffer(entropy.take(n*8), dtype=numpy.uint32)
+    a = r[:n] >> 5
+    b = r[n:] >> 6
     return (a * 67108864.0 + b) / 9007199254740992.0
     
 
@@ -54,13 +250,15 @@ def roll_dice (dice):
     
 
 ## Return the Julian date for a given date/time.  Date/time should be in UTC.  Default
-## value is "now".
+## value is "now" (from the app clock).
 
-def get_julian_date (dt = datetime.datetime.now(datetime.UTC)):
+def get_julian_date (dt = None):
+    if (dt is None): dt = clock.utcnow()
     jd = juliandate.from_gregorian(dt.year, dt.month, dt.day)
     return (jd)
     
-def get_julian_time (dt = datetime.datetime.now(datetime.UTC)):
+def get_julian_time (dt = None):
+    if (dt is None): dt = clock.utcnow()
     jt = juliandate.from_gregorian(dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
     return (jt)
 
@@ -76,7 +274,8 @@ def is_leap_year (year):
 ## UTC and the results are also in UTC.  Conversion must be done to local time for this
 ## to make any sense at all.
 
-def get_sun_times (lat, lon, dt = datetime.datetime.now(datetime.UTC)):
+def get_sun_times (lat, lon, dt = None):
+    if (dt is None): dt = clock.utcnow()
     sun = suntime.Sun(lat, lon)
     sr  = sun.get_sunrise_time(dt)
     ss  = sun.get_sunset_time(dt)
@@ -86,16 +285,152 @@ def get_sun_times (lat, lon, dt = datetime.datetime.now(datetime.UTC)):
     return ([sr, sn, ss])
 
 
+## The NOAA solar equations (the ones in the NOAA solar calculator spreadsheet), done with numpy for any number of
+## dates and places at once.  dates is anything that numpy can turn in to datetime64[D] (UTC dates); lat and lon are
+## in degrees and broadcast against the dates.  The result is an array of k_SUN_DTYPE with the event times in minutes
+## after UTC midnight of the date (so they can be negative, or more than 1440, for places far from Greenwich).  The sun
+## position is worked out once per date, at the place's solar noon, which is good to well under a minute.
+##
+## Instead of raising an exception (like suntime does), places where the sun doesn't rise or set are flagged in the
+## polar field (+1 = the sun is up all day, -1 = the sun is down all day) and get NaN for the rise and set times.  The
+## same goes for the civil twilight times, which are NaN when the sun never gets six degrees below the horizon (or
+## never comes up that far).  Solar noon is always there.
+
+k_SUN_DTYPE  = [ ('dawn', 'f8'), ('rise', 'f8'), ('noon', 'f8'), ('set', 'f8'), ('dusk', 'f8'), ('polar', 'i1') ]
+k_SUN_ZENITH = 90.833                                       ## zenith at sunrise/sunset (refraction plus the sun's radius)
+k_SUN_CIVIL  = 96.0                                         ## zenith at the start/end of civil twilight
+k_SUN_JD1970 = 2440587.5                                    ## julian date of 1970-01-01 00:00 UTC
+
+def sun_events (dates, lat, lon):
+    days = numpy.asarray(dates, dtype='datetime64[D]').astype(numpy.float64)
+    lat  = numpy.asarray(lat, dtype=numpy.float64)
+    lon  = numpy.asarray(lon, dtype=numpy.float64)
+    jc   = (days + k_SUN_JD1970 + 0.5 - (lon / 360.0) - 2451545.0) / 36525.0        ## julian century at solar noon
+
+    l0   = numpy.radians((280.46646 + jc * (36000.76983 + jc * 0.0003032)) % 360.0) ## geometric mean longitude
+    m    = numpy.radians(357.52911 + jc * (35999.05029 - jc * 0.0001537))           ## geometric mean anomaly
+    e    = 0.016708634 - jc * (0.000042037 + jc * 0.0000001267)                     ## eccentricity of earth's orbit
+    c    = (numpy.sin(m) * (1.914602 - jc * (0.004817 + jc * 0.000014)) +           ## equation of center
+            numpy.sin(2 * m) * (0.019993 - jc * 0.000101) + numpy.sin(3 * m) * 0.000289)
+    om   = numpy.radians(125.04 - jc * 1934.136)
+    lam  = numpy.radians(numpy.degrees(l0) + c - 0.00569 - 0.00478 * numpy.sin(om))  ## apparent longitude
+    eps  = numpy.radians(23.0 + (26.0 + ((21.448 - jc * (46.815 + jc * (0.00059 - jc * 0.001813)))) / 60.0) / 60.0 +
+                         0.00256 * numpy.cos(om))                                   ## corrected obliquity
+    dec  = numpy.arcsin(numpy.sin(eps) * numpy.sin(lam))                            ## declination
+    y    = numpy.tan(eps / 2) ** 2
+    eqt  = 4.0 * numpy.degrees(y * numpy.sin(2 * l0) - 2 * e * numpy.sin(m) +       ## equation of time (minutes)
+                               4 * e * y * numpy.sin(m) * numpy.cos(2 * l0) -
+                               0.5 * y * y * numpy.sin(4 * l0) - 1.25 * e * e * numpy.sin(2 * m))
+
+    phi  = numpy.radians(lat)
+    res  = numpy.empty(numpy.broadcast(jc, phi).shape, dtype=k_SUN_DTYPE)
+    res['noon'] = 720.0 - (4.0 * lon) - eqt
+    for (zen, a, b) in ((k_SUN_ZENITH, 'rise', 'set'), (k_SUN_CIVIL, 'dawn', 'dusk')):
+        cha = (numpy.cos(numpy.radians(zen)) / (numpy.cos(phi) * numpy.cos(dec))) - (numpy.tan(phi) * numpy.tan(dec))
+        ha  = 4.0 * numpy.degrees(numpy.arccos(numpy.clip(cha, -1.0, 1.0)))         ## half the day length (minutes)
+        ha  = numpy.where(numpy.abs(cha) > 1.0, numpy.nan, ha)
+        res[a] = res['noon'] - ha
+        res[b] = res['noon'] + ha
+        if (a == 'rise'): res['polar'] = numpy.where(cha > 1.0, -1, numpy.where(cha < -1.0, 1, 0))
+    return (res)
+
+
+## A whole (UTC) year of sun_events for one place, one row per day (row 0 = January 1st).  The last few are kept, so
+## that looking up one day at a time (sun_day) only does the work once a year, and a simulated run through the year
+## for a handful of places only does it once per place.
+
+k_SUN_CACHE = 16                                            ## number of (place, year) tables to keep
+
+sun_cache = {}                                              ## (lat, lon, year) -> sun_events for the year
+
+def sun_year (lat, lon, year):
+    key = (lat, lon, year)
+    tab = sun_cache.get(key)
+    if (tab is None):
+        if (len(sun_cache) >= k_SUN_CACHE): sun_cache.pop(next(iter(sun_cache)))   ## drop the oldest one
+        dates = numpy.arange(numpy.datetime64("%04d-01-01" % year), numpy.datetime64("%04d-01-01" % (year + 1)))
+        tab   = sun_cache[key] = sun_events(dates, lat, lon)
+    return (tab)
+
+def sun_day (lat, lon, dt = None):
+    if (dt is None): dt = clock.utcnow()
+    return (sun_year(lat, lon, dt.year)[dt.timetuple().tm_yday - 1])
+
+
 ## Return the phase of the moon for the given time and location.  Phase is returned as a
 ## floating point number (0.0 = new, 0.5 = full, 1.0 = new again).
 
-def get_moon_phase (lat, lon, dt = datetime.datetime.now()):
+def get_moon_phase_ephem (lat, lon, dt = None):
+    if (dt is None): dt = clock.now()
     d   = ephem.Date(datetime.date(dt.year, dt.month, dt.day))  ## fetch the ephemeris date
     nnm = ephem.next_new_moon(d)                                ## find the next new moon
     pnm = ephem.previous_new_moon(d)                            ## and the previous one
     lun = (d - pnm)/(nnm - pnm)                                 ## lunation is the ratio of the difference
     return (lun)
 
+
+## The same thing from a table of new moons (all_nm.bin): the two searches above become a bisect of the table, so the
+## answer comes back in a microsecond instead of a millisecond or so.  The phase only depends on the date, as above.
+## The table is a list of ephem dates (big-endian doubles, like the other binary data files) running from the new moon
+## before 2024 to the one after 2100; dates outside of that fall back to the ephem search.  The table positions agree
+## with the searched ones to within a few microseconds of time (the search stops at slightly different places
+## depending on where it starts), which is far below anything the phase is used for.
+
+k_LUN_YEARS = (2024, 2100)                                  ## years covered by the lunation table
+k_LUN_DTYPE = '>f8'                                         ## table entry: ephem date (days since 1899-12-31 12:00)
+k_LUN_EPOCH = datetime.date(1899, 12, 31).toordinal() + 0.5 ## the ordinal day of ephem's day zero
+
+lunations = None                                            ## new moon table (loaded on first use)
+
+def get_moon_phase (lat, lon, dt = None):
+    global lunations
+    if (dt is None): dt = clock.now()
+    if (lunations is None): lunations = lunation_load()
+    d   = datetime.date(dt.year, dt.month, dt.day).toordinal() - k_LUN_EPOCH   ## the same as ephem.Date(), without ephem
+    i   = bisect.bisect_right(lunations, d)
+    if ((i == 0) or (i == len(lunations))):
+        return (get_moon_phase_ephem(lat, lon, dt))             ## outside of the table
+    pnm = lunations[i - 1]
+    nnm = lunations[i]
+    return ((d - pnm) / (nnm - pnm))
+
+
+## Read the new moon table, or generate it if it is missing or damaged.  Returns a sorted list of floats.
+
+def lunation_load (fname = None):
+    if (fname is None): fname = app_files.file_lunations
+    try:
+        f = open(fname, 'rb')
+        data = f.read()
+        f.close()
+        tab = numpy.frombuffer(data, dtype=k_LUN_DTYPE)
+        if ((len(tab) > 1) and numpy.all(numpy.diff(tab) > 0)):
+            return (tab.tolist())
+    except (OSError, ValueError):
+        pass
+    return (lunation_build(fname).tolist())
+
+
+## Generate the new moon table with ephem, stepping from each new moon to the next.  It is written to fname (if that
+## can be done) and returned as an array either way.  The table never changes, so this only needs to be run if the
+## file goes missing (or the range in k_LUN_YEARS is changed).
+
+def lunation_build (fname = None):
+    if (fname is None): fname = app_files.file_lunations
+    end = ephem.Date(datetime.date(k_LUN_YEARS[1] + 1, 1, 1))
+    tab = [ ephem.previous_new_moon(ephem.Date(datetime.date(k_LUN_YEARS[0], 1, 1))) ]
+    while (tab[-1] < end):
+        tab.append(ephem.next_new_moon(tab[-1]))
+    tab = numpy.array(tab, dtype=k_LUN_DTYPE)
+    try:
+        f = open(fname + ".tmp", 'wb')                          ## write to a temporary file and swap it in
+        f.write(tab.tobytes())
+        f.close()
+        os.replace(fname + ".tmp", fname)
+    except OSError:
+        pass                                                    ## can't write it, so just use it from memory
+    return (tab)
+
     
 ## Return the current martian sol and optionally, time within that sol.  Computed based on 
 ## the terrestrial Julian date from the algorithm at: https://en.wikipedia.org/wiki/Timekeeping_on_Mars
@@ -104,7 +439,8 @@ def get_moon_phase (lat, lon, dt = datetime.datetime.now()):
 ## Should render as: sol 53008 martian standard time 3:22
 ## Data is returned as a tuple: [sol, hh, mm]
 
-def get_mars_time (dt = datetime.datetime.now(datetime.UTC)):
+def get_mars_time (dt = None):
+    if (dt is None): dt = clock.utcnow()
     jt = get_julian_time(dt)                        ## start with the julian date/time
     cc = 32.184 / 86400.0                           ## terrestrial time to UTC correction
     md = (jt + cc - 2405522.0025054) / 1.0274912517 ## martian date
@@ -201,10 +537,64 @@ def gps_dist_km_rhumb (lat1, lon1, lat2, lon2):
     return int(dist)
 
 
+## The same four computations from one point (lat1, lon1) to arrays of points (lat2, lon2), all in one pass.  Each
+## step is the same as in the scalar version (including the truncation to whole degrees and kilometers), so the results
+## match calling the scalar functions on each point in turn.  Returned as int64 arrays.
+
+def gps_dir_deg_haversine_many (lat1, lon1, lat2, lon2):
+    hapi  = math.pi / 180.0
+    lat1  = lat1 * hapi
+    lat2  = numpy.asarray(lat2, dtype=numpy.float64) * hapi
+    dlon  = (lon1 - numpy.asarray(lon2, dtype=numpy.float64)) * hapi
+    x     = math.cos(lat1) * numpy.sin(dlon)
+    y     = (numpy.cos(lat2) * math.sin(lat1)) - (numpy.sin(lat2) * math.cos(lat1) * numpy.cos(dlon))
+    b     = numpy.trunc(numpy.arctan2(x, y) / hapi).astype(numpy.int64)
+    return (numpy.where(b < 0, b + 360, b))
+
+def gps_rhumb_many (lat1, lon1, lat2, lon2):
+    lat_a = numpy.radians(numpy.asarray(lat2, dtype=numpy.float64))
+    lon_a = numpy.radians(numpy.asarray(lon2, dtype=numpy.float64))
+    lat_b = math.radians(lat1)
+    lon_b = math.radians(lon1)
+
+    a = numpy.tan((math.pi / 4) + (lat_a / 2))
+    a = numpy.where(a == 0, 0.01, a)
+    delta_psi    = numpy.log(simple_project(lat_b) / a)
+    delta_lambda = lon_b - lon_a
+    delta_lambda = numpy.where(numpy.abs(delta_lambda) > math.pi,
+                               numpy.where(delta_lambda > 0, -(2 * math.pi - delta_lambda), 2 * math.pi + delta_lambda),
+                               delta_lambda)
+    return (lat_a, lat_b, delta_psi, delta_lambda)
+
+def gps_dir_deg_rhumb_many (lat1, lon1, lat2, lon2):
+    lat_a, lat_b, delta_psi, delta_lambda = gps_rhumb_many(lat1, lon1, lat2, lon2)
+    return (numpy.trunc(numpy.degrees(numpy.arctan2(delta_lambda, delta_psi))).astype(numpy.int64))
+
+def gps_dist_km_haversine_many (lat1, lon1, lat2, lon2):
+    hapi  = math.pi / 180.0
+    lat2  = numpy.asarray(lat2, dtype=numpy.float64)
+    dLat  = ((lat2 - lat1) * hapi) / 2.00
+    dLon  = ((numpy.asarray(lon2, dtype=numpy.float64) - lon1) * hapi) / 2.00
+    lat1  = lat1 * hapi
+    lat2  = lat2 * hapi
+    a     = (numpy.sin(dLat) * numpy.sin(dLat)) + (numpy.sin(dLon) * numpy.sin(dLon) * math.cos(lat1) * numpy.cos(lat2))
+    c     = 2.00 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1.00 - a))
+    return (numpy.trunc(k_earth_radius * c).astype(numpy.int64))
+
+def gps_dist_km_rhumb_many (lat1, lon1, lat2, lon2):
+    lat_a, lat_b, delta_psi, delta_lambda = gps_rhumb_many(lat1, lon1, lat2, lon2)
+    delta_phi = lat_b - lat_a
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        q = numpy.where(numpy.abs(delta_psi) > 10e-12, delta_phi / delta_psi, numpy.cos(lat_a))
+    dist = numpy.sqrt(delta_phi * delta_phi + q * q * delta_lambda * delta_lambda) * k_earth_radius
+    return (numpy.trunc(dist).astype(numpy.int64))
+
+
 ## Convert the input time to a day fractional (0.00 = midnight (am), 1.00 = 23:59:59).  Conversely, format
 ## the day fractional as hh:mm 
 
-def day_fraction (t = datetime.datetime.now()):
+def day_fraction (t = None):
+    if (t is None): t = clock.now()
     d = float(t.hour) / 24.00
     d = d + ((float(t.minute) / 60) / 24)
     d = d + (((float(t.second) / 60) / 60) / 24)
@@ -224,7 +614,8 @@ def day_fraction_format (t):
 ## Functions for converting between LTC and UTC using the current timezone offset.  Offset is given
 ## as an integer in the form: <+|->hhmm.  Example: PDT = utc_to_ltc(-700, UTC)
     
-def ltc_to_utc (offset, ltc = datetime.datetime.now()):
+def ltc_to_utc (offset, ltc = None):
+    if (ltc is None): ltc = clock.now()
     hh = int(offset / 100)
     mm = int(abs(offset) % 100)
     if (offset < 0):
@@ -232,7 +623,8 @@ def ltc_to_utc (offset, ltc = datetime.datetime.now()):
     utc = ltc - datetime.timedelta(hours=hh, minutes=mm)
     return (utc)
     
-def utc_to_ltc (offset, utc = datetime.datetime.now(datetime.UTC)):
+def utc_to_ltc (offset, utc = None):
+    if (utc is None): utc = clock.utcnow()
     hh = int(offset / 100)
     mm = int(abs(offset) % 100)
     if (offset < 0):
@@ -248,6 +640,13 @@ def round_to_val (x, b = 0.05, y = 2):
     return (round(b * round(x / b), y))
 
 
+## The same rounding applied to every element of an array.  numpy rounds halves to even, just like round() does, so
+## the results are identical to calling round_to_val() on each element in turn.
+
+def round_to_val_many (x, b = 0.05, y = 2):
+    return (numpy.round(b * numpy.round(numpy.asarray(x, dtype=numpy.float64) / b), y))
+
+
 ## Check that the datetime stamp is inside the bounding box defined by the initial datetime
 ## and the final datetime - return true if it is. This is its own function (rather than one
 ## included in python) because we want to ignore any embedded timezone information and just
@@ -266,19 +665,235 @@ def check_time_in_range (dt, dti, dtf):
 
 planet_list = [ "null", "mercury", "venus", "the moon", "mars", "jupiter", "saturn", "uranus", "neptune", "pluto" ]
 
+planet_body = [ None, "Mercury", "Venus", "Moon", "Mars", "Jupiter", "Saturn", "Uranus", "Neptune", "Pluto" ]   ## ephem body classes
+
 def return_planet_ephem (dt, planet_id):
     if   (planet_id < 0):   planet_id = arand(1, 1, 10)     ## return a random planet
-    if   (planet_id == 1):  p = ephem.Mercury(dt)           ## create an ephemeris object for the planet
-    elif (planet_id == 2):  p = ephem.Venus(dt)
-    elif (planet_id == 3):  p = ephem.Moon(dt)
-    elif (planet_id == 4):  p = ephem.Mars(dt)
-    elif (planet_id == 5):  p = ephem.Jupiter(dt)
-    elif (planet_id == 6):  p = ephem.Saturn(dt)
-    elif (planet_id == 7):  p = ephem.Uranus(dt)
-    elif (planet_id == 8):  p = ephem.Neptune(dt)
-    elif (planet_id == 9):  p = ephem.Pluto(dt)
-    else:                   return ""
-    
-    c = ephem.constellation(p)
-    return ( planet_list[planet_id] + " is in the constellation of " + c[1].lower() )
-    
+    if ((planet_id < 1) or (planet_id > 9)): return ""
+    c = planet_sky.hourly(dt)[planet_id]                    ## the constellation, as of the top of the hour
+    return ( planet_list[planet_id] + " is in the constellation of " + c.lower() )
+
+
+## ------------------------------------------------------------------------------------------------- CLASS - PlanetSky
+## The constellation that each of the nine bodies in planet_list is in.  at() works them all out for any time, and
+## hourly() keeps the answer for the current hour (the moon, the fastest of them, takes a couple of days to cross a
+## constellation, so an hour is close enough for a message).  ingress() makes a table for a whole (UTC) year of when
+## each body moves in to a new constellation, for looking positions up at any time without ephem, and for tools that
+## generate the h_yyyy event files.  The ingress times are found by stepping through the year (every two hours for the
+## moon, every day for the rest) and then halving the step until it is down to a minute.  A body that pops in and out
+## of a constellation between two steps is missed, which doesn't happen with these step sizes.
+##
+## The caches are shared between threads, so they are only changed with the lock held.
+
+k_SKY_STEP   = [ 0, 1.0, 1.0, 1.0 / 12, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0 ]     ## ingress search step (days) by planet
+k_SKY_ACC    = 1.0 / 1440                                                   ## ingress time accuracy (days)
+k_SKY_YEARS  = 2                                                            ## number of ingress tables to keep
+
+class PlanetSky:
+
+    def __init__ (self):
+        self.hour    = None                                 ## the hour that names is for
+        self.names   = None                                 ## constellation names for that hour, by planet id
+        self.tables  = {}                                   ## year -> ingress table
+        self.lock    = threading.Lock()
+
+
+    ## The constellation of every body at time dt, as a list indexed by planet id (entry zero is empty).
+
+    def at (self, dt):
+        d = ephem.Date(dt)
+        return ([ "" ] + [ ephem.constellation(getattr(ephem, planet_body[i])(d))[1] for i in range(1, 10) ])
+
+
+    ## The same thing for the hour that dt is in, worked out once per hour.
+
+    def hourly (self, dt):
+        h = dt.replace(minute=0, second=0, microsecond=0)
+        with self.lock:
+            if (self.hour != h):
+                self.names = self.at(h)
+                self.hour  = h
+            return (self.names)
+
+
+    ## The ingress table for a year:  a list (indexed by planet id) of [ (time, constellation), ... ] for each body,
+    ## starting with where it is at the start of the year.  The times are naive UTC datetimes.
+
+    def ingress (self, year):
+        with self.lock:
+            if (year in self.tables): return (self.tables[year])
+        t0  = float(ephem.Date(datetime.date(year, 1, 1)))
+        t1  = float(ephem.Date(datetime.date(year + 1, 1, 1)))
+        tab = [ [] ]
+        for i in range(1, 10):
+            def where (t): return (ephem.constellation(getattr(ephem, planet_body[i])(ephem.Date(t)))[1])
+            t = t0
+            c = where(t)
+            res = [ (ephem.Date(t).datetime(), c) ]
+            while (t < t1):
+                tn = min(t + k_SKY_STEP[i], t1)
+                cn = where(tn)
+                if (cn != c):
+                    a, b = t, tn                            ## the ingress is somewhere in (a, b]
+                    while ((b - a) > k_SKY_ACC):
+                        m = (a + b) / 2
+                        if (where(m) == c): a = m
+                        else:               b = m
+                    res.append((ephem.Date(b).datetime(), cn))
+                t, c = tn, cn
+            tab.append(res)
+        with self.lock:
+            self.tables[year] = tab
+            for y in sorted(self.tables)[:-k_SKY_YEARS]:    ## keep just the latest few years
+                if (y != year): del self.tables[y]
+        return (tab)
+
+
+    ## The constellation of a body at (UTC) time dt, from the ingress table for its year.
+
+    def lookup (self, planet_id, dt):
+        dt  = dt.replace(tzinfo=None)
+        res = self.ingress(dt.year)[planet_id]
+        i   = bisect.bisect_right(res, (dt, "\uffff")) - 1
+        return (res[max(i, 0)][1])
+
+
+planet_sky = PlanetSky()                                    ## the one and only planet cache for the app
+
+
+## ------------------------------------------------------------------------------------------------- TEST CODE
+
+## Compare the old rejection loop with arand() on the worst-case ranges used by the app (small ranges drawn with two
+## bytes) and some ordinary ones: random bytes read (through an unbuffered pool, so one read per try) and time per call.
+
+def app_numeric_bench_arand (count = 2000):
+    def arand_reject (n, lo, hi):
+        a = -1
+        while ((a < lo) or (a > hi)):
+            a = int.from_bytes(entropy.take(n), byteorder='big')
+        return (a)
+
+    for (n, lo, hi) in [ (2, 1, 12), (2, 0, 20), (1, 1, 2), (1, 1, 100), (1, 1, 120), (2, 0, 999) ]:
+        res = []
+        for f in (arand_reject, arand):
+            pool = EntropyPool(0)
+            old  = set_entropy_pool(pool)
+            t0   = datetime.datetime.now()
+            for i in range(count): f(n, lo, hi)
+            t1   = datetime.datetime.now()
+            set_entropy_pool(old)
+            res.append((pool.reads / count, (t1 - t0).total_seconds() * 1e6 / count))
+        print ("arand(%d, %3d, %3d)   reject: %8.1f reads %9.1f us   randbelow: %5.2f reads %6.2f us" %
+               (n, lo, hi, res[0][0], res[0][1], res[1][0], res[1][1]))
+
+## app_numeric_bench_arand()
+
+
+## Compare get_moon_phase() with get_moon_phase_ephem() on every step_days'th day of the table's range: the largest
+## difference in phase, and the time per call for each.
+
+def app_numeric_check_lunations (step_days = 1):
+    dd = datetime.date(k_LUN_YEARS[0], 1, 1)
+    de = datetime.date(k_LUN_YEARS[1], 12, 31)
+    dates = []
+    while (dd <= de):
+        dates.append(dd)
+        dd = dd + datetime.timedelta(days=step_days)
+    get_moon_phase(0, 0, dates[0])                          ## load the table outside of the timing
+
+    t0  = datetime.datetime.now()
+    old = [ get_moon_phase_ephem(0, 0, d) for d in dates ]
+    t1  = datetime.datetime.now()
+    new = [ get_moon_phase(0, 0, d) for d in dates ]
+    t2  = datetime.datetime.now()
+
+    err = max(abs(a - b) for (a, b) in zip(old, new))
+    print ("lunations: %d dates   max phase difference %.3g   ephem: %.1f us   table: %.2f us" %
+           (len(dates), err, (t1 - t0).total_seconds() * 1e6 / len(dates), (t2 - t1).total_seconds() * 1e6 / len(dates)))
+
+## app_numeric_check_lunations()
+
+
+## Compare sun_events() with get_sun_times() (suntime) at count random places and dates between the polar circles
+## (suntime raises an exception past them): the largest and average difference in minutes for sunrise and sunset, and
+## how many of the polar days and nights each one finds over the whole globe.  Then the time per call for suntime, for
+## sun_events one place at a time, for a whole batch at once, and for sun_day out of the year cache.
+
+def app_numeric_check_sun (count = 2000):
+    old  = seed_random(count)
+    lats = [ (randbelow(13201) / 100.0) - 66.0 for i in range(count) ]
+    glat = [ (randbelow(18001) / 100.0) - 90.0 for i in range(count) ]
+    lons = [ (randbelow(36001) / 100.0) - 180.0 for i in range(count) ]
+    days = [ datetime.datetime(2024, 1, 1, 12) + datetime.timedelta(days=randbelow(365 * 76)) for i in range(count) ]
+    set_entropy_pool(old)
+
+    def minutes (t, d):
+        return ((t - datetime.datetime.combine(d.date(), datetime.time(tzinfo=t.tzinfo))).total_seconds() / 60.0)
+
+    ev  = sun_events([ d.date() for d in days ], lats, lons)
+    err = []
+    for i in range(count):
+        sr, sn, ss = get_sun_times(lats[i], lons[i], days[i])
+        for (t, f) in ((sr, 'rise'), (ss, 'set')):
+            e = (minutes(t, days[i]) - ev[f][i]) % 1440.0
+            err.append(min(e, 1440.0 - e))
+    print ("sun: %d places   rise/set difference from suntime: max %.2f min  mean %.2f min" %
+           (count, max(err), sum(err) / len(err)))
+
+    pol = [ 0, 0 ]
+    ev  = sun_events([ d.date() for d in days ], glat, lons)
+    for i in range(count):
+        try:
+            get_sun_times(glat[i], lons[i], days[i])
+        except suntime.SunTimeException:
+            pol[0] = pol[0] + 1
+    pol[1] = int(numpy.count_nonzero(ev['polar']))
+    print ("sun: %d places   polar days and nights   suntime: %d   sun_events: %d" % (count, pol[0], pol[1]))
+
+    t0 = datetime.datetime.now()
+    for i in range(count): get_sun_times(lats[i], lons[i], days[i])
+    t1 = datetime.datetime.now()
+    for i in range(count): sun_events(days[i].date(), lats[i], lons[i])
+    t2 = datetime.datetime.now()
+    sun_events([ d.date() for d in days ], lats, lons)
+    t3 = datetime.datetime.now()
+    sun_year(lats[0], lons[0], days[0].year)
+    t4 = datetime.datetime.now()
+    for i in range(count): sun_day(lats[0], lons[0], days[0])
+    t5 = datetime.datetime.now()
+    print ("sun: suntime %.1f us   sun_events one %.1f us  batch %.2f us   sun_year %.1f us   sun_day %.2f us" %
+           ((t1 - t0).total_seconds() * 1e6 / count, (t2 - t1).total_seconds() * 1e6 / count,
+            (t3 - t2).total_seconds() * 1e6 / count, (t4 - t3).total_seconds() * 1e6,
+            (t5 - t4).total_seconds() * 1e6 / count))
+
+## app_numeric_check_sun()
+
+
+## Compare the constellations from PlanetSky.hourly() and PlanetSky.lookup() with ephem at the exact time, for count
+## random times in one year, and the time per message for each (the ingress table is made before the timing starts).
+
+def app_numeric_check_sky (count = 2000, year = 2025):
+    old   = seed_random(count)
+    times = [ datetime.datetime(year, 1, 1) + datetime.timedelta(minutes=randbelow(525600)) for i in range(count) ]
+    ids   = [ randbelow(9) + 1 for i in range(count) ]
+    set_entropy_pool(old)
+
+    sky = PlanetSky()
+    t0  = datetime.datetime.now()
+    sky.ingress(year)
+    t1  = datetime.datetime.now()
+    exact  = [ ephem.constellation(getattr(ephem, planet_body[p])(t))[1] for (t, p) in zip(times, ids) ]
+    t2  = datetime.datetime.now()
+    hourly = [ sky.hourly(t)[p] for (t, p) in zip(times, ids) ]
+    t3  = datetime.datetime.now()
+    table  = [ sky.lookup(p, t) for (t, p) in zip(times, ids) ]
+    t4  = datetime.datetime.now()
+
+    print ("sky: %d times   ingress table for %d: %.2f s   differences from ephem   hourly: %d   table: %d" %
+           (count, year, (t1 - t0).total_seconds(), sum(a != b for (a, b) in zip(exact, hourly)),
+            sum(a != b for (a, b) in zip(exact, table))))
+    print ("sky: ephem %.1f us   hourly (new hour every time) %.1f us   table %.1f us" %
+           ((t2 - t1).total_seconds() * 1e6 / count, (t3 - t2).total_seconds() * 1e6 / count,
+            (t4 - t3).total_seconds() * 1e6 / count))
+
+## app_numeric_check_sky()
@@ -0,0 +1,385 @@
+##  Module:         app_pack
+##  Description:    Compiled binary content pack for the resource files.
+##  Contains:       pack_line           One pre-parsed line from the pack
+##                  pack_build          Compile the resource files in to the binary pack
+##                  ContentPack         Read-side access to the pack (rebuilt automatically when stale)
+##                  EligibleLines       Which lines of the pack have conditions that pass right now
+##
+## The human-editable, fixed-width resource files (r_anys.txt, r_brc.txt, r_cond.txt, r_macr.txt, r_time.txt) are
+## still the source of truth.  The pack is a derived file that holds the same lines with everything that the fetch
+## functions used to work out with regexes on every read (attribution, image tag, the end-of-line strip, conditional
+## flag and the kinds of markup on the line) already worked out.  It is stored next to the data files and is rebuilt
+## whenever the mtime, size, or hash of any source file no longer matches what was recorded in the pack.
+##
+## Pack layout (all integers big-endian, like the timezone files):
+##
+##      header      4s  magic ("STPK")
+##                  H   version
+##                  H   number of source files (n)
+##                  I   byte offset of the string heap
+##                  I   size of the string heap
+##      sources     n * [ 8s name | Q mtime (ns) | Q size | 20s sha1 | I first record | I record count ]
+##      records     one 14-byte record per line, in file order:
+##                  I   offset of the message text in the string heap
+##                  H   length of the message text
+##                  H   attribution id (0 = none)
+##                  3s  image tag (all zeros = none)
+##                  B   flags (bit 0 = line starts with ! conditions)
+##                  H   markup kinds present on the line (k_MK_* bitmask)
+##      heap        ascii message text for every record, stripped of the end-of-line tildes
+
+from dataclasses import dataclass
+import hashlib
+import os
+import re
+import struct
+
+import numpy
+
+import app_files
+import app_markup
+import app_numeric
+import app_strings
+
+
+## ------------------------------------------------------------------------------------------------- CONSTANT DEFINITIONS
+
+k_PACK_MAGIC    = b"STPK"
+k_PACK_VERSION  = 1
+k_PACK_HEAD     = ">4sHHII"                             ## header
+k_PACK_SRC      = ">8sQQ20sII"                          ## one source file entry
+k_PACK_REC      = ">IHH3sBH"                            ## one line record
+
+k_FL_COND       = 0x01                                  ## flag - line starts with a set of ! conditions
+
+k_MK_YEAR       = 0x01                                  ## markup - year substitution (a-nnnn), (b-nnnn), (o-nnnn)
+k_MK_MACRO      = 0x02                                  ## markup - macro substitution _x
+k_MK_NUMBER     = 0x04                                  ## markup - number substitution #nnnn
+k_MK_COMPUTED   = 0x08                                  ## markup - computed substitution <x...
+k_MK_CHOICE     = 0x10                                  ## markup - multiple choices separated by semicolons
+
+file_pack       = app_files.dir_data + "r_pack.bin"     ## file - compiled content pack (derived, not under source control)
+
+## Source files in the pack, by the same type designators used by Parser.fetch_res_based().
+
+k_pack_sources  = [ ( "any",  app_files.file_any,   app_files.k_LEN_R_ANYS ),
+                    ( "brc",  app_files.file_brc,   app_files.k_LEN_R_ANYS ),
+                    ( "con",  app_files.file_cond,  app_files.k_LEN_R_ANYS ),
+                    ( "macr", app_files.file_macro, app_files.k_LEN_R_MACR ),
+                    ( "time", app_files.file_time,  app_files.k_LEN_R_TIME ) ]
+
+
+## ------------------------------------------------------------------------------------------------- STRUCTURES
+
+@dataclass
+class pack_line:
+    text:       str     = ""                            ## message text with the end-of-line tildes stripped
+    attrib:     int     = 0                             ## reference id of the attribution (0 = none)
+    image:      str     = ""                            ## reference image tag ("" = none)
+    cond:       bool    = False                         ## true if the line starts with ! conditions
+    markup:     int     = 0                             ## markup kinds present on the line (k_MK_* bitmask)
+
+
+## ------------------------------------------------------------------------------------------------- FUNCTIONS
+
+## Strip the end-of-line flags from a line in exactly the same way that the fetch functions always have: drop
+## everything from the character before the first tilde, or just strip the spaces if there is no tilde.
+
+def pack_strip (s):
+    try:
+        eos = s.index('~')
+        s   = s[:(eos-1)]
+    except:
+        s   = s.strip()
+    return (s)
+
+
+## Work out the markup kinds that are present in a message.
+
+def pack_markup (s):
+    m = 0
+    if (re.search("[(][abo][-][0-9]+[)]", s)):                  m = m | k_MK_YEAR
+    if ('_' in s):                                              m = m | k_MK_MACRO
+    if (re.search("[#][0-9]", s)):                              m = m | k_MK_NUMBER
+    if (re.search("[<][ABCDGHMNOPRSWYZdeghimnprsty?]", s)):     m = m | k_MK_COMPUTED
+    if (';' in s):                                              m = m | k_MK_CHOICE
+    return (m)
+
+
+## Stat and hash a source file.  Returns the (mtime, size, sha1) triple that is recorded in the pack.
+
+def pack_source_sig (fname):
+    st = os.stat(fname)
+    f  = open(fname, 'rb')
+    h  = hashlib.sha1(f.read()).digest()
+    f.close()
+    return (st.st_mtime_ns, st.st_size, h)
+
+
+## Compile all of the source files in to a pack.  The pack is written to fname (if that can be done) and the pack
+## contents are returned as bytes either way, so that a read-only data directory still gets a working pack.
+
+def pack_build (fname = file_pack):
+    srcs = []
+    recs = []
+    heap = bytearray()
+    for (name, src, linelen) in k_pack_sources:
+        mtime, size, sha = pack_source_sig(src)
+        first = len(recs)
+        lines = app_files.file_read_lines(src, range(1, app_files.file_get_lines(src, linelen) + 1), linelen)
+        for s in lines:
+            ref = app_strings.get_reference_num(s)              ## the same regexes the fetch functions used to run
+            img = app_strings.get_reference_image(s)
+            txt = pack_strip(s)
+            flg = 0
+            if ((len(s) > 0) and (s[0] == '!')): flg = k_FL_COND
+            b   = txt.encode()
+            recs.append(struct.pack(k_PACK_REC, len(heap), len(b), ref, img.encode(), flg, pack_markup(txt)))
+            heap.extend(b)
+        srcs.append(struct.pack(k_PACK_SRC, name.encode(), mtime, size, sha, first, len(recs) - first))
+
+    hoff = struct.calcsize(k_PACK_HEAD) + (len(srcs) * struct.calcsize(k_PACK_SRC)) + (len(recs) * struct.calcsize(k_PACK_REC))
+    data = struct.pack(k_PACK_HEAD, k_PACK_MAGIC, k_PACK_VERSION, len(srcs), hoff, len(heap)) + b"".join(srcs) + b"".join(recs) + bytes(heap)
+
+    app_files.store.release(fname)                              ## drop any stale mapping of the old pack
+    try:
+        f = open(fname + ".tmp", 'wb')                          ## write to a temporary file and swap it in
+        f.write(data)
+        f.close()
+        os.replace(fname + ".tmp", fname)
+    except OSError:
+        pass                                                    ## can't write it, so just use it from memory
+    return (data)
+
+
+## ------------------------------------------------------------------------------------------------- CLASS - ContentPack
+## Read-side access to the pack.  The pack is checked against its source files the first time that it is used (and
+## whenever check() is called), rebuilt if it is stale, and then memory-mapped through the app resource store.
+
+class ContentPack:
+
+    def __init__ (self, fname = file_pack):
+        self.fname   = fname
+        self.data    = None                                     ## the pack (memory map or bytes)
+        self.files   = {}                                       ## type designator -> (first record, record count)
+        self.sigs    = {}                                       ## type designator -> (mtime, size, sha1) of the source
+        self.heap    = 0                                        ## offset of the string heap
+        self.rec_off = 0                                        ## offset of the first record
+        self.rec_len = struct.calcsize(k_PACK_REC)
+
+
+    ## Check that the pack on disk is current, rebuilding it if it is not.  The pack is current if it exists, has the
+    ## right version, and every source file still has the mtime, size, and hash that was recorded when it was built.
+
+    def check (self):
+        data = None
+        try:
+            data = app_files.store.map(self.fname)
+            if (not self.parse(data)):  data = None
+        except (OSError, struct.error):
+            data = None
+        if (data is not None):
+            for (name, src, linelen) in k_pack_sources:
+                if (self.sigs.get(name) != pack_source_sig(src)):
+                    data = None
+                    break
+        if (data is None):                                      ## missing, old, or stale -- rebuild
+            data = pack_build(self.fname)
+            self.parse(data)
+        self.data = data
+        return (self.data)
+
+
+    ## Read the header and source table of a pack.  Returns false if the pack is not one that we understand.
+
+    def parse (self, data):
+        hsz = struct.calcsize(k_PACK_HEAD)
+        ssz = struct.calcsize(k_PACK_SRC)
+        magic, ver, n, hoff, hlen = struct.unpack_from(k_PACK_HEAD, data, 0)
+        if ((magic != k_PACK_MAGIC) or (ver != k_PACK_VERSION)): return (False)
+        self.files = {}
+        self.sigs  = {}
+        for i in range(n):
+            name, mtime, size, sha, first, count = struct.unpack_from(k_PACK_SRC, data, hsz + (i * ssz))
+            name = name.rstrip(b"\0").decode()
+            self.files[name] = (first, count)
+            self.sigs[name]  = (mtime, size, sha)
+        self.rec_off = hsz + (n * ssz)
+        self.heap    = hoff
+        return (True)
+
+
+    ## Number of lines in the pack for the given type designator.
+
+    def count (self, name):
+        if (self.data is None): self.check()
+        return (self.files[name][1])
+
+
+    ## Return the (zero-based) ith line of the given type as a pack_line.
+
+    def line (self, name, i):
+        if (self.data is None): self.check()
+        first, count = self.files[name]
+        off, n, ref, img, flg, mk = struct.unpack_from(k_PACK_REC, self.data, self.rec_off + ((first + i) * self.rec_len))
+        a = self.heap + off
+        return (pack_line(self.data[a:(a + n)].decode(), ref, img.rstrip(b"\0").decode(), ((flg & k_FL_COND) != 0), mk))
+
+
+    ## Return a line of the given type chosen at random.  The random draw is the same one used by file_read_random_line.
+
+    def random_line (self, name):
+        r = app_numeric.arand(2, 0, (self.count(name) - 1))
+        return (self.line(name, r))
+
+
+pack = ContentPack()                                    ## the one and only content pack for the app
+
+
+## ------------------------------------------------------------------------------------------------- CLASS - EligibleLines
+## An index of the lines of a type in the pack whose conditions pass for a coordinate, so that a line can be drawn
+## straight from the ones that will show instead of drawing lines at random until one passes.
+##
+## The conditions of every conditional line are compiled in to two arrays, the lowest and highest value of each
+## condition field (one row per field that any line of the type tests, one column per line, +/- k_EL_ANY where the
+## line doesn't care), and the whole type is tested against the condition feature vector of the coordinate in one
+## go.  The result is kept until the feature vector changes (other than the seconds, which is tested separately for
+## the few lines that use it), so with the clock ticking it is worked out about once a minute.  Lines that can never
+## pass (a condition that isn't understood or can't be parsed) and "do not display" lines when on playa are never
+## eligible.
+##
+## pick() keeps the odds of the old way of doing things, which drew up to "tries" lines at random and took the first
+## that passed:  with a fraction p of the lines eligible, that finds one with a chance of 1 - (1 - p)^tries, and when
+## it does, each eligible line is equally likely.
+
+k_EL_SECOND     = app_markup.k_cond_fields.index('s')   ## the only condition field that changes within a minute
+k_EL_ANY        = 0x7FFFFFFF                            ## bound for a field that a line doesn't test (int32)
+
+class EligibleLines:
+
+    def __init__ (self, cpack):
+        self.pack    = cpack
+        self.types   = {}                               ## type designator -> compiled conditions (see build)
+        self.cache   = {}                               ## type designator -> (key, eligible line numbers)
+        self.counts  = {}                               ## type designator -> [ mask hits, mask misses, picks, misses ]
+
+
+    ## Compile the conditions of every line of a type.  Lines without conditions are always eligible, so those are
+    ## just kept as a list of line numbers (along with the same list less the "do not display" lines).
+
+    def build (self, name):
+        nf    = len(app_markup.k_cond_fields)
+        rows  = []                                              ## conditional lines:  line number
+        lo    = []                                              ##      lowest value of each field
+        hi    = []                                              ##      highest value of each field
+        nop   = []                                              ##      "do not display" on playa
+        free  = []                                              ## lines without conditions:  line number
+        fnop  = []                                              ##      "do not display" on playa
+        for i in range(self.pack.count(name)):
+            pl = self.pack.line(name, i)
+            if (not pl.cond):
+                free.append(i)
+                fnop.append(pl.image == 'nop')
+                continue
+            try:
+                cset = app_markup.condition_compile(pl.text[1:(pl.text.index(' ') + 1)])
+            except Exception:
+                cset = None                                     ## it would fail in process_me() anyway
+            if (cset is None): continue                         ## never eligible
+            a = [ -app_markup.k_cond_inf ] * nf
+            b = [  app_markup.k_cond_inf ] * nf
+            for (f, flo, fhi) in cset:                          ## more than one condition on a field narrows it
+                a[f] = max(a[f], flo)
+                b[f] = min(b[f], fhi)
+            rows.append(i)
+            lo.append(a)
+            hi.append(b)
+            nop.append(pl.image == 'nop')
+        rows  = numpy.array(rows, dtype=numpy.int64)
+        lo    = numpy.clip(numpy.array(lo, dtype=numpy.float64).reshape(-1, nf).T, -k_EL_ANY, k_EL_ANY).astype(numpy.int32)
+        hi    = numpy.clip(numpy.array(hi, dtype=numpy.float64).reshape(-1, nf).T, -k_EL_ANY, k_EL_ANY).astype(numpy.int32)
+        cols  = [ f for f in range(nf) if ((f != k_EL_SECOND) and ((lo[f] > -k_EL_ANY).any() or (hi[f] < k_EL_ANY).any())) ]
+        srows = numpy.flatnonzero((lo[k_EL_SECOND] > -k_EL_ANY) | (hi[k_EL_SECOND] < k_EL_ANY))
+        free  = numpy.array(free, dtype=numpy.int64)
+        fnop  = numpy.array(fnop, dtype=bool)
+        self.types[name]  = { "rows": rows, "nop": numpy.array(nop, dtype=bool), "cols": cols,
+                              "lo": numpy.ascontiguousarray(lo[cols]), "hi": numpy.ascontiguousarray(hi[cols]),
+                              "srows": srows, "slo": lo[k_EL_SECOND, srows], "shi": hi[k_EL_SECOND, srows],
+                              "free": free, "free_nop": free[~fnop] }
+        self.counts[name] = [ 0, 0, 0, 0 ]
+        return (self.types[name])
+
+
+    ## Return the (zero-based) line numbers of every line of a type that is eligible for the coordinate.
+
+    def lines (self, name, coord):
+        if (name not in self.types): self.build(name)
+        t   = self.types[name]
+        f   = app_markup.condition_features(coord)
+        key = f[:k_EL_SECOND] + f[(k_EL_SECOND + 1):]
+        hit = self.cache.get(name)
+        if ((hit is not None) and (hit[0] == key)):
+            self.counts[name][0] = self.counts[name][0] + 1
+            elig = hit[1]
+        else:
+            self.counts[name][1] = self.counts[name][1] + 1
+            fv   = numpy.clip(numpy.array([ f[c] for c in t["cols"] ], dtype=numpy.int64), -k_EL_ANY, k_EL_ANY)
+            fv   = fv.astype(numpy.int32).reshape(-1, 1)
+            ok   = ((t["lo"] <= fv) & (fv <= t["hi"])).all(axis=0)
+            if (coord.tz == 452):                               ## "do not display" on playa
+                elig = numpy.concatenate((t["free_nop"], t["rows"][ok & ~t["nop"]]))
+            else:
+                elig = numpy.concatenate((t["free"], t["rows"][ok]))
+            self.cache[name] = (key, elig)
+        if (len(t["srows"]) > 0):                               ## seconds, for the lines that test them
+            sec  = f[k_EL_SECOND]
+            fail = t["rows"][t["srows"][(t["slo"] > sec) | (t["shi"] < sec)]]
+            elig = elig[~numpy.isin(elig, fail)]
+        return (elig)
+
+
+    ## Draw an eligible line of a type at random, with the odds of drawing up to "tries" lines at random and taking the
+    ## first one that passes.  Returns the pack_line, or None if none would have been found.
+
+    def pick (self, name, coord, tries = 1):
+        elig = self.lines(name, coord)
+        n    = self.pack.count(name)
+        cnt  = self.counts[name]
+        cnt[2] = cnt[2] + 1
+        if (len(elig) == 0):
+            cnt[3] = cnt[3] + 1
+            return (None)
+        if (len(elig) < n):
+            q = 1.0 - ((1.0 - (len(elig) / n)) ** tries)        ## chance that one of the tries would have passed
+            if (app_numeric.arand(2, 0, 9999) >= (q * 10000)):
+                cnt[3] = cnt[3] + 1
+                return (None)
+        return (self.pack.line(name, int(elig[app_numeric.arand(3, 0, len(elig) - 1)])))
+
+
+    ## Statistics for a type:  lines in the type, conditional lines, lines eligible for the coordinate (if one is given,
+    ## otherwise for the last minute tested, or -1 if none has been), mask cache hits and misses, and picks made and
+    ## missed.
+
+    def stats (self, name, coord = None):
+        if (name not in self.types): self.build(name)
+        if (coord is not None): n = len(self.lines(name, coord))
+        else:                   n = len(self.cache[name][1]) if (name in self.cache) else -1
+        cnt = self.counts[name]
+        return ({ "lines":       self.pack.count(name),
+                  "conditional": self.pack.count(name) - len(self.types[name]["free"]),
+                  "eligible":    n,
+                  "mask_hits":   cnt[0],
+                  "mask_misses": cnt[1],
+                  "picks":       cnt[2],
+                  "missed":      cnt[3] })
+
+
+eligible = EligibleLines(pack)                          ## eligibility index over the content pack
+
+
+## ------------------------------------------------------------------------------------------------- BUILD STEP
+## Running this file directly forces a rebuild of the pack:  python app_pack.py
+
+if (__name__ == "__main__"):
+    pack_build()
@@ -1,18 +1,30 @@
 ##  Module:         app_parser
 ##  Description:    Primary parser interface
 ##  Contains        Class - Parser
+##                  Class - PriorityIndex   Interval index over the high-priority (h_yyyy) messages for a year
+##                  Class - YearCalendars   The r_yyyy files, parsed in to typed columns (cached by year)
+##                  day_calendar    r_yyyy row for the day, from the day context
+##                  day_macros      Year-based macro lines for the day, from the day context
+##                  coordinate_now  Set the times of a coordinate from its clock
 
 from dataclasses import dataclass
 from dateutil import relativedelta
 
+import bisect
 import datetime
 import math
 import re
+import threading
+import time
+
+import numpy
 
 import app_files
+import app_pack
 import app_strings
 import app_numeric
 import app_markup
+import app_timezones
 
 ## ------------------------------------------------------------------------------------------------- STRUCTURES
 
@@ -30,6 +42,279 @@ class coordinate:
     lon:        float       = 0.0                           ## current longitude
     tz:         int         = 0                             ## current timezone identifier
     tz_off:     int         = 0                             ## current timezone offset (lct = utc + off) in <+|->hhmm
+    clock:      object      = None                          ## clock for "now" (None = the app clock, app_numeric.clock)
+    day:        object      = None                          ## everything that only changes with the day (app_markup.get_day_context)
+
+@dataclass
+class priority_event:
+    line:       int         = 0                             ## line number in the h_yyyy file (file order is check order)
+    local:      bool        = False                         ## interval is in local time (otherwise GMT)
+    start:      int         = 0                             ## start of the interval (priority_key)
+    end:        int         = 0                             ## end of the interval (priority_key)
+    lat_lo:     float       = 0.0                           ## geobox
+    lat_hi:     float       = 0.0
+    lon_lo:     float       = 0.0
+    lon_hi:     float       = 0.0
+    message:    str         = ""                            ## message to show
+
+## Set the local and universal times of a coordinate to "now", from the coordinate's clock.
+
+def coordinate_now (coord):
+    clk       = coord.clock if (coord.clock is not None) else app_numeric.clock
+    coord.ltc = clk.now()
+    coord.utc = clk.utcnow()
+    return (coord)
+
+## ------------------------------------------------------------------------------------------------- CLASS - PriorityIndex
+## The high-priority messages for a year (see Parser.fetch_high_priority for the file format), parsed once in to an
+## interval index.  The GMT and the local intervals are kept apart, each sorted by the start of the interval, and
+## every interval is kept as priority_key(start) .. priority_key(end).  An interval that holds a time t starts no
+## earlier than t less the longest interval in the list, so finding the active ones is a bisect and a scan of just
+## the intervals that start in that window.  The index is reloaded whenever the (local) year changes.
+##
+## The active messages are then checked in file order, drawing the same random number for each one that the line by
+## line walk does, so the message picked (and the random numbers used) are exactly the same as walking the file.
+
+## Interval key for a date and time within a year.  It only has to sort the same way as the date and time, since every
+## date in an h_yyyy file is taken to be in the same year as the time being checked.
+
+def priority_key (month, day, hour, minute):
+    return ((month * 1000000) + (day * 10000) + (hour * 100) + minute)
+
+
+class PriorityIndex:
+
+    def __init__ (self):
+        self.year   = None                                  ## year that is loaded
+        self.events = []                                    ## every event, in file order
+        self.lists  = {}                                    ## local -> (events sorted by start, starts, longest)
+
+
+    ## Parse one line of an h_yyyy file, in exactly the same way as Parser.check_high_priority().
+
+    def parse (self, s, line):
+        a = re.findall(r'[-+]?[\d]+', s)                     ## extract all numbers as a string list
+        b = [int(i) for i in a]                             ## convert all of those to signed ints
+        k1 = priority_key(b[0], (b[1] * -1), int(b[2] / 100), (b[2] % 100))
+        k2 = priority_key(b[3], (b[4] * -1), int(b[5] / 100), (b[5] % 100))
+        lat1 = float(a[6]) + (float(a[7]) / 1000)           ## fetch the location box from the line
+        lon1 = float(a[8]) + (float(a[9]) / 1000)
+        lat2 = float(a[10]) + (float(a[11]) / 1000)
+        lon2 = float(a[12]) + (float(a[13]) / 1000)
+        return (priority_event(line, (s[0] == '['), min(k1, k2), max(k1, k2),
+                               min(lat1, lat2), max(lat1, lat2), min(lon1, lon2), max(lon1, lon2), (s[65:]).strip(' ~')))
+
+
+    ## Load the messages for a year.  Returns the number of messages.
+
+    def load (self, yy):
+        self.year   = yy
+        self.events = []
+        self.lists  = {}
+        if ((yy < 2024) or (yy > 2100)): return (0)                     ## year is out of range
+        fname = app_files.dir_h_year + "h_" + str(yy) + ".txt"
+        try:
+            lc = app_files.file_get_lines(fname, app_files.k_LEN_H_20xx)
+        except OSError:
+            lc = 0
+        for i in range(lc):
+            s = app_files.file_read_line(fname, i + 1, app_files.k_LEN_H_20xx)
+            try:
+                self.events.append(self.parse(s, i + 1))
+            except (IndexError, ValueError):
+                pass                                                    ## not a usable line
+        for local in (False, True):
+            ev = sorted([ e for e in self.events if (e.local == local) ], key=lambda e: e.start)
+            longest = max([ (e.end - e.start) for e in ev ], default=0)
+            self.lists[local] = (ev, [ e.start for e in ev ], longest)
+        return (len(self.events))
+
+
+    ## Every event whose interval holds the time (GMT or local as the event needs), in file order.
+
+    def active (self, coord):
+        if (coord.ltc.year != self.year): self.load(coord.ltc.year)     ## new year, new file
+        res = []
+        for (local, dt) in ((False, coord.utc), (True, coord.ltc)):
+            ev, starts, longest = self.lists.get(local, ([], [], 0))
+            t = priority_key(dt.month, dt.day, dt.hour, dt.minute)
+            i = bisect.bisect_left(starts, t - longest)                 ## the first interval that could hold t
+            j = bisect.bisect_right(starts, t)                          ## and the first that starts after it
+            res.extend([ e for e in ev[i:j] if (t <= e.end) ])
+        if (len(res) > 1): res.sort(key=lambda e: e.line)
+        return (res)
+
+
+    ## The high-priority message for the coordinate, or a nullstring if there isn't one.
+
+    def message (self, coord):
+        for e in self.active(coord):
+            r = app_numeric.arand(1, 1, 100)                            ## we only want to hit 15% of the time
+            if ((coord.lat >= e.lat_lo) and (coord.lat <= e.lat_hi) and
+                (coord.lon >= e.lon_lo) and (coord.lon <= e.lon_hi) and
+                (r <= 20)):
+                return (e.message)
+        return ("")
+
+
+high_priority = PriorityIndex()                             ## the one and only high-priority index for the app
+
+
+## ------------------------------------------------------------------------------------------------- CLASS - YearCalendars
+## The r_yyyy files (see Parser.fetch_algorithmic for the format), each read in one go as an array of fixed-width
+## records and converted in to typed columns:  one row per day of the year, with the calendar dates as integers and
+## the macro file line numbers as a list (padded out with zeros, with a count).  The columns are:
+##
+##      islam       (dd, mm, yyyy)                  Islamic (Kuwaiti) date
+##      china       (dd, mm, yyyy)                  Chinese date (months over 20 are leap months)
+##      china_sign  Y                               Chinese sexagenary year character
+##      hebrew      (dd, mm, yyyy)                  Hebrew date (months over 20 are in a 13-month year)
+##      mayan       (kk, ww, tt, KKK, bb)           Long count date
+##      indian      (dd, mm, yyyy)                  Indian national date
+##      coptic      (dd, mm, yyyy)                  Coptic date
+##      macro       [ aaa, bbb, ... ]               Lines of the macro file, nmacro of them
+##
+## Years are cached once read, and the next year is read ahead (on another thread) as soon as December comes around,
+## so the first fetch of the new year doesn't have to wait for it.  Only the years either side of the one in use are
+## kept.  A year without a file (or with one that can't be parsed) is cached as None.
+
+k_RY_MACROS     = 12                                        ## most macro file entries on a line (the field is 46 bytes)
+
+k_RY_RAW        = numpy.dtype([ ('isl_d', 'S2'), ('isl_m', 'S2'), ('isl_y', 'S4'), ('sep1', 'S1'),
+                                ('chn_d', 'S2'), ('chn_m', 'S2'), ('chn_y', 'S4'), ('chn_s', 'S1'), ('sep2', 'S1'),
+                                ('heb_d', 'S2'), ('heb_m', 'S2'), ('heb_y', 'S4'), ('sep3', 'S1'),
+                                ('may_k', 'S2'), ('may_w', 'S2'), ('may_t', 'S2'), ('may_K', 'S3'), ('may_b', 'S2'), ('sep4', 'S1'),
+                                ('ind_d', 'S2'), ('ind_m', 'S2'), ('ind_y', 'S4'), ('sep5', 'S1'),
+                                ('cop_d', 'S2'), ('cop_m', 'S2'), ('cop_y', 'S4'), ('sep6', 'S1'),
+                                ('macro', 'u1', 46), ('date', 'S6'), ('eol', 'S2') ])
+
+k_RY_DTYPE      = numpy.dtype([ ('islam', '<i4', 3), ('china', '<i4', 3), ('china_sign', 'U1'), ('hebrew', '<i4', 3),
+                                ('mayan', '<i4', 5), ('indian', '<i4', 3), ('coptic', '<i4', 3),
+                                ('macro', '<i4', k_RY_MACROS), ('nmacro', '<i4') ])
+
+k_RY_FIELDS     = { 'islam':  ('isl_d', 'isl_m', 'isl_y'),
+                    'china':  ('chn_d', 'chn_m', 'chn_y'),
+                    'hebrew': ('heb_d', 'heb_m', 'heb_y'),
+                    'mayan':  ('may_k', 'may_w', 'may_t', 'may_K', 'may_b'),
+                    'indian': ('ind_d', 'ind_m', 'ind_y'),
+                    'coptic': ('cop_d', 'cop_m', 'cop_y') }
+
+class YearCalendars:
+
+    def __init__ (self):
+        self.years   = {}                                   ## year -> typed array (or None)
+        self.pending = set()                                ## years being read ahead
+        self.lock    = threading.Lock()
+
+
+    ## Read and convert the file for a year.  Returns the typed array, or None.
+
+    def load (self, yy):
+        fname = app_files.dir_r_year + "r_" + str(yy) + ".txt"
+        try:
+            raw = numpy.frombuffer(app_files.store.map(fname), dtype=k_RY_RAW)
+            cal = numpy.zeros(len(raw), dtype=k_RY_DTYPE)
+            for (col, fields) in k_RY_FIELDS.items():
+                for (i, f) in enumerate(fields): cal[col][:, i] = raw[f].astype(numpy.int32)
+            cal['china_sign'] = raw['chn_s'].astype('U1')
+
+            ## the macro line numbers are three digits each, separated by semicolons:  "aaa;bbb;ccc ~~~"
+
+            m   = numpy.zeros((len(raw), k_RY_MACROS * 4), dtype=numpy.uint8)
+            m[:, :46] = raw['macro']
+            m   = m.reshape(len(raw), k_RY_MACROS, 4)[:, :, :3].astype(numpy.int32) - ord('0')
+            ok  = numpy.all((m >= 0) & (m <= 9), axis=2)
+            ok  = numpy.cumprod(ok, axis=1).astype(bool)        ## entries stop at the first one that isn't a number
+            cal['macro']  = numpy.where(ok, (m[:, :, 0] * 100) + (m[:, :, 1] * 10) + m[:, :, 2], 0)
+            cal['nmacro'] = numpy.count_nonzero(ok, axis=1)
+        except (OSError, ValueError):
+            cal = None
+        return (cal)
+
+
+    ## The typed array for a year, reading it if it isn't cached yet.
+
+    def get (self, yy):
+        with self.lock:
+            if (yy in self.years): return (self.years[yy])
+        cal = self.load(yy)
+        with self.lock:
+            self.years[yy] = cal
+            self.pending.discard(yy)
+            for y in [ y for y in self.years if (abs(y - yy) > 1) ]:    ## keep just the years either side
+                del self.years[y]
+        return (cal)
+
+
+    ## Read a year ahead, on another thread.
+
+    def prefetch (self, yy):
+        with self.lock:
+            if ((yy in self.years) or (yy in self.pending)): return
+            self.pending.add(yy)
+        threading.Thread(target=self.get, args=(yy,), daemon=True).start()
+
+
+    ## The row for a (local) date, or None if there isn't one.  Reads the next year ahead during December.
+
+    def day (self, dt):
+        if (dt.month == 12): self.prefetch(dt.year + 1)
+        cal = self.get(dt.year)
+        n   = dt.timetuple().tm_yday
+        if ((cal is None) or (n > len(cal))): return (None)
+        return (cal[n - 1])
+
+
+    ## The macro file line numbers for a row.
+
+    def macros (self, row):
+        return (row['macro'][:row['nmacro']].tolist())
+
+
+year_calendars = YearCalendars()                            ## the one and only r_yyyy cache for the app
+
+
+## The r_yyyy row for the (local) day of a coordinate, or None if there isn't one.  Kept in the day context.
+
+def day_calendar (coord):
+    ctx = app_markup.get_day_context(coord)
+    if (ctx.cal is None):
+        yy      = coord.ltc.year
+        cal     = year_calendars.day(coord.ltc) if ((yy > 2023) and (yy < 2100)) else None
+        ctx.cal = cal if (cal is not None) else False
+    return (ctx.cal if (ctx.cal is not False) else None)
+
+
+## The year-based messages for the day of a coordinate (see Parser.fetch_year_based), as one string with the options
+## separated by semicolons.  Kept in the day context.
+
+def day_macros (coord):
+    ctx = app_markup.get_day_context(coord)
+    if (ctx.macros is not None): return (ctx.macros)
+    s    = ""                                                       ## line placeholder
+    yy   = coord.ltc.year
+    lnum = coord.ltc.timetuple().tm_yday                            ## line number is the day of the year
+    cal  = day_calendar(coord)                                      ## the parsed r_year line for the day (if any)
+    if (cal is not None):
+        n    = year_calendars.macros(cal)                           ## the macro.txt file indicies
+    else:
+        if ((app_numeric.is_leap_year(yy) == False) and 
+            (coord.ltc.month >= 3)):                                ## if we're not a leap year and the month is march or later, we
+            lnum = lnum + 1                                         ## have to add 1 to the day since macro.txt assumes a leap year
+        n    = [ lnum ]                                             ## set the day of the year as the first line number
+
+    lines = app_files.file_read_lines(app_files.file_macro, n, app_files.k_LEN_R_MACR)     ## grab every line in the set n at once
+    for line in lines:                                              ## step through each entry in the macro.txt file
+        s = s + line                                                            ## add the jth line (in the set n)
+        try:                                                                                ## get rid of any eol flags (~)
+            eos  = s.index('~')
+            s    = s[:(eos-1)]
+        except:                                                                 ## or just strip trailing spaces if no eol
+            s    = s.strip()
+        s = s + ";"                                                             ## tack on a delimiter and get the next line
+    ctx.macros = s
+    return (s)
+
 
 ## ------------------------------------------------------------------------------------------------- CLASS - Parser
 
@@ -74,18 +359,9 @@ class Parser:
         self.rules_image_display(s)                     ## before going on, check for any image display rules
         s = app_markup.process_me(s, coord)             ## and fix the markups
         if (s == ""):                                   ## if we still don't have a message
-            i = 1
-            while ((s == "") and (i <= 5)):             ## try up to 5 times for a conditional message
-                s = self.fetch_res_based(coord, 'con')
-                self.rules_image_display(s)
-                s = app_markup.process_me(s, coord)
-                i = i + 1
-            if (s == ""):                               ## if none of the conditionals worked out
-                while ((s == "") and (i <= 25)):        ## try another 20 times for an any-time valid message
-                    s = self.fetch_res_based(coord, 'any')
-                    self.rules_image_display(s)
-                    s = app_markup.process_me(s, coord)
-                    i = i + 1
+            s = self.fetch_eligible_text(coord, 'con', 5)       ## a conditional message (with the odds of 5 random tries)
+        if (s == ""):
+            s = self.fetch_eligible_text(coord, 'any', 20)      ## otherwise an any-time valid message (odds of 20 tries)
         s = re.sub(' +', ' ', s)                        ## replace multiple spaces with single spaces if needed
         s = re.sub(r'[ ]*[/][ ]*', '/', s)              ## get rid of any oddly formatted line-breaks that may remain
         self.data.message = s
@@ -124,6 +400,12 @@ class Parser:
     ##          01234567890123456789012345678901234567890123456789012345678901234567890123456789012345678901234567890
     
     def fetch_high_priority (self, coord):
+        return (high_priority.message(coord))
+
+
+    ## The same, walking every line of the file (the way that it was done before the interval index).
+
+    def fetch_high_priority_walk (self, coord):
         yy = coord.ltc.year
         if ((yy < 2024) or (yy > 2100)): return ("")                    ## if year is out of range, return an error
         fname = app_files.dir_h_year + "h_" + str(yy) + ".txt"          ## generate the target file name from the year
@@ -189,21 +471,20 @@ class Parser:
         s = ""                                                          ## generic string placeholder
         yy = coord.ltc.year
         if ((yy < 2024) or (yy >= 2100)):  return ("")                  ## if year is out of range, return an error
-        fname = app_files.dir_r_year + "r_" + str(yy) + ".txt"          ## generate the target file name from the year
-        lnum = coord.ltc.timetuple().tm_yday                            ## line number is the day of the year
-        line = app_files.file_read_line(fname, lnum, app_files.k_LEN_R_20xx)
+        cal = day_calendar(coord)                                       ## the r_yyyy line for today, already parsed
         
         r = app_numeric.arand(1, 1, 22) ## roll the dice and...
+        if ((r >= 8) and (r <= 19) and (cal is None)): return ("")      ## no calendar dates without the r_yyyy file
         if (r == 1) or (r == 2):        s = self.message_algo_sun(coord)                    ## sunrise/sunset for the current date/time/place
         elif (r == 3) or (r == 4):      s = self.message_algo_moon(coord)                   ## the phase of the moon for the current date/time/place
         elif (r == 5):                  s = self.message_algo_julian(coord)                 ## julian date
         elif (r == 6) or (r == 7):      s = self.message_algo_zodiac(coord)                 ## zodiac information
-        elif (r == 8) or (r == 9):      s = self.message_algo_islam(coord, line[0:8])       ## islamic calendar date (look up table)
-        elif (r == 10) or (r == 11):    s = self.message_algo_china(coord, line[9:18])      ## chinese calendar date or zodiac information (look up table)
-        elif (r == 12) or (r == 13):    s = self.message_algo_hebrew(coord, line[19:27])    ## hebrew calendar date (look up table)
-        elif (r == 14) or (r == 15):    s = self.message_algo_mayan(coord, line[28:39])     ## mayan long-count calendar (look up table)
-        elif (r == 16) or (r == 17):    s = self.message_algo_indian(coord, line[40:48])    ## indian national calendar date (look up table)
-        elif (r == 18) or (r == 19):    s = self.message_algo_coptic(coord, line[49:57])    ## coptic calendar date (look up table)
+        elif (r == 8) or (r == 9):      s = self.message_algo_islam(coord, cal['islam'].tolist())       ## islamic calendar date (look up table)
+        elif (r == 10) or (r == 11):    s = self.message_algo_china(coord, cal['china'].tolist(), str(cal['china_sign']))  ## chinese calendar date or zodiac information
+        elif (r == 12) or (r == 13):    s = self.message_algo_hebrew(coord, cal['hebrew'].tolist())     ## hebrew calendar date (look up table)
+        elif (r == 14) or (r == 15):    s = self.message_algo_mayan(coord, cal['mayan'].tolist())       ## mayan long-count calendar (look up table)
+        elif (r == 16) or (r == 17):    s = self.message_algo_indian(coord, cal['indian'].tolist())     ## indian national calendar date (look up table)
+        elif (r == 18) or (r == 19):    s = self.message_algo_coptic(coord, cal['coptic'].tolist())     ## coptic calendar date (look up table)
         elif (r == 20):                 s = self.message_algo_mars(coord)                   ## martian calendar date or time
         elif (r == 21):                 s = self.message_algo_burn(coord)                   ## burning man event countdown time
         elif (r == 22):                 s = self.message_algo_extrasol(coord)               ## distance to an extra-solar object
@@ -215,36 +496,13 @@ class Parser:
     ## no failure in reading the file, then assemble the line based on the associated indicies in the macro
     ## table.  This only holds for year files that we have (year < 2100).   If we do not have the year file
     ## in question (or if its read failed), then read the day number line straight from the macro file.  If
-    ## even that fails, return null.
+    ## even that fails, return null.  The options for the day are put together once a day, by day_macros().
     ## r_20xx.txt:
     ##      Messages that are tied to a date for a specific year, all with equal probability.  Lines are
     ##      indexed by day of the year such that each file has 365 (or 366 for leap years) lines.
     
     def fetch_year_based (self, coord, thing = 0):
-        s    = ""                                                       ## line placeholder
-        yy   = coord.ltc.year
-        lnum = coord.ltc.timetuple().tm_yday                            ## line number is the day of the year
-        
-        if ((yy > 2023) and (yy < 2100)):                               ## if there is a r_year file for this year
-            fname = app_files.dir_r_year + "r_" + str(yy) + ".txt"                  ## generate the target file name from the year
-            line = app_files.file_read_line(fname, lnum, app_files.k_LEN_R_20xx)    ## read the line number
-            line = line[58:104].strip('~ ')                                         ## extract the macro.txt file indicies
-            n    = [int(i) for i in (line.split(';'))]                              ## change them to an integer list and append
-        else:
-            if ((app_numeric.is_leap_year(yy) == False) and 
-                (coord.ltc.month >= 3)):                                ## if we're not a leap year and the month is march or later, we
-                lnum = lnum + 1                                         ## have to add 1 to the day since macro.txt assumes a leap year
-            n    = [ lnum ]                                             ## set the day of the year as the first line number
-
-        for j in n:                                                     ## step through each entry in the macro.txt file
-            s = s + app_files.file_read_line(app_files.file_macro, j, app_files.k_LEN_R_MACR)   ## grab the jth line (in the set n)
-            try:                                                                                ## get rid of any eol flags (~)
-                eos  = s.index('~')
-                s    = s[:(eos-1)]
-            except:                                                                 ## or just strip trailing spaces if no eol
-                s    = s.strip()
-            s = s + ";"                                                             ## tack on a delimiter and get the next line
-        
+        s = day_macros(coord)                                           ## every option for the day (worked out once a day)
         if (thing == 1): return (s)                                     ## return every option on debug flag
         ii = ""
         s, ii = app_strings.choose_between(s, ';')                      ## fetch a random one
@@ -293,19 +551,45 @@ class Parser:
     ## Important note: Each of the aforementioned files must have no more than 65535 lines.
     
     def fetch_res_based (self, coord, type):
-        if   (type == 'brc'):   fname = app_files.file_brc              ## figure out which file to open or bail if invalid
-        elif (type == 'con'):   fname = app_files.file_cond
-        elif (type == 'any'):   fname = app_files.file_any
-        else:                   return ("")
-        s   = app_files.file_read_random_line(fname)                    ## grab a line at random
+        if (type not in ('brc', 'con', 'any')): return ("")             ## bail if the list type is invalid
+        pl  = app_pack.pack.random_line(type)                           ## grab a pre-parsed line at random from the pack
+        return (self.res_line(coord, type, pl))
+
+
+    ## The same, but drawn from just the lines whose conditions pass (see app_pack.EligibleLines), with the odds of
+    ## drawing up to "tries" lines at random until one passes.  Returns None if no line was found that way (as opposed
+    ## to "" for a line that can't be shown).
+
+    def fetch_eligible (self, coord, type, tries = 1):
+        if (type not in ('brc', 'con', 'any')): return (None)           ## bail if the list type is invalid
+        pl  = app_pack.eligible.pick(type, coord, tries)
+        if (pl is None): return (None)
+        return (self.res_line(coord, type, pl))
+
+
+    ## Draw an eligible line and do its markup.  A line whose markup comes up empty (a year substitution under two
+    ## years, say) is replaced by another draw, up to "tries" draws in all, just as the random tries used to do.  The
+    ## draw itself already has the odds of "tries" random tries, so a draw that finds nothing is not tried again.
+
+    def fetch_eligible_text (self, coord, type, tries):
+        s = ""
+        i = 1
+        while ((s == "") and (i <= tries)):
+            s = self.fetch_eligible(coord, type, tries)
+            if (s is None): return ("")                                 ## nothing eligible (with the odds of the tries)
+            self.rules_image_display(s)
+            s = app_markup.process_me(s, coord)
+            i = i + 1
+        return (s)
+
+
+    ## Set up the attribution and image for a line from the pack and return the line for markup.
+
+    def res_line (self, coord, type, pl):
+        s   = pl.text                                                   ## eol flags are already stripped in the pack
         if (s == ""): return ("")                                       ## return a null on read error
-        ref = app_strings.get_reference_num(s)                          ## find any reference numbers or reference images
-        img = app_strings.get_reference_image(s)
-        try:                                                            ## get rid of any eol flags
-            eos = s.index('~')
-            s   = s[:(eos-1)]
-        except:
-            s   = s.strip()
+        ref = pl.attrib                                                 ## reference numbers and reference images too
+        img = pl.image
         self.data.attrib = ref                                          ## save off the reference and image (if any)
         self.data.bg_img = img
         if ((coord.tz == 452) and (img == 'nop')): return ("")          ## check for "on playa" and "do not display"
@@ -334,16 +618,20 @@ class Parser:
     ## ------------------------------------------------------------------------------------------- algorithmic message generation
     
     ## Display the time around sunrise, solar noon, or sunset.  If thing == 1, return all times as a string for debugging.
+    ## Above the arctic (or antarctic) circle there may be no sunrise or sunset at all, which gets its own message.
     
     def message_algo_sun (self, coord, thing = 0):
-        st = app_numeric.get_sun_times(coord.lat, coord.lon, coord.utc) ## compute sunrise, sunset, and solar noon times
-        sr = app_numeric.day_fraction(app_numeric.utc_to_ltc(coord.tz_off, st[0]))
-        sn = app_numeric.day_fraction(app_numeric.utc_to_ltc(coord.tz_off, st[1]))
-        ss = app_numeric.day_fraction(app_numeric.utc_to_ltc(coord.tz_off, st[2]))
+        sr, sn, ss = app_markup.day_sun(coord)                          ## sunrise, solar noon, and sunset (worked out once a day)
         ct = app_numeric.day_fraction(coord.ltc)                        ## get the day fraction for the current time
         s  = ""                                                         ## string for assembly
         r = app_numeric.arand(1, 1, 100)
         
+        if (sr is None):                                                ## polar day or polar night
+            if (app_markup.get_day_context(coord).polar > 0):       s = "the midnight sun"
+            else:                                                   s = "polar night"
+            if (thing == 1): s = s + "\nsolar noon:    " + app_numeric.day_fraction_format(sn) + "\n"
+            return (s)
+        
         if (thing == 1):                                                ## debug string
             s =     "sunrise time:  " + app_numeric.day_fraction_format(sr) + "\n"
             s = s + "solar noon:    " + app_numeric.day_fraction_format(sn) + "\n"
@@ -381,7 +669,7 @@ class Parser:
     ## Display the phase of the moon.
     
     def message_algo_moon (self, coord):
-        a = app_numeric.get_moon_phase(coord.lat, coord.lon, coord.ltc)     ## fetch the phase of the moon
+        a = app_markup.day_moon(coord)                                      ## fetch the phase of the moon (worked out once a day)
         b = a * 29.53                                                       ## justify as a fraction of the total lunation in days
         s = "under a "                                                      ## init the string
         if   (b <  1.84):   s = s + "new"                                   ## add the phase information
@@ -535,16 +823,16 @@ class Parser:
     
     
     ## Return the current date in the system of the unified Islamic (Kuwati) calendar.  This information is in the r_yyyy.txt
-    ## file.  Islamic calendar information starts at byte zero and runs through byte 7 with the format: ddmmyyyy.
+    ## file.  Islamic calendar information starts at byte zero and runs through byte 7 with the format: ddmmyyyy.  The date
+    ## is passed in as the (dd, mm, yyyy) integers from the YearCalendars 'islam' column.
     
     k_islam_m = ["""al-muharram""",     """safar""",                """rabi al-'awwal""",  """rabi ath-thani""",
                  """jumada al-'ula""",  """jumada ath-thaniyah""",  """rajab""",           """sha'ban""",
                  """ramadan""",         """shawwal""",              """du al-qa'dah""",    """du al-hijjah""" ]
     
-    def message_algo_islam (self, coord, line, thing = 0):
-        dd = int(line[0:2])                                             ## fetch day, month, year
-        mm = int(line[2:4]) - 1
-        yy = int(line[4:])
+    def message_algo_islam (self, coord, date, thing = 0):
+        dd, mm, yy = date                                               ## fetch day, month, year
+        mm = mm - 1
         d  = "the " + app_strings.num_to_text(dd, True) + " day of"     ## convert to strings for each
         m  = "the month of " + self.k_islam_m[mm]
         y  = "in the " + app_strings.num_to_text(yy, True) + " year"
@@ -560,7 +848,8 @@ class Parser:
         
     
     ## Return the current date in the system of the Chinese national calendar.  This information is in the r_yyyy.txt
-    ## file.  Chinese calendar information starts at byte 9 and runs through byte 17 with the format: ddmmyyyyY.
+    ## file.  Chinese calendar information starts at byte 9 and runs through byte 17 with the format: ddmmyyyyY.  The date
+    ## is passed in as the (dd, mm, yyyy) integers from the 'china' column and the year character Y from 'china_sign'.
     ##
     ## Assembly of the sexagenary year in the part buffer from the year designation character.  Designation characters 
     ## are according to the following table:
@@ -605,13 +894,12 @@ class Parser:
                 14, 24, 35, 45, 51, 61, 72, 82, 93, 103, 114, 124, 
                 15, 25, 31, 41, 52, 62, 73, 83, 94, 104, 115, 125 ]
     
-    def message_algo_china (self, coord, line, thing = 0):
+    def message_algo_china (self, coord, date, sign, thing = 0):
         aY = "123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxy"     ## sexagenary year key to index
-        dd = int(line[0:2])                                                     ## fetch day, month, year
-        mm = int(line[2:4]) - 1
-        yy = int(line[4:8])
+        dd, mm, yy = date                                                       ## fetch day, month, year
+        mm = mm - 1
         try:
-            Y  = aY.index(line[8])                  ## fetch the sexagenary year and convert to element and animal
+            Y  = aY.index(sign)                     ## fetch the sexagenary year and convert to element and animal
         except:
             return ("")
         ni = self.k_ChinM[Y]                        ## go from the character index to the year matrix
@@ -655,14 +943,13 @@ class Parser:
     ## position 9 for the 7th month in a non-leap year or 8th month in a leap year.  
     ## So for a leap year, the month names are:  { 1,  2,  3,  4,  5,  -,  6,  7,  8,  9, 10, 11, 12, 13}
     ## For a non-leap year, the month names are: { 1,  2,  3,  4,  5,  6,  -,  -,  7,  8,  9, 10, 11, 12}
+    ## The date is passed in as the (dd, mm, yyyy) integers from the YearCalendars 'hebrew' column.
     
     k_HebM  = [ "tishrei",   "cheshvan", "kislev", "tevet", "shevat", "adar", "adar alef", 
                 "adar beit", "nissan",   "iyar",   "sivan", "tamuz",  "av",   "elul" ]
     
-    def message_algo_hebrew (self, coord, line, thing = 0):
-        dd = int(line[0:2])                                 ## fetch day, month, year
-        mm = int(line[2:4])
-        yy = int(line[4:])
+    def message_algo_hebrew (self, coord, date, thing = 0):
+        dd, mm, yy = date                                   ## fetch day, month, year
         if (mm > 20):                                       ## correct for leap months
             mm = mm - 21
             leap = True
@@ -693,13 +980,10 @@ class Parser:
     ##     tt  = tun       =    360 days
     ##     KKK = k'atun    =   7200 days
     ##     bb  = b'ak'tun  = 144000 days (the 13th b'ak'tun runs from 2012-12-21 to 2407-03-26)
+    ## The date is passed in as the (kk, ww, tt, KKK, bb) integers from the YearCalendars 'mayan' column.
     
-    def message_algo_mayan (self, coord, line, thing = 0):
-        kk  = int(line[0:2])                                    ## fetch date components
-        ww  = int(line[2:4])
-        tt  = int(line[4:6])
-        KKK = int(line[6:9])
-        bb  = int(line[9:])
+    def message_algo_mayan (self, coord, date, thing = 0):
+        kk, ww, tt, KKK, bb = date                              ## fetch date components
         
         s   = "in the "                                         ## convert to strings
         k   = app_strings.num_to_text(kk, True) + """ k'in"""
@@ -728,15 +1012,15 @@ class Parser:
     
     ## Return the current date in the system of the Indian national calendar. This information is in the r_yyyy.txt file
     ## with the structure documented in the message_process_year function. Indian calendar information starts at byte 40
-    ## and runs through byte 47 with the format: ddmmyyyy.
+    ## and runs through byte 47 with the format: ddmmyyyy.  The date is passed in as the (dd, mm, yyyy) integers from the
+    ## YearCalendars 'indian' column.
     
     k_IndM = [ "chaitra", "vaisakha", "jyeshtha",   "ashadha", "shraavana", "bhadrapada",
                "ashvin",  "kartika",  "agrahayana", "pausha",  "magha",     "phalguna"  ]
     
-    def message_algo_indian (self, coord, line, thing = 0):
-        dd = int(line[0:2])                                             ## fetch day, month, year
-        mm = int(line[2:4]) - 1
-        yy = int(line[4:])
+    def message_algo_indian (self, coord, date, thing = 0):
+        dd, mm, yy = date                                               ## fetch day, month, year
+        mm = mm - 1
         d  = "the " + app_strings.num_to_text(dd, True) + " day of"     ## convert to strings for each
         m  = "the month of " + self.k_IndM[mm]
         y  = "in the " + app_strings.num_to_text(yy, True) + " year"
@@ -753,15 +1037,14 @@ class Parser:
     
     ## Return the current date in the system of the Coptic calendar. This information is in the r_yyyy.txt 
     ## file.  Coptic calendar information starts at byte 49 and runs through byte 56 with the
-    ## format: ddmmyyyy.
+    ## format: ddmmyyyy.  The date is passed in as the (dd, mm, yyyy) integers from the YearCalendars 'coptic' column.
     
     k_CopM = [ "thout",    "paopi",   "hathor", "koiak", "tobi",   "meshir", "paremhat",
                "parmouti", "pashons", "paoni",  "epip",  "mesori", "pi kogi enavot"  ]
     
-    def message_algo_coptic (self, coord, line, thing = 0):
-        dd = int(line[0:2])                                             ## fetch day, month, year
-        mm = int(line[2:4]) - 1
-        yy = int(line[4:])
+    def message_algo_coptic (self, coord, date, thing = 0):
+        dd, mm, yy = date                                               ## fetch day, month, year
+        mm = mm - 1
         d  = "the " + app_strings.num_to_text(dd, True) + " day of"     ## convert to strings for each
         m  = "the month of " + self.k_CopM[mm]
         y  = "in the " + app_strings.num_to_text(yy, True) + " year"
@@ -857,10 +1140,10 @@ def print_conditional_entries (file_desig, c):
         print ("--- file designator not found")
         return
     
-    for i in range(1, flen):
-        if (file_desig == "r_anys"):    s = app_files.file_read_line(app_files.file_any, i, app_files.k_LEN_R_ANYS)
-        elif (file_desig == "r_brc"):   s = app_files.file_read_line(app_files.file_brc, i, app_files.k_LEN_R_ANYS)
-        elif (file_desig == "r_cond"):  s = app_files.file_read_line(app_files.file_cond, i, app_files.k_LEN_R_ANYS)
+    if (file_desig == "r_anys"):        lines = app_files.file_read_lines(app_files.file_any, range(1, flen), app_files.k_LEN_R_ANYS)
+    elif (file_desig == "r_brc"):       lines = app_files.file_read_lines(app_files.file_brc, range(1, flen), app_files.k_LEN_R_ANYS)
+    elif (file_desig == "r_cond"):      lines = app_files.file_read_lines(app_files.file_cond, range(1, flen), app_files.k_LEN_R_ANYS)
+    for s in lines:
         if (s[0] == '!'):
             try:                        ## get rid of any eol flags
                 eos = s.index('~')
@@ -905,16 +1188,14 @@ def return_everything ():
     print ("  " + p.message_algo_zodiac(c, 35) )
     print ("  " + p.message_algo_zodiac(c, 45) + "\n")
     
-    fname = app_files.dir_r_year + "r_" + str(ltc.year) + ".txt"                    ## generate the target file name from the year
-    lnum = ltc.timetuple().tm_yday                                                  ## line number is the day of the year
-    line = app_files.file_read_line(fname, lnum, app_files.k_LEN_R_20xx)
+    cal = year_calendars.day(ltc)                                                   ## the r_yyyy line for the day
         
-    print ("islamic calendar:  " + p.message_algo_islam(c, line[0:8], 1) )          ## islamic calendar date (look up table)
-    print ("chinese calendar:  " + p.message_algo_china(c, line[9:18], 1) )         ## chinese calendar date or zodiac information
-    print ("hebrew calendar:   " + p.message_algo_hebrew(c, line[19:27], 1) )       ## hebrew calendar date (look up table)
-    print ("mayan calendar:    " + p.message_algo_mayan(c, line[28:39], 1) )        ## mayan long-count calendar (look up table)
-    print ("hindu calendar:    " + p.message_algo_indian(c, line[40:48], 1) )       ## indian national calendar date (look up table)
-    print ("coptic calendar:   " + p.message_algo_coptic(c, line[49:57], 1) + "\n") ## coptic calendar date (look up table)
+    print ("islamic calendar:  " + p.message_algo_islam(c, cal['islam'].tolist(), 1) )      ## islamic calendar date (look up table)
+    print ("chinese calendar:  " + p.message_algo_china(c, cal['china'].tolist(), str(cal['china_sign']), 1) )
+    print ("hebrew calendar:   " + p.message_algo_hebrew(c, cal['hebrew'].tolist(), 1) )    ## hebrew calendar date (look up table)
+    print ("mayan calendar:    " + p.message_algo_mayan(c, cal['mayan'].tolist(), 1) )      ## mayan long-count calendar (look up table)
+    print ("hindu calendar:    " + p.message_algo_indian(c, cal['indian'].tolist(), 1) )    ## indian national calendar date (look up table)
+    print ("coptic calendar:   " + p.message_algo_coptic(c, cal['coptic'].tolist(), 1) + "\n")  ## coptic calendar date (look up table)
     
     print ("extra-solar objects:")
     print ("    " + p.message_algo_extrasol(c, 5) )
@@ -1009,3 +1290,262 @@ def return_particular ():
 
 #### return_everything()
 #### return_particular()
+
+
+## Count the os.urandom calls (system calls for random bytes) per Parser.fetch(), with an entropy pool of size zero
+## (one call per random number, the way that arand and cryptorand used to work) and with the default pool.
+
+def bench_entropy (n = 2000):
+    ltc = datetime.datetime.now()                   ## init the times
+    utc = datetime.datetime.now(datetime.UTC)
+    c   = coordinate(ltc, utc, 47.434765, -122.668934, 134, -700)
+    p   = Parser()
+    for (label, size) in [ ("unbuffered", 0), ("pooled", app_numeric.EntropyPool().size) ]:
+        pool = app_numeric.EntropyPool(size)
+        old  = app_numeric.set_entropy_pool(pool)
+        t0   = time.perf_counter()
+        for i in range(n): p.fetch(c, (i % 2) == 0)
+        t1   = time.perf_counter()
+        app_numeric.set_entropy_pool(old)
+        print ("%-10s  %8.2f urandom calls per fetch   %8.1f us per fetch" % (label, pool.reads / n, (t1 - t0) * 1e6 / n))
+
+#### bench_entropy()
+
+
+## Check that a seeded run is reproducible: run the same sequence of fetches (at the same sequence of times, a
+## minute apart) twice with the same seed and make sure that the messages are identical.
+
+def check_seeded_fetch (seed = 1234, n = 500):
+    t0  = datetime.datetime(2026, 8, 30, 12, 0, 0)
+    p   = Parser()
+    out = []
+    for k in range(2):
+        old = app_numeric.seed_random(seed)
+        msg = []
+        for i in range(n):
+            ltc = t0 + datetime.timedelta(minutes = i)
+            c   = coordinate(ltc, ltc + datetime.timedelta(hours = 7), 40.786110, -119.204595, 452, -700)
+            a   = p.fetch(c, (i % 2) == 0)
+            msg.append((a.message, a.attrib, a.bg_img))
+        app_numeric.set_entropy_pool(old)
+        out.append(msg)
+    same = sum([ 1 for i in range(n) if (out[0][i] == out[1][i]) ])
+    print ("seed " + str(seed) + ": " + str(same) + " of " + str(n) + " messages identical")
+    return (same == n)
+
+#### check_seeded_fetch()
+
+
+## Soak test a whole year:  step a simulated clock through the year (five minutes at a time) and fetch a message at
+## every step, as fast as the CPU allows.  The timezone offset follows the daylight saving changes for the timezone.
+## Reports the number of fetches, empty messages, and exceptions (with the first few of those printed).
+
+def soak_year (year = 2026, lat = 47.434765, lon = -122.668934, tz = 134, on_playa = False, step_min = 5):
+    t0    = datetime.datetime(year, 1, 1, tzinfo = datetime.UTC)
+    n     = int((datetime.datetime(year + 1, 1, 1, tzinfo = datetime.UTC) - t0).total_seconds() // (step_min * 60))
+    offs  = app_timezones.tz_offset_many(tz, [ int(t0.timestamp()) + (i * step_min * 60) for i in range(n) ])
+    clk   = app_numeric.SimClock(t0, int(offs[0]), datetime.timedelta(minutes = step_min))
+    c     = coordinate(t0, t0, lat, lon, tz, int(offs[0]), clk)
+    p     = Parser()
+    empty = 0
+    errs  = 0
+    start = time.perf_counter()
+    for i in range(n):
+        clk.tz_off = c.tz_off = int(offs[i])
+        coordinate_now(c)
+        try:
+            if (p.fetch(c, on_playa).message == ""): empty = empty + 1
+        except Exception as e:
+            errs = errs + 1
+            if (errs <= 5): print ("  " + str(c.ltc) + "  " + type(e).__name__ + ": " + str(e))
+        clk.tick()
+    t = time.perf_counter() - start
+    print ("%d: %d fetches in %.1f s (%.0f us each), %d empty, %d exceptions" % (year, n, t, t * 1e6 / n, empty, errs))
+    return (errs)
+
+#### soak_year()
+
+
+## Compare the eligibility index with drawing conditional lines at random (up to 5 tries, the old way) at a few dates:
+## how many lines are eligible, how often each way finds a line, and how many different lines each one finds.
+
+def check_eligible (n = 20000):
+    for ltc in [ datetime.datetime(2026, 1, 30, 9, 0), datetime.datetime(2026, 7, 4, 20, 0), datetime.datetime(2026, 12, 25, 9, 0) ]:
+        c   = coordinate(ltc, ltc + datetime.timedelta(hours = 8), 47.434765, -122.668934, 134, -800)
+        old = {}
+        new = {}
+        for k in range(n):
+            for i in range(5):
+                pl = app_pack.pack.random_line('con')
+                if (app_markup.condition_test(pl.text[1:(pl.text.index(' ') + 1)], c)):
+                    old[pl.text] = old.get(pl.text, 0) + 1
+                    break
+            pl = app_pack.eligible.pick('con', c, 5)
+            if (pl is not None): new[pl.text] = new.get(pl.text, 0) + 1
+        print ("%s  %4d eligible   found: random %.4f, index %.4f   different lines: random %d, index %d" % (str(ltc.date()),
+               len(app_pack.eligible.lines('con', c)), sum(old.values()) / n, sum(new.values()) / n, len(old), len(new)))
+    for t in ('con', 'any'): print (t + ": " + str(app_pack.eligible.stats(t)))
+
+#### check_eligible()
+
+
+## Check the high-priority interval index against walking the h_yyyy file line by line, for every year file, at a few
+## places:  every step_min minutes through the year, and a minute either side of the start and end of every interval
+## in the file.  Both are run from the same seed, so the random draws have to match too.  Also times the two.  Times
+## where the walk raises (there is no h_2024.txt, for one) are counted separately:  the index just has no messages.
+
+def check_high_priority (step_min = 360):
+    p      = Parser()
+    places = [ (40.786110, -119.204595, -700), (47.434765, -122.668934, -800), (-33.9, 151.2, 1000), (51.5, -0.1, 0) ]
+    one    = datetime.timedelta(minutes = 1)
+    bad    = 0
+    errs   = 0
+    n      = 0
+    found  = 0
+    tw     = 0.0
+    ti     = 0.0
+    for yy in range(2024, 2101):
+        times = []                                          ## (time, is it local)
+        t     = datetime.datetime(yy, 1, 1)
+        while (t.year == yy):
+            times.append((t, True))
+            t = t + datetime.timedelta(minutes = step_min)
+        high_priority.load(yy)
+        for e in high_priority.events:
+            for k in (e.start, e.end):
+                try:    t = datetime.datetime(yy, k // 1000000, (k // 10000) % 100, (k // 100) % 100, k % 100)
+                except  ValueError: continue
+                times.extend([ (t - one, e.local), (t, e.local), (t + one, e.local) ])
+        for (t, local) in times:
+            for (lat, lon, off) in places:
+                dt  = datetime.timedelta(hours = int(off / 100))
+                if (local): c = coordinate(t, t - dt, lat, lon, 0, off)
+                else:       c = coordinate(t + dt, t, lat, lon, 0, off)
+                old = app_numeric.seed_random(n)
+                t0  = time.perf_counter()
+                try:                a = p.fetch_high_priority_walk(c)
+                except Exception:   a = None
+                t1  = time.perf_counter()
+                app_numeric.seed_random(n)
+                b   = p.fetch_high_priority(c)
+                t2  = time.perf_counter()
+                app_numeric.set_entropy_pool(old)
+                tw  = tw + (t1 - t0)
+                ti  = ti + (t2 - t1)
+                n   = n + 1
+                if (b != ""): found = found + 1
+                if (a is None):
+                    errs = errs + 1
+                elif (a != b):
+                    bad = bad + 1
+                    if (bad <= 5): print ("  " + str(c.ltc) + " " + str((lat, lon)) + ": " + repr(a) + " vs " + repr(b))
+    print ("%d checks, %d messages, %d mismatches, %d walk errors;  walk %.1f us, index %.1f us per check" %
+           (n, found, bad, errs, tw * 1e6 / n, ti * 1e6 / n))
+    return (bad)
+
+#### check_high_priority()
+
+
+## Check the typed r_yyyy columns against slicing the same fields out of each line by hand (the way that the message
+## functions used to), for every day of every year file.  Also times reading a year both ways.
+
+def check_year_calendars ():
+    cals = YearCalendars()
+    bad  = 0
+    days = 0
+    tr   = 0.0
+    tl   = 0.0
+    for yy in range(2024, 2100):
+        fname = app_files.dir_r_year + "r_" + str(yy) + ".txt"
+        t0    = time.perf_counter()
+        cal   = cals.load(yy)
+        t1    = time.perf_counter()
+        try:
+            lines = app_files.file_read_lines(fname, range(1, app_files.file_get_lines(fname, app_files.k_LEN_R_20xx) + 1), app_files.k_LEN_R_20xx)
+        except OSError:
+            lines = []
+        t2    = time.perf_counter()
+        tr    = tr + (t1 - t0)
+        tl    = tl + (t2 - t1)
+        if (cal is None):
+            if (len(lines) > 0): print ("  " + str(yy) + ": not loaded")
+            continue
+        for (i, line) in enumerate(lines):
+            a = [ [ int(line[0:2]),   int(line[2:4]),   int(line[4:8])   ],
+                  [ int(line[9:11]),  int(line[11:13]), int(line[13:17]) ], line[17],
+                  [ int(line[19:21]), int(line[21:23]), int(line[23:27]) ],
+                  [ int(line[28:30]), int(line[30:32]), int(line[32:34]), int(line[34:37]), int(line[37:39]) ],
+                  [ int(line[40:42]), int(line[42:44]), int(line[44:48]) ],
+                  [ int(line[49:51]), int(line[51:53]), int(line[53:57]) ],
+                  [ int(j) for j in (line[58:104].strip('~ ').split(';')) ] ]
+            b = [ cal[i]['islam'].tolist(), cal[i]['china'].tolist(), str(cal[i]['china_sign']), cal[i]['hebrew'].tolist(),
+                  cal[i]['mayan'].tolist(), cal[i]['indian'].tolist(), cal[i]['coptic'].tolist(), cals.macros(cal[i]) ]
+            days = days + 1
+            if (a != b):
+                bad = bad + 1
+                if (bad <= 5): print ("  " + str(yy) + " day " + str(i + 1) + ": " + str(a) + " vs " + str(b))
+    print ("%d days, %d mismatches;  typed load %.2f ms per year, line reads %.2f ms per year" % (days, bad, tr * 1e3 / 76, tl * 1e3 / 76))
+    return (bad)
+
+#### check_year_calendars()
+
+
+## Time the day-dependent message parts with the day context made fresh on every call (the cost of working everything
+## out on every tick, which is how it used to be) and with it kept for the day.
+
+def bench_day_context (n = 200):
+    ltc = datetime.datetime(2026, 8, 30, 21, 15, 0)
+    c   = coordinate(ltc, ltc + datetime.timedelta(hours = 7), 40.786110, -119.204595, 452, -700)
+    p   = Parser()
+    for (label, fresh) in [ ("every tick", True), ("once a day", False) ]:
+        res = []
+        for (name, fn) in [ ("sun", p.message_algo_sun), ("moon", p.message_algo_moon), ("year", p.fetch_year_based),
+                            ("season", lambda c: app_markup.day_season(c)) ]:
+            t0 = time.perf_counter()
+            for i in range(n):
+                if (fresh):
+                    c.day = None
+                    app_markup.day_last = app_markup.day_context()
+                fn(c)
+            res.append("%s %7.1f us" % (name, (time.perf_counter() - t0) * 1e6 / n))
+        print ("%-12s " % (label) + ",  ".join(res))
+
+#### bench_day_context()
+
+
+## Time a cold start in a fresh interpreter:  importing the parser, and the first message after that (which loads the
+## content pack and the tables).  Also lists the heavy modules that were loaded by then (a headless start shouldn't load
+## any of the display libraries, and only loads ephem and friends when a message needs them), and the slowest imports
+## from python's own import-time profile (-X importtime).  Times are the best of a few runs, in milliseconds.
+
+k_STARTUP_CODE = """
+import time, sys, datetime
+t0 = time.perf_counter()
+import app_parser
+t1 = time.perf_counter()
+ltc = datetime.datetime(2026, 8, 30, 12, 0, 0)
+app_parser.Parser().fetch(app_parser.coordinate(ltc, ltc + datetime.timedelta(hours = 7), 40.786110, -119.204595, 452, -700))
+t2 = time.perf_counter()
+print ("%.3f %.3f " % ((t1 - t0) * 1e3, (t2 - t1) * 1e3) + ",".join([ m for m in ("tkinter", "PIL", "ephem", "suntime", "juliandate", "numpy") if (m in sys.modules) ]))
+"""
+
+def bench_startup (runs = 5, top = 12):
+    import subprocess
+    import sys
+    res = []
+    for i in range(runs):
+        out = subprocess.run([ sys.executable, "-c", k_STARTUP_CODE ], capture_output = True, text = True).stdout.split()
+        res.append(out)
+    print ("import app_parser %.1f ms,  first fetch %.1f ms,  loaded: %s" %
+           (min([ float(r[0]) for r in res ]), min([ float(r[1]) for r in res ]), (res[0][2:] or [ "-" ])[0]))
+
+    err  = subprocess.run([ sys.executable, "-X", "importtime", "-c", k_STARTUP_CODE ], capture_output = True, text = True).stderr
+    imps = []
+    for ln in err.splitlines():
+        f = ln.split("|")
+        if ((len(f) == 3) and f[1].strip().isdigit()): imps.append((int(f[0].split(":")[1]), int(f[1]), f[2].rstrip()))
+    print ("slowest imports (self / cumulative, ms):")
+    for (t, c, name) in sorted(imps, key = lambda x: -x[0])[:top]:
+        print ("  %7.1f %7.1f  %s" % (t / 1e3, c / 1e3, name))
+
+#### bench_startup()
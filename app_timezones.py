@@ -1,17 +1,47 @@
 ## Module:      app_timezones
 ## Description: Functions for determining the timezone in which a set of geographic coordinates
 ##              resides.
-## Contains:    get_timezone        Return the timezone ID for the given geographic coordinates
+## Contains:    TimezoneMap         The timezone map decoded in to memory
+##              TimezoneRaster      The timezone map expanded in to a dense, memory-mapped raster
+##              tz_raster_build     Generate the dense raster file from the timezone map
+##              set_timezone_engine Select the lookup engine used by get_timezone (rle | raster)
+##              get_timezone        Return the timezone ID for the given geographic coordinates
+##              get_timezone_many   Return the timezone IDs for whole arrays of geographic coordinates
+##              RegionTable         All of the regions in all_rgn.txt, parsed once
 ##              get_timezone_data   Return the timezone data for the given timezone ID
 ##              get_timezone_file   Return the offset for a particular timezone, given the timezone file name and date
+##              TransitionTable     Every timezone file compiled in to sorted offset transition arrays
+##              tz_offset_many      Return the offsets in effect for arrays of timezone IDs and UTC times
+##              utc_to_local_many   Convert arrays of UTC times to local times for arrays of timezone IDs
 
 import os
+import bisect
 import datetime
-from dataclasses import dataclass
+import time
+import numpy
+from dataclasses import dataclass, replace
 
 import app_files
 import app_numeric
 
+## ------------------------------------------------------------------------------------------------- CONSTANT DEFINITIONS
+
+k_TZ_KEY = 1 << 16                                      ## latitude span of one line of longitude in the lookup_many keys
+
+k_RAS_LONS   = 7201                                     ## raster columns:  -180.00 to 180.00 in 0.05 degree steps
+k_RAS_LATS   = 3401                                     ## raster rows:     -85.00 to 85.00 in 0.05 degree steps
+k_RAS_DTYPE  = '<u2'                                    ## raster cell:     timezone ID as returned by get_timezone
+
+k_TZ_ENGINES = ( "rle", "raster" )                      ## lookup engines for get_timezone
+
+k_TZ_YEAR_LO = 2023                                     ## first and last years in the timezone files
+k_TZ_YEAR_HI = 2099
+k_TZ_DAY_LO  = (datetime.date(k_TZ_YEAR_LO, 1, 1) - datetime.date(1970, 1, 1)).days      ## as days since 1970-01-01
+k_TZ_DAY_HI  = (datetime.date(k_TZ_YEAR_HI + 1, 1, 1) - datetime.date(1970, 1, 1)).days
+k_TZ_T_BASE  = (k_TZ_DAY_LO - 1) * 86400                ## base of the utc_to_local_many keys (before any transition)
+k_TZ_T_KEY   = 1 << 32                                  ## time span of one timezone ID in the utc_to_local_many keys
+
+
 ## ------------------------------------------------------------------------------------------------- STRUCTURES
 
 @dataclass
@@ -151,10 +181,190 @@ class tz_info:
 ## actual time zone for the input co-ordinates, down to a resolution of 0.05 degrees in both longitude and
 ## latitude.
 
+## ------------------------------------------------------------------------------------------------- CLASS - TimezoneMap
+## The whole RLE map decoded in to memory, once.  The reading algorithm above is still exactly what happens, but the
+## index and map files are each read a single time (through the app resource store) and every 3-byte triple in the
+## map is unpacked up front in to two parallel arrays:
+##
+##      region      region ID of each triple (I16_1 above)
+##      lat         latitude boundary of each triple (I16_2 above, already scaled to -8500..8500)
+##
+## plus a per-longitude pair of offsets (start, stop) in to those arrays, with the "keep scanning while stop equals
+## start" step for duplicate lines already resolved.  Within one line of longitude the latitude boundaries are in
+## ascending order, so finding the first boundary that the latitude is less than or equal to is a binary search.
+
+class TimezoneMap:
+
+    def __init__ (self):
+        idx = numpy.frombuffer(app_files.store.map(app_files.file_tz_index), dtype='>i4').astype(numpy.int64)
+        raw = numpy.frombuffer(app_files.store.map(app_files.file_tz_map), dtype=numpy.uint8)
+        raw = raw[:(len(raw) - (len(raw) % 3))].reshape(-1, 3).astype(numpy.int32)
+        msz = len(raw) * 3                                              ## size of the map data in bytes
+
+        self.region = (raw[:, 0] + ((raw[:, 1] & 3) << 8)).astype(numpy.int16)
+        self.lat    = ((((raw[:, 1] & 252) >> 2) + (raw[:, 2] << 6)) * 5) - 8500
+
+        ## The stop offset for each longitude is the next entry in the index that differs from the start offset.  For
+        ## the last longitude (+180.00) there is no next entry, so the stop offset is the end of the map file.
+
+        stop = numpy.empty(len(idx), dtype=numpy.int64)
+        nxt  = msz
+        for i in range(len(idx) - 1, -1, -1):
+            stop[i] = nxt
+            if ((i > 0) and (idx[i - 1] != idx[i])): nxt = idx[i]
+        stop[-1] = msz
+        self.start = idx // 3                                           ## byte offsets to triple offsets
+        self.stop  = stop // 3
+        self.line  = None                                               ## line number of each triple    (built on first use
+        self.keys  = None                                               ## sort key of each triple        by lookup_many)
+
+    ## Look up the region for a latitude (x 100, as an integer) at a given longitude index (0..7200).  Returns the
+    ## region ID exactly as it appears in the map (zero-based), or -1 if there is no data for that longitude.
+
+    def lookup (self, lat, lon_idx):
+        a = self.start[lon_idx]
+        b = self.stop[lon_idx]
+        if (b <= a): return (-1)
+        i = int(numpy.searchsorted(self.lat[a:b], lat, side='left'))    ## first boundary that lat is <= to
+        if (i >= (b - a)): i = b - a - 1                                ## past the last boundary = last region
+        return (int(self.region[a + i]))
+
+    ## Look up the regions for whole arrays of latitudes (x 100) and longitude indices at once.  Every line of longitude
+    ## is a run of ascending latitude boundaries, so each triple gets a single sort key of (line number, latitude) and
+    ## one searchsorted over all of the keys does the work of the per-line binary search for every point together.
+    ## The result is the same as calling lookup() on each point in turn.
+
+    def lookup_many (self, lat, lon_idx):
+        if (self.keys is None):
+            line = numpy.zeros(len(self.region), dtype=numpy.int64)     ## line number of each triple
+            firsts = numpy.unique(self.start[self.start < len(self.region)])
+            line[firsts[1:]] = 1
+            self.line = numpy.cumsum(line)
+            self.keys = (self.line * k_TZ_KEY) + (self.lat + 8500)
+
+        lat = numpy.asarray(lat, dtype=numpy.int64)
+        lon_idx = numpy.asarray(lon_idx, dtype=numpy.int64)
+        a   = self.start[lon_idx]
+        b   = self.stop[lon_idx]
+        ok  = (b > a)                                                   ## longitudes with data
+        ln  = self.line[numpy.minimum(a, len(self.region) - 1)]
+        i   = numpy.searchsorted(self.keys, (ln * k_TZ_KEY) + (lat + 8500), side='left')
+        i   = numpy.clip(i, a, numpy.maximum(b - 1, a))                 ## past the last boundary = last region
+        rgn = self.region[numpy.minimum(i, len(self.region) - 1)].astype(numpy.int32)
+        return (numpy.where(ok, rgn, -1))
+
+
+tz_map = None                                                           ## decoded map (loaded on first use)
+
+def get_timezone_map ():
+    global tz_map
+    if (tz_map is None): tz_map = TimezoneMap()
+    return (tz_map)
+
+
+## ------------------------------------------------------------------------------------------------- CLASS - TimezoneRaster
+## The timezone map expanded out to one cell for every 0.05 degree point from -180.00 to 180.00 longitude and -85.00
+## to 85.00 latitude.  Each cell is a little-endian uint16 holding the timezone ID that get_timezone() returns for that
+## point (so it is 7201 x 3401 x 2 bytes, about 49 megs).  The raster is generated from the RLE map (all_tz.idx and
+## all_tz.map stay the source of truth), written to the data directory, and memory-mapped through the app resource
+## store, so looking up a point is a single array index and the operating system pages in only what is used.
+##
+## The raster is regenerated whenever it is missing, the wrong size, or older than either of the RLE map files.
+
+class TimezoneRaster:
+
+    def __init__ (self, fname = app_files.file_tz_raster):
+        self.fname = fname
+        data = None
+        if (not tz_raster_stale(fname)):
+            try:
+                data = app_files.store.map(fname)
+            except OSError:
+                data = None
+        if (data is None):
+            data = tz_raster_build(fname)
+            app_files.store.release(fname)                              ## the next map() picks up the new file
+        self.grid = numpy.frombuffer(data, dtype=k_RAS_DTYPE).reshape(k_RAS_LONS, k_RAS_LATS)
+
+    ## Look up the timezone ID for a latitude and longitude that have already been rounded to 0.05 degrees.
+
+    def lookup (self, alat, alon):
+        return (int(self.grid[round(((alon * 100.0) + 18000.0) / 5.0), round(((alat * 100.0) + 8500.0) / 5.0)]))
+
+    ## The same for whole arrays of latitudes and longitudes.
+
+    def lookup_many (self, alat, alon):
+        i = numpy.round(((alon * 100.0) + 18000.0) / 5.0).astype(numpy.int64)
+        j = numpy.round(((alat * 100.0) + 8500.0) / 5.0).astype(numpy.int64)
+        return (self.grid[i, j])
+
+
+## Return true if the raster file needs to be (re)generated from the RLE map files.
+
+def tz_raster_stale (fname = app_files.file_tz_raster):
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return (True)
+    if (st.st_size != (k_RAS_LONS * k_RAS_LATS * numpy.dtype(k_RAS_DTYPE).itemsize)): return (True)
+    for src in (app_files.file_tz_index, app_files.file_tz_map):
+        if (os.stat(src).st_mtime_ns > st.st_mtime_ns): return (True)
+    return (False)
+
+
+## Generate the raster from the RLE map by looking up every grid point with TimezoneMap.lookup_many().  The polar
+## cases are left to get_timezone(), so the rows at +/-85.00 hold what the map says.  The latitudes go through the same
+## rounding and truncation as get_timezone() so that every cell matches it exactly.  The raster is written to fname
+## (if that can be done) and returned as bytes either way, so that a read-only data directory still gets a working
+## raster.  The new file is swapped in under a new inode, so a raster that is still mapped from the old one keeps
+## working;  it is up to the caller to drop that raster and release the old mapping from the resource store.
+
+def tz_raster_build (fname = app_files.file_tz_raster):
+    tzm  = get_timezone_map()
+    lats = app_numeric.round_to_val_many((numpy.arange(k_RAS_LATS) * 5 - 8500) / 100.0)
+    lats = numpy.trunc(lats * 100.0).astype(numpy.int64)
+    grid = numpy.empty((k_RAS_LONS, k_RAS_LATS), dtype=k_RAS_DTYPE)
+    for i in range(0, k_RAS_LONS, 600):                                 ## a block of longitudes at a time
+        lons = numpy.arange(i, min(i + 600, k_RAS_LONS))
+        grid[i:(i + len(lons))] = tzm.lookup_many(lats[None, :], lons[:, None]) + 1
+    data = grid.tobytes()
+
+    try:
+        f = open(fname + ".tmp", 'wb')                                  ## write to a temporary file and swap it in
+        f.write(data)
+        f.close()
+        os.replace(fname + ".tmp", fname)
+    except OSError:
+        pass                                                            ## can't write it, so just use it from memory
+    return (data)
+
+
+tz_raster = None                                                        ## dense raster (loaded on first use)
+tz_engine = "rle"                                                       ## lookup engine used by get_timezone
+
+def get_timezone_raster ():
+    global tz_raster
+    if (tz_raster is None): tz_raster = TimezoneRaster()
+    return (tz_raster)
+
+
+## Select the lookup engine used by get_timezone() and get_timezone_many():  "rle" decodes the compressed map (about
+## half a meg in memory, suitable for small devices) and "raster" indexes the dense raster (about 49 megs of page
+## cache, one array index per lookup).  Both return exactly the same timezone IDs.
+
+def set_timezone_engine (engine):
+    global tz_engine
+    if (engine not in k_TZ_ENGINES):
+        raise ValueError("unknown timezone engine: " + str(engine))
+    tz_engine = engine
+
+
 ## Get the timezone for the given coordinates.  If the timezone cannot be determined, return -1.  Otherwise, the timezone
-## is an index in to the all_rgn.txt file.  WARNING: This makes use of platform-specific file system calls and so must be
-## re-written for each particular platform.  OTHER WARNING: The parameters (alat, alon) MUST be expressed no smaller than
-## 0.05 degrees.  We'll round to that to make sure.
+## is an index in to the all_rgn.txt file.  The parameters (alat, alon) MUST be expressed no smaller than 0.05 degrees.
+## We'll round to that to make sure.
+##
+## For <lat = 47.45, lon = -122.65> we should have a lon index of 1147 (5735 / 5) and a lat of 4745, with map triples
+## starting at 11013 (33039 / 3), and the result should be timezone 134.  This is your sanity check...
 
 def get_timezone (alat, alon):
     if ((alat < -90.00) or (alat > 90.00)):                             ## return null on invalid cases
@@ -167,110 +377,45 @@ def get_timezone (alat, alon):
         return (316)
     alat = app_numeric.round_to_val(alat)                               ## force these to 0.05 degree increments
     alon = app_numeric.round_to_val(alon)
-    
-    region = -1
-    lat    = int( alat * 100.0 )                                        ## turn lat and lon into pointers to the index file
-    lon    = int( (((alon * 100.0) + 18000.0) / 5.0) * 4.0 )
+    if (tz_engine == "raster"):
+        return (get_timezone_raster().lookup(alat, alon))
 
-    ## For <lat = 47.45, lon = -122.65> we should have a lon index of 4588 (5735), and a lat index
-    ## of 4745.  This is your sanity check...
-    
-    ## print ("--- lon index [4588 (5735)] = " + str(lon) + " (" + str((alon * 100) + 18000) + ")")
-    ## print ("--- lat index [4745       ] = " + str(lat))
-    
-    f_idx  = open(app_files.file_tz_index, mode='rb')                   ## open up the index file
-    f_idx.seek(lon, 0)                                                  ## jump to the position as given by the "lon" pointer
-    start = app_files.file_read_uint(f_idx)                             ## grab the next 4 bytes as an uint32_t
-    
-    ##  If the longitude is 180.00, then there is no stop location in the index file, and we just
-    ##  read all the way to the end of the map file.  In that instance, set the stop location to
-    ##  zero as a flag that we're going to read the rest.
-    if (alon == 180.0):
-        stop = 0
-    else:
-        ##  If the longitude is less than 180.00, we need to figure out where to stop reading the map
-        ##  file.  We do this by getting the next location, and then reading everything from start to
-        ##  stop.  It is possible that the stop location is the same as the start location. This will
-        ##  happen when two entries in the map file are the same and duplicates are eliminated in the
-        ##  name of saving space.  If they are the same, then we keep scanning until we find one that
-        ##  is different.
-        stop = app_files.file_read_uint(f_idx)
-        while (stop == start):
-            stop = app_files.file_read_uint(f_idx)
-    
-    f_idx.close()                                                       ## done with the index file
-    
-    ## Now it's time to open up the map file and read its data from the appropriate spot.  There
-    ## are no lines longer than 208 bytes and so we've hard-coded the map data array to that.
-    
-    f_map  = open(app_files.file_tz_map, mode='rb')                     ## open up the index file
-    
-    ## If stop is zero, then that's our flag that there's nothing past the last data line (i.e.:
-    ## we're at +180.00 degrees longitude).  In that case we need to figure out where the end of
-    ## the map data file is and use that as our stopping point.
-    
-    if (stop == 0):
-        f_map.seek(0, 2)                                                ## move to the end of file
-        stop = f_map.tell()                                             ## get the byte offset
-        f_map.seek(0, 0)                                                ## move back to the start
-    slen = stop - start
-    
-    ## Now that we have a valid start and stop, we can actually read the data.  For the aforementioned
-    ## <lat,lon> coordinates, we should have a map start of 33039, a map stop of 33060, and a map span
-    ## of 21.  This is your sanity check...
-    
-    ## print(" --- map start (33039) = " + str(start))
-    ## print(" --- map stop  (33060) = " + str(stop))
-    ## print(" --- map slen  (   21) = " + str(slen))
-    
-    f_map.seek(start, 0)                                                ## move to the map start
-    map_dat = f_map.read(slen)                                          ## read x-bytes to an array
-    f_map.close()
+    lat  = int( alat * 100.0 )                                          ## latitude and the longitude index in to the map
+    lon  = int( round(((alon * 100.0) + 18000.0) / 5.0) )
+    return (get_timezone_map().lookup(lat, lon) + 1)
 
-    ## We now have a buffer full of data, so we can step-through it and convert it from its optimized
-    ## form in to our original scheme of [region][latitude][region][latitude]...
-    ## Next sanity check: map data = be 29 26 85 e0 29 c2 dc 2b 5f ac 2c 66 50 2d c6 80 32 be 1d 35
-    
-    ## print("\nbe292685e029c2dc2b5fac2c66502dc68032be1d35")
-    ## print(bytes(map_dat).hex())    
-    
-    ##  Step through the array three bytes at a time and copy them in to placeholder values. And the
-    ##  values with 0x00FF in order to have enough room to bit shift and to clear out extra data.
-        
-    i = 0
-    while (i < slen):
-        ua = map_dat[i]
-        ub = map_dat[i + 1]
-        uc = map_dat[i + 2]
-        
-        ##  Region is equal to all of the bits of the first U8, and the first two bits of the second.
-        
-        region = ua + ((ub & 3) * 256)
-        
-        ##  Latitude is a little more complicated. It's equal to the last six bits of the second U8 and
-        ##  all of the bits of the third.  And then we have to multiply by 5 and subtract 8500 from the
-        ##  value in order to get actual latitude.
-        
-        i_lat = ((((ub & 252) / 4) + (uc * 64)) * 5) - 8500;
-        
-        ##  If our current latitude is less than the latitude in the map file, then we've found the right
-        ##  region and we can get out of here.  Otherwise, we go on to the next three bytes and start the
-        ##  process over.  The process ends when we get a hit.  This is guaranteed to always return valid
-        ##  data since (a) we designed the map file that way, and (b) we already accounted for the limits
-        ##  of far-north and far-south.
-        
-    ##  print(" +++ i = " + str(i) + " [ " + hex(ua) + " " + hex(ub) + " " + hex(uc) + " ] r = " + str(region) + ", lat = " + str(i_lat) )
-        
-        if (lat <= i_lat):
-            break
-        i = i + 3
-    
-    ## Final sanity check from the above printf statement:
-    ##     +++ i = 0 [ 0xbe 0x29 0x26 ] r = 446, lat = 3710
-    ##     +++ i = 3 [ 0x85 0xe0 0x29 ] r = 133, lat = 4900
-    ##     new tz : 134
-    
-    return (region + 1)
+
+## The same as get_timezone(), but for whole arrays of coordinates at once (anything that numpy.asarray() will take,
+## including plain lists).  The arrays must be the same shape, and an array of timezone IDs of that shape is returned.
+## Invalid coordinates (out of range or NaN) come back as -1 and the polar cases are exactly those of get_timezone().
+## The engine defaults to the one selected with set_timezone_engine(), and an unknown one raises a ValueError.
+
+def get_timezone_many (lats, lons, engine = None):
+    if (engine is None): engine = tz_engine
+    if (engine not in k_TZ_ENGINES):
+        raise ValueError("unknown timezone engine: " + str(engine))
+    alat = numpy.asarray(lats, dtype=numpy.float64)
+    alon = numpy.asarray(lons, dtype=numpy.float64)
+    alat, alon = numpy.broadcast_arrays(alat, alon)
+    rgn  = numpy.full(alat.shape, -1, dtype=numpy.int32)
+
+    ok   = (alat >= -90.00) & (alat <= 90.00) & (alon >= -180.00) & (alon <= 180.00)
+    sp   = ok & (alat <= -89.50)                                        ## south pole = pacific/auckland
+    pol  = ok & ~sp & ((alat <= -84.95) | (alat >= 84.95))              ## too far north or south = Etc/UTC
+    rgn[sp]  = 390
+    rgn[pol] = 316
+    ok   = ok & ~sp & ~pol
+    if (not ok.any()): return (rgn)
+
+    rlat = app_numeric.round_to_val_many(alat[ok])                      ## force these to 0.05 degree increments
+    rlon = app_numeric.round_to_val_many(alon[ok])
+    if (engine == "raster"):
+        rgn[ok] = get_timezone_raster().lookup_many(rlat, rlon)
+        return (rgn)
+    lat  = numpy.trunc(rlat * 100.0).astype(numpy.int64)                ## same as int() in get_timezone()
+    lon  = numpy.round(((rlon * 100.0) + 18000.0) / 5.0).astype(numpy.int64)
+    rgn[ok] = get_timezone_map().lookup_many(lat, lon) + 1
+    return (rgn)
 
 
 ## Return the region information for a given region ID number.  The region information comes from the
@@ -290,23 +435,100 @@ def get_timezone (alat, alon):
 ##                  <+|->hh:mm = hours and minutes of offset from utc
 ##                  z_nnn.     = the timezone file to lookup for the offset
 ##                  ~~~~~~~~~~ = no offset from utc
+##
+## The whole file is parsed once, when this module is imported, in to the region table below.  Lines that are not
+## regions (the notes at the end of the file) are marked as not valid.
+
+class RegionTable:
+
+    def __init__ (self):
+        n = app_files.file_get_lines(app_files.file_all_rgn, app_files.k_LEN_ALL_RG)
+        self.count  = n                                                 ## number of lines (region IDs are 1..n)
+        self.valid  = numpy.zeros(n + 1, dtype=bool)                    ## all of these are indexed by region ID,
+        self.lat    = numpy.zeros(n + 1, dtype=numpy.float64)           ## so entry 0 is never valid
+        self.lon    = numpy.zeros(n + 1, dtype=numpy.float64)
+        self.offset = numpy.zeros(n + 1, dtype=numpy.int32)             ## fixed offset (-9999 = use lookup)
+        self.name   = [ "" ] * (n + 1)
+        self.city   = [ "" ] * (n + 1)                                  ## name after the last divider ("" = none)
+        self.lookup = [ "" ] * (n + 1)                                  ## timezone file ("" = fixed offset)
+        self.cache  = {}                                                ## region -> tz_info
+        self.years  = {}                                                ## (region, year) -> resolved offsets for the year
+
+        lines = app_files.file_read_lines(app_files.file_all_rgn, range(1, n + 1), app_files.k_LEN_ALL_RG)
+        for (r, s) in enumerate(lines, 1):
+            try:
+                lat = float(s[0:6]) / 1000                              ## determine the representative lat/lon
+                lon = float(s[7:14]) / 1000
+                t   = s.index('~')
+            except ValueError:                                          ## not a region
+                continue
+            self.valid[r] = True
+            self.lat[r]   = lat
+            self.lon[r]   = lon
+            self.name[r]  = s[15:(t - 1)]                               ## get the timezone name
+            i = s.rfind('/')
+            if (i >= 0): self.city[r] = s[(i + 1):(t - 1)]
+
+            if ((s[48] == '+') or (s[48] == '-')):                      ## if there is an offset
+                self.offset[r] = (int(s[49:51]) * 100) + int(s[52:54])  ## read the offset time
+                if (s[48] == '-'):                                      ## and negate if needed
+                    self.offset[r] = 0 - self.offset[r]
+            if (s[48] == 'z'):                                          ## if there is a timezone file
+                self.lookup[r] = app_files.dir_z_time + s[48:54] + "txt"
+                self.offset[r] = -9999
+
+    ## Return true if the region ID is one of the regions in the table.
+
+    def is_region (self, region_id):
+        return ((region_id >= 1) and (region_id <= self.count) and bool(self.valid[region_id]))
+
+    ## Return the tz_info for a region.  These are made once and then shared, so they must not be changed by the
+    ## caller.  For regions with a timezone file the offset is -9999 (use lookup).
+
+    def info (self, region_id):
+        atz = self.cache.get(region_id)
+        if (atz is None):
+            atz = tz_info(region_id, float(self.lat[region_id]), float(self.lon[region_id]), int(self.offset[region_id]),
+                          self.name[region_id], self.lookup[region_id])
+            self.cache[region_id] = atz
+        return (atz)
+
+    ## Return the offsets of a region with a timezone file for a whole year, resolved once per (region, year):  a list
+    ## of the (zero-based) days of the year that the offset changes on, starting with day 0, and the tz_info (with the
+    ## offset filled in, shared like the ones above) for each of them.  Every day of the year is looked up in the
+    ## timezone file, so this gives what get_timezone_file would for any date in the year.
+
+    def year (self, region_id, year):
+        res = self.years.get((region_id, year))
+        if (res is None):
+            atz   = self.info(region_id)
+            day0  = datetime.date(year, 1, 1)
+            days  = []
+            infos = []
+            for n in range((datetime.date(year + 1, 1, 1) - day0).days):
+                off = get_timezone_file(atz.lookup, day0 + datetime.timedelta(days = n))
+                if ((len(infos) == 0) or (infos[-1].offset != off)):
+                    days.append(n)
+                    infos.append(replace(atz, offset = off))
+            res = self.years[(region_id, year)] = (days, infos)
+        return (res)
+
+
+regions = RegionTable()                                                 ## the one and only region table
+
+
+## Return the region information for a given region ID number and date, from the region table.  For regions that
+## have a timezone file, the offset is the one in effect on the date (from the offsets resolved for the year).  The
+## tz_info is shared, so it must not be changed by the caller.  A region ID that is not in the table raises an
+## IndexError.
 
 def get_timezone_data (region_id, adate):
-    s = app_files.file_read_line(app_files.file_all_rgn, region_id, app_files.k_LEN_ALL_RG)
-    atz = tz_info(region = region_id)                           ## set the region id in the struct
-    atz.lat  = float(s[0:6]) / 1000                             ## determine the representative lat/lon
-    atz.lon  = float(s[7:14]) / 1000
-    t        = s.index('~')
-    atz.name = s[15:(t - 1)]                                    ## get the timezone name
-    
-    if ((s[48] == '+') or (s[48] == '-')):                      ## if there is an offset
-        atz.offset = (int(s[49:51]) * 100) + int(s[52:54])      ## read the offset time
-        if (s[48] == '-'):                                      ## and negate if needed
-            atz.offset = 0 - atz.offset
-    if (s[48] == 'z'):                                          ## if there is a timezone file
-        atz.lookup = dir_z_time + s[48:54] + "txt"              ## read the filename
-        atz.offset = get_timezone_file(atz.lookup, adate)
-        
+    if (not regions.is_region(region_id)):
+        raise IndexError("not a timezone region: " + str(region_id))
+    atz = regions.info(region_id)
+    if (atz.lookup != ""):                                              ## if there is a timezone file
+        days, infos = regions.year(region_id, adate.year)
+        atz = infos[bisect.bisect_right(days, adate.timetuple().tm_yday - 1) - 1]
     return (atz)
 
 
@@ -333,28 +555,172 @@ def get_timezone_data (region_id, adate):
 ## chars 53-57  j = the offset starting on the fourth break to the end of the year
 
 def get_timezone_file (fname, adate):
-    if (adate.year < 2023):                                     ## trap out invalid years
-        adate.year = 2023
-    if (adate.year > 2099):
-        adate.year = 2099
-    s = app_files.file_read_line(fname, (adate.year-2022), app_files.k_LEN_Z_xxxx)
-    a = int(s[0:4])                                             ## get each component and test against them
-    eoy = datetime.date(year = a, month = 12, day = 31)         ## set the end of year flag
-    b = int(s[5:10])                                            ## get the first (only required) offset
-    
-    for i in range(4):
-        k = i * 12                                              ## character offset for each range
-        if (s[11 + k] != '~'):                                  ## if the ith date field is valid
-            m = int(s[(11 + k):(13 + k)])                       ##      get the month
-            d = int(s[(14 + k):(16 + k)])                       ##      get the day
-            c = datetime.date(year = a, month = m, day = d)     ##      assemble the date
-        else:                                                   ## if invalid
-            c = eoy                                             ##      set the date to end of year
-        if (adate < c):                                         ## check the interval and return if in range
-            return (b)
-        if (s[17 + k] != '~'):                                  ## get the next offset if valid
-            b = int(s[(17 + k):(22 + k)])
-    return (b)
+    if (isinstance(adate, datetime.datetime)): adate = adate.date()
+    return (get_timezone_transitions().offset_on(fname, adate))
+
+
+## ------------------------------------------------------------------------------------------------- CLASS - TransitionTable
+## Every timezone file compiled, once, in to a list of offset transitions per file.  Each line of a file is walked in
+## exactly the way described above (a break date of all tildes is the end of the year, and an offset of all tildes
+## leaves the offset unchanged), and every place where the walk would move on to the next offset becomes a transition.
+## A line also starts with a transition on January 1st to the start-of-year offset.  For each transition there is:
+##
+##      day         the date that it applies from, as days since 1970-01-01 (used for dates, as the file lines are)
+##      time        the instant that it applies from, as seconds since 1970-01-01 00:00 UTC -- the changeover is at
+##                  0100 local time (0000 on January 1st), in the offset that was in effect before it
+##      offset      the offset from then on, as <+|->hhmm
+##
+## The transitions are in order, so the offset for any date or instant is a bisect.  Dates and instants before 2023 or
+## after 2099 use the same day of the year in 2023 or 2099, the years that are closest.
+##
+## For the array functions, every region in the region table (the same timezone ID that get_timezone returns) gets the
+## transitions of its timezone file, or a single transition to its fixed offset, and all of them are joined in to one
+## sorted array of (timezone ID, time) keys.
+
+class TransitionTable:
+
+    def __init__ (self):
+        self.zones = {}                                                 ## file name -> (days, times, offsets) lists
+        for name in sorted(os.listdir(app_files.dir_z_time)):
+            if ((name[:2] == "z_") and (name[-4:] == ".txt")):
+                self.zones[app_files.dir_z_time + name] = self.compile(app_files.dir_z_time + name)
+
+        nrg   = regions.count
+        keys  = []
+        offs  = []
+        for r in range(nrg + 1):                                        ## 0 is the invalid ID (no offset)
+            times, tofs = [ k_TZ_T_BASE ], [ 0 ]
+            if (regions.valid[r]):
+                tofs = [ int(regions.offset[r]) ]
+            if (regions.lookup[r] != ""):
+                times, tofs = self.zones[regions.lookup[r]][1:]
+            keys.extend([ (r * k_TZ_T_KEY) + (t - k_TZ_T_BASE) for t in times ])
+            offs.extend(tofs)
+        self.nrg  = nrg
+        self.keys = numpy.array(keys, dtype=numpy.int64)
+        self.offs = numpy.array(offs, dtype=numpy.int32)
+        self.secs = tz_offset_seconds(self.offs)
+
+    ## Compile one timezone file in to its transitions.
+
+    def compile (self, fname):
+        nln   = app_files.file_get_lines(fname, app_files.k_LEN_Z_xxxx)
+        days  = []
+        times = []
+        offs  = []
+        b     = 0
+        for s in app_files.file_read_lines(fname, range(1, nln + 1), app_files.k_LEN_Z_xxxx):
+            a   = int(s[0:4])
+            eoy = datetime.date(year = a, month = 12, day = 31)
+            c   = datetime.date(year = a, month = 1, day = 1)
+            self.add(days, times, offs, c, 0, b, int(s[5:10]))          ## start of the year
+            b   = int(s[5:10])
+            for i in range(4):
+                k = i * 12
+                if (s[11 + k] != '~'):                                  ## a break date that is earlier than the last one
+                    c = max(c, datetime.date(year = a, month = int(s[(11 + k):(13 + k)]), day = int(s[(14 + k):(16 + k)])))
+                else:                                                   ## can't be reached before the last one is, and
+                    c = max(c, eoy)                                     ## all tildes is the end of the year
+                if (s[17 + k] != '~'):
+                    self.add(days, times, offs, c, 1, b, int(s[(17 + k):(22 + k)]))
+                    b = int(s[(17 + k):(22 + k)])
+        if (len(times) > 0): times[0] = k_TZ_T_BASE                     ## the first offset is good from the beginning
+        return (days, times, offs)
+
+    ## Add a transition on date c at hour h (local), from offset b to offset o.  Instants are kept in order even when
+    ## two changeovers fall on the same day.
+
+    def add (self, days, times, offs, c, h, b, o):
+        d = (c - datetime.date(1970, 1, 1)).days
+        t = (d * 86400) + (h * 3600) - int(tz_offset_seconds(b))
+        if (len(times) > 0): t = max(t, times[-1])
+        days.append(d)
+        times.append(t)
+        offs.append(o)
+
+    ## Return the offset in effect on a date, for a timezone file.
+
+    def offset_on (self, fname, adate):
+        days, times, offs = self.zones[fname]
+        d = tz_clamp_day((adate - datetime.date(1970, 1, 1)).days)
+        return (offs[max(bisect.bisect_right(days, d) - 1, 0)])
+
+    ## Return the offset in effect at an instant (seconds since 1970-01-01 00:00 UTC), for a timezone file.
+
+    def offset_at (self, fname, t):
+        days, times, offs = self.zones[fname]
+        t = int(tz_clamp_time(numpy.array([ t ], dtype=numpy.int64))[0])
+        return (offs[max(bisect.bisect_right(times, t) - 1, 0)])
+
+    ## Return the index in to self.offs of the transition in effect for arrays of timezone IDs and instants.  IDs that
+    ## are not regions in all_rgn.txt get the index of an offset of zero.
+
+    def index_many (self, zone_ids, timestamps):
+        z = numpy.asarray(zone_ids, dtype=numpy.int64)
+        t = numpy.floor(numpy.asarray(timestamps, dtype=numpy.float64)).astype(numpy.int64)
+        z, t = numpy.broadcast_arrays(z, t)
+        z = numpy.where((z >= 1) & (z <= self.nrg), z, 0)
+        t = tz_clamp_time(t)
+        return (numpy.searchsorted(self.keys, (z * k_TZ_T_KEY) + (t - k_TZ_T_BASE), side='right') - 1)
+
+
+tz_trans = None                                                         ## compiled transitions (loaded on first use)
+
+def get_timezone_transitions ():
+    global tz_trans
+    if (tz_trans is None): tz_trans = TransitionTable()
+    return (tz_trans)
+
+
+## Convert <+|->hhmm offsets (a single integer or an array) to seconds.
+
+def tz_offset_seconds (off):
+    a = numpy.abs(off)
+    return (numpy.sign(off) * (((a // 100) * 3600) + ((a % 100) * 60)))
+
+
+## Move days (as days since 1970-01-01) that are outside the years in the timezone files to the same day of the year
+## in the closest year that is in the files.
+
+def tz_clamp_day (d):
+    if ((d < k_TZ_DAY_LO) or (d >= k_TZ_DAY_HI)):
+        y   = datetime.date.fromordinal(d + 719163).year                ## 719163 = ordinal of 1970-01-01
+        rel = min(d - (datetime.date(y, 1, 1) - datetime.date(1970, 1, 1)).days, 364)
+        d   = (k_TZ_DAY_LO if (d < k_TZ_DAY_LO) else (k_TZ_DAY_HI - 365)) + rel
+    return (d)
+
+
+## The same for an array of instants (as seconds since 1970-01-01 00:00 UTC).
+
+def tz_clamp_time (t):
+    lo  = k_TZ_DAY_LO * 86400
+    hi  = k_TZ_DAY_HI * 86400
+    out = (t < lo) | (t >= hi)
+    if (not out.any()): return (t)
+    t   = t.copy()
+    ts  = t[out]
+    y0  = ts.astype('M8[s]').astype('M8[Y]').astype('M8[s]').astype(numpy.int64)
+    rel = numpy.minimum(ts - y0, (365 * 86400) - 1)                     ## 2023 and 2099 are not leap years
+    t[out] = numpy.where(ts < lo, lo, hi - (365 * 86400)) + rel
+    return (t)
+
+
+## Return the offsets (as <+|->hhmm) in effect for arrays of timezone IDs (as returned by get_timezone, one-based lines
+## of all_rgn.txt) and UTC instants (as seconds since 1970-01-01 00:00 UTC).  IDs that are not valid have an offset of
+## zero.  The arrays are broadcast against each other, so a single ID can be given for a whole array of instants.
+
+def tz_offset_many (zone_ids, timestamps):
+    tt = get_timezone_transitions()
+    return (tt.offs[tt.index_many(zone_ids, timestamps)])
+
+
+## Convert arrays of UTC instants (seconds since 1970-01-01 00:00 UTC) to local instants for arrays of timezone IDs,
+## by adding the offset in effect at each instant.  The result has the same type as the timestamps given.
+
+def utc_to_local_many (zone_ids, timestamps):
+    tt = get_timezone_transitions()
+    ts = numpy.asarray(timestamps)
+    return (ts + tt.secs[tt.index_many(zone_ids, ts)])
 
 
 ## ------------------------------------------------------------------------------------------------- TEST CODE
@@ -367,5 +733,54 @@ def app_timezones_test ():
     print(get_timezone_data(ar, ad))
     print(get_timezone_data(249, ad))
     print(get_timezone_data(49, ad))
+
+    ut = int(datetime.datetime(2026, 3, 8, 9, 0, 0, tzinfo=datetime.UTC).timestamp())  ## PST -> PDT at 0100 local
+    print(tz_offset_many(ar, [ ut - 1, ut ]))
+    print(utc_to_local_many([ ar, ar, 49 ], ut) - ut)
     
 ## app_timezones_test()
+
+
+## Compare the two lookup engines:  resident memory after loading, cold start (load plus first lookup), and the
+## latency of scalar and batch lookups over the same set of random points.  The raster is generated beforehand if it
+## is missing, so that its cold start is just the memory map.
+
+def app_timezones_rss ():
+    try:
+        f = open("/proc/self/statm")
+        n = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        f.close()
+        return (n / 1e6)
+    except (OSError, ValueError, AttributeError):
+        return (0.0)
+
+def app_timezones_bench (n = 100000):
+    global tz_map, tz_raster
+    if (tz_raster_stale()):
+        tz_raster_build()
+        tz_raster = None                                                ## drop the raster mapped from the old file
+        app_files.store.release(app_files.file_tz_raster)
+    rng  = numpy.random.default_rng(1)
+    lats = rng.uniform(-84.9, 84.9, n)
+    lons = rng.uniform(-180.0, 180.0, n)
+    for eng in k_TZ_ENGINES:
+        tz_map    = None                                                ## start each engine from nothing
+        tz_raster = None
+        app_files.store.release(app_files.file_tz_index)
+        app_files.store.release(app_files.file_tz_map)
+        app_files.store.release(app_files.file_tz_raster)
+        set_timezone_engine(eng)
+        m0 = app_timezones_rss()
+        t0 = time.perf_counter()
+        get_timezone(47.45, -122.65)
+        t1 = time.perf_counter()
+        for i in range(n): get_timezone(lats[i], lons[i])
+        t2 = time.perf_counter()
+        get_timezone_many(lats, lons)
+        t3 = time.perf_counter()
+        m1 = app_timezones_rss()
+        print("%-6s  cold start %8.2f ms   scalar %6.2f us/pt   batch %6.3f us/pt   rss +%6.1f MB" %
+              (eng, (t1 - t0) * 1e3, (t2 - t1) * 1e6 / n, (t3 - t2) * 1e6 / n, m1 - m0))
+    set_timezone_engine("rle")
+
+## app_timezones_bench()